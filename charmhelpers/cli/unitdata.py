@@ -18,6 +18,7 @@ from charmhelpers.core import unitdata
 
 @cmdline.subcommand_builder('unitdata', description="Store and retrieve data")
 def unitdata_cmd(subparser):
+    subparser.set_defaults(keep_revisions=None, keep_days=None, vacuum=False)
     nested = subparser.add_subparsers()
     get_cmd = nested.add_parser('get', help='Retrieve data')
     get_cmd.add_argument('key', help='Key to retrieve the value of')
@@ -26,12 +27,24 @@ def unitdata_cmd(subparser):
     set_cmd.add_argument('key', help='Key to set')
     set_cmd.add_argument('value', help='Value to store')
     set_cmd.set_defaults(action='set')
+    compact_cmd = nested.add_parser('compact', help='Remove old history')
+    compact_cmd.add_argument('--keep-revisions', type=int,
+                             help='Number of revisions to keep for each key')
+    compact_cmd.add_argument('--keep-days', type=int,
+                             help='Number of days of hook history to keep')
+    compact_cmd.add_argument('--vacuum', action='store_true',
+                             help='Reclaim free space in the database file')
+    compact_cmd.set_defaults(action='compact', key=None, value=None)
 
-    def _unitdata_cmd(action, key, value):
+    def _unitdata_cmd(action, key, value, keep_revisions, keep_days, vacuum):
         if action == 'get':
             return unitdata.kv().get(key)
         elif action == 'set':
             unitdata.kv().set(key, value)
             unitdata.kv().flush()
             return ''
+        elif action == 'compact':
+            removed = unitdata.kv().compact(keep_revisions, keep_days, vacuum)
+            unitdata.kv().flush()
+            return removed
     return _unitdata_cmd
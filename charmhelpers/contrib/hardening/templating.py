@@ -20,9 +20,10 @@ from charmhelpers.core.hookenv import (
     DEBUG,
     WARNING,
 )
+from charmhelpers.core.templating import get_environment
 
 try:
-    from jinja2 import FileSystemLoader, Environment
+    from jinja2 import FileSystemLoader
 except ImportError:
     from charmhelpers.fetch import apt_install
     from charmhelpers.fetch import apt_update
@@ -31,7 +32,7 @@ except ImportError:
         apt_install('python-jinja2', fatal=True)
     else:
         apt_install('python3-jinja2', fatal=True)
-    from jinja2 import FileSystemLoader, Environment
+    from jinja2 import FileSystemLoader
 
 
 # NOTE: function separated from main rendering code to facilitate easier
@@ -59,7 +60,7 @@ def render_and_write(template_dir, path, context):
     :param path: the path to write the templated contents to
     :param context: the parameters to pass to the rendering engine
     """
-    env = Environment(loader=FileSystemLoader(template_dir))
+    env = get_environment(FileSystemLoader(template_dir))
     template_file = os.path.basename(path)
     template = env.get_template(template_file)
     log('Rendering from template: %s' % template.name, level=DEBUG)
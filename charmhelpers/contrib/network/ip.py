@@ -12,12 +12,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import bisect
 import glob
 import re
 import subprocess
 import six
 import socket
 
+from collections import namedtuple
 from functools import partial
 
 from charmhelpers.fetch import apt_install, apt_update
@@ -87,6 +89,161 @@ def _get_ipv6_network_from_address(address):
                                         netmask))
 
 
+# An address configured on an interface, with the network it is on.
+# order is the position of the address when walking the interfaces in
+# netifaces order, so that lookups return the same address as that walk.
+IfaceNetwork = namedtuple('IfaceNetwork', ['order', 'iface', 'addr',
+                                           'network', 'primary'])
+
+_LINK_LOCAL_SCOPE = re.compile("(.+)%.*")
+_ADDRESS_WIDTH = {4: 32, 6: 128}
+
+
+class InterfaceSnapshot(object):
+    """The interfaces of this host and the addresses configured on them.
+
+    The addresses of each interface are read from netifaces once, and the
+    networks they are on are indexed so that finding the interface an
+    address could be bound to, or the address on a network, does not walk
+    every interface::
+
+        snapshot = interface_snapshot()
+        snapshot.network_for_address('10.5.0.10').iface
+    """
+
+    def __init__(self):
+        self.interfaces = list(netifaces.interfaces())
+        self._addresses = {}
+        self._index = None
+        self._local = None
+
+    def ifaddresses(self, iface):
+        """Return netifaces.ifaddresses(iface), or {} if iface has gone."""
+        if iface not in self._addresses:
+            try:
+                self._addresses[iface] = netifaces.ifaddresses(iface)
+            except ValueError:
+                # If an instance was deleted between
+                # netifaces.interfaces() run and now, its interfaces are gone
+                self._addresses[iface] = {}
+        return self._addresses[iface]
+
+    def networks(self):
+        """Yield an IfaceNetwork for each address on a routable network.
+
+        Only the first IPv4 address of an interface is primary.  IPv6
+        link local and loopback addresses are skipped.
+        """
+        order = 0
+        for iface in self.interfaces:
+            addresses = self.ifaddresses(iface)
+            for n, addr in enumerate(addresses.get(netifaces.AF_INET, [])):
+                network = netaddr.IPNetwork("%s/%s" % (addr['addr'],
+                                                       addr['netmask']))
+                yield IfaceNetwork(order, iface, addr, network, n == 0)
+                order += 1
+            for addr in addresses.get(netifaces.AF_INET6, []):
+                network = _get_ipv6_network_from_address(addr)
+                if network:
+                    yield IfaceNetwork(order, iface, addr, network, True)
+                    order += 1
+
+    def _get_index(self):
+        """Index networks() by version.
+
+        For each version there is a prefix table, {prefixlen: {network bits:
+        [IfaceNetwork]}}, to look up the networks containing an address
+        with one probe per prefix length in use, and the networks sorted by
+        their first address, to find those within a given network with a
+        bisection.
+        """
+        if self._index is None:
+            self._index = {}
+            for ifnet in self.networks():
+                version = ifnet.network.version
+                prefixes, by_first = self._index.setdefault(version, ({}, []))
+                shift = _ADDRESS_WIDTH[version] - ifnet.network.prefixlen
+                prefixes.setdefault(ifnet.network.prefixlen, {}).setdefault(
+                    ifnet.network.first >> shift, []).append(ifnet)
+                by_first.append((ifnet.network.first, ifnet.order, ifnet))
+            for prefixes, by_first in self._index.values():
+                by_first.sort()
+        return self._index
+
+    def network_for_address(self, address, primary=False):
+        """Return the first IfaceNetwork whose network contains address,
+        or None.
+
+        :param address: an netaddr.IPAddress.
+        :param primary: only consider primary addresses.
+        """
+        prefixes, _ = self._get_index().get(address.version, ({}, []))
+        width = _ADDRESS_WIDTH[address.version]
+        found = None
+        for prefixlen, networks in prefixes.items():
+            for ifnet in networks.get(int(address) >> (width - prefixlen), ()):
+                if primary and not ifnet.primary:
+                    continue
+                if found is None or ifnet.order < found.order:
+                    found = ifnet
+                break
+        return found
+
+    def address_in_network(self, network):
+        """Return the first IfaceNetwork on a subnet of network, or None.
+
+        :param network: an netaddr.IPNetwork.
+        """
+        _, by_first = self._get_index().get(network.version, ({}, []))
+        start = bisect.bisect_left(by_first, (network.first,))
+        found = None
+        for first, order, ifnet in by_first[start:]:
+            if first > network.last:
+                break
+            if ifnet.network.last <= network.last and \
+                    (found is None or order < found.order):
+                found = ifnet
+        return found
+
+    def iface_with_address(self, address):
+        """Return the first interface address is configured on, or None.
+
+        Addresses of every family are considered, with any link local
+        scope (e.g. %eth0) removed.
+        """
+        if self._local is None:
+            self._local = {}
+            for iface in self.interfaces:
+                addresses = self.ifaddresses(iface)
+                for inet_type in addresses:
+                    for addr in addresses[inet_type]:
+                        addr = addr['addr']
+                        raw = re.match(_LINK_LOCAL_SCOPE, addr)
+                        if raw:
+                            addr = raw.group(1)
+                        self._local.setdefault(addr, iface)
+        return self._local.get(address)
+
+
+_interface_snapshot = None
+
+
+def interface_snapshot(refresh=False):
+    """Return the InterfaceSnapshot used by the address lookups in this
+    module.
+
+    The snapshot is taken on first use, so normally once per hook, and is
+    kept until it is refreshed, e.g. after the charm adds an address or an
+    interface.
+
+    :param refresh (boolean): take a new snapshot.
+    """
+    global _interface_snapshot
+    if refresh or _interface_snapshot is None:
+        _interface_snapshot = InterfaceSnapshot()
+    return _interface_snapshot
+
+
 def get_address_in_network(network, fallback=None, fatal=False):
     """Get an IPv4 or IPv6 address within the network from the host.
 
@@ -108,26 +265,10 @@ def get_address_in_network(network, fallback=None, fatal=False):
     networks = network.split() or [network]
     for network in networks:
         _validate_cidr(network)
-        network = netaddr.IPNetwork(network)
-        for iface in netifaces.interfaces():
-            try:
-                addresses = netifaces.ifaddresses(iface)
-            except ValueError:
-                # If an instance was deleted between
-                # netifaces.interfaces() run and now, its interfaces are gone
-                continue
-            if network.version == 4 and netifaces.AF_INET in addresses:
-                for addr in addresses[netifaces.AF_INET]:
-                    cidr = netaddr.IPNetwork("%s/%s" % (addr['addr'],
-                                                        addr['netmask']))
-                    if cidr in network:
-                        return str(cidr.ip)
-
-            if network.version == 6 and netifaces.AF_INET6 in addresses:
-                for addr in addresses[netifaces.AF_INET6]:
-                    cidr = _get_ipv6_network_from_address(addr)
-                    if cidr and cidr in network:
-                        return str(cidr.ip)
+        ifnet = interface_snapshot().address_in_network(
+            netaddr.IPNetwork(network))
+        if ifnet:
+            return str(ifnet.network.ip)
 
     if fallback is not None:
         return fallback
@@ -188,34 +329,16 @@ def _get_for_address(address, key):
     :returns str: Requested attribute or None if address is not bindable.
     """
     address = netaddr.IPAddress(address)
-    for iface in netifaces.interfaces():
-        addresses = netifaces.ifaddresses(iface)
-        if address.version == 4 and netifaces.AF_INET in addresses:
-            addr = addresses[netifaces.AF_INET][0]['addr']
-            netmask = addresses[netifaces.AF_INET][0]['netmask']
-            network = netaddr.IPNetwork("%s/%s" % (addr, netmask))
-            cidr = network.cidr
-            if address in cidr:
-                if key == 'iface':
-                    return iface
-                else:
-                    return addresses[netifaces.AF_INET][0][key]
-
-        if address.version == 6 and netifaces.AF_INET6 in addresses:
-            for addr in addresses[netifaces.AF_INET6]:
-                network = _get_ipv6_network_from_address(addr)
-                if not network:
-                    continue
-
-                cidr = network.cidr
-                if address in cidr:
-                    if key == 'iface':
-                        return iface
-                    elif key == 'netmask' and cidr:
-                        return str(cidr).split('/')[1]
-                    else:
-                        return addr[key]
-    return None
+    # Only the first IPv4 address of each interface is considered.
+    ifnet = interface_snapshot().network_for_address(
+        address, primary=address.version == 4)
+    if ifnet is None:
+        return None
+    if key == 'iface':
+        return ifnet.iface
+    elif key == 'netmask' and address.version == 6:
+        return str(ifnet.network.prefixlen)
+    return ifnet.addr[key]
 
 
 get_iface_for_address = partial(_get_for_address, key='iface')
@@ -281,7 +404,8 @@ def get_iface_addr(iface='eth0', inet_type='AF_INET', inc_aliases=False,
     except AttributeError:
         raise Exception("Unknown inet type '%s'" % str(inet_type))
 
-    interfaces = netifaces.interfaces()
+    snapshot = interface_snapshot()
+    interfaces = snapshot.interfaces
     if inc_aliases:
         ifaces = []
         for _iface in interfaces:
@@ -304,7 +428,7 @@ def get_iface_addr(iface='eth0', inet_type='AF_INET', inc_aliases=False,
 
     addresses = []
     for netiface in ifaces:
-        net_info = netifaces.ifaddresses(netiface)
+        net_info = snapshot.ifaddresses(netiface)
         if inet_num in net_info:
             for entry in net_info[inet_num]:
                 if 'addr' in entry and entry['addr'] not in exc_list:
@@ -322,21 +446,10 @@ get_ipv4_addr = partial(get_iface_addr, inet_type='AF_INET')
 
 def get_iface_from_addr(addr):
     """Work out on which interface the provided address is configured."""
-    for iface in netifaces.interfaces():
-        addresses = netifaces.ifaddresses(iface)
-        for inet_type in addresses:
-            for _addr in addresses[inet_type]:
-                _addr = _addr['addr']
-                # link local
-                ll_key = re.compile("(.+)%.*")
-                raw = re.match(ll_key, _addr)
-                if raw:
-                    _addr = raw.group(1)
-
-                if _addr == addr:
-                    log("Address '%s' is configured on iface '%s'" %
-                        (addr, iface))
-                    return iface
+    iface = interface_snapshot().iface_with_address(addr)
+    if iface is not None:
+        log("Address '%s' is configured on iface '%s'" % (addr, iface))
+        return iface
 
     msg = "Unable to infer net iface on which '%s' is configured" % (addr)
     raise Exception(msg)
@@ -12,13 +12,22 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import binascii
+import errno
 import os
+import stat
+import threading
+import time
+from contextlib import contextmanager
 
 import six
 
 from charmhelpers.fetch import apt_install, apt_update
+from charmhelpers.core.host import parallel_map
+from charmhelpers.core.templating import bytecode_cache
 from charmhelpers.core.hookenv import (
     log,
+    DEBUG,
     ERROR,
     INFO,
     TRACE
@@ -40,6 +49,47 @@ class OSConfigException(Exception):
     pass
 
 
+def _create_temp(path):
+    """
+    Create a temporary file next to path, with mode 0o666 less the umask
+    like open() would, and return (fd, temporary path).
+    """
+    prefix = os.path.join(os.path.dirname(path),
+                          '.{}.'.format(os.path.basename(path)))
+    while True:
+        tmp = prefix + binascii.hexlify(os.urandom(4)).decode('ascii')
+        try:
+            return os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                           0o666), tmp
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+
+def _write_atomic(path, content):
+    """
+    Replace the content of path atomically, keeping its mode and ownership.
+    Symlinks are followed.  A new file gets the same mode and ownership as
+    with open(), which honours the umask.
+    """
+    path = os.path.realpath(path)
+    try:
+        st = os.stat(path)
+    except OSError:
+        st = None
+    fd, tmp = _create_temp(path)
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            if st is not None:
+                os.fchown(out.fileno(), st.st_uid, st.st_gid)
+                os.fchmod(out.fileno(), stat.S_IMODE(st.st_mode))
+            out.write(content)
+        os.rename(tmp, path)
+    except Exception:
+        os.unlink(tmp)
+        raise
+
+
 def get_loader(templates_dir, os_release):
     """
     Create a jinja2.ChoiceLoader containing template dirs up to
@@ -88,6 +138,48 @@ def get_loader(templates_dir, os_release):
     return ChoiceLoader(loaders)
 
 
+class ContextMemo(object):
+    """
+    Remembers what each context generator returned during a render pass of
+    an OSConfigRenderer, so generators shared by several config files are
+    only called once.  Results are keyed by generator instance.
+    """
+
+    def __init__(self):
+        self._results = {}
+        # id(generator) -> [generator, runs, hits]
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, generator):
+        key = id(generator)
+        with self._lock:
+            stats = self._stats.setdefault(key, [generator, 0, 0])
+            if key in self._results:
+                stats[2] += 1
+            else:
+                stats[1] += 1
+                self._results[key] = generator()
+            return self._results[key]
+
+    def invalidate(self, generator=None):
+        """
+        Forget the result of generator, or of all generators if it is None,
+        so they are called again on next use.
+        """
+        if generator is None:
+            self._results.clear()
+        else:
+            self._results.pop(id(generator), None)
+
+    def stats(self):
+        """
+        :returns: list of (generator, runs, hits) tuples, the number of
+            times each generator was called and was answered from the memo.
+        """
+        return [tuple(stats) for stats in self._stats.values()]
+
+
 class OSConfigTemplate(object):
     """
     Associates a config file template with a list of context generators.
@@ -106,10 +198,10 @@ class OSConfigTemplate(object):
 
         self.config_template = config_template
 
-    def context(self):
+    def context(self, memo=None):
         ctxt = {}
         for context in self.contexts:
-            _ctxt = context()
+            _ctxt = memo(context) if memo else context()
             if _ctxt:
                 ctxt.update(_ctxt)
                 # track interfaces for every complete context.
@@ -118,13 +210,13 @@ class OSConfigTemplate(object):
                  if interface not in self._complete_contexts]
         return ctxt
 
-    def complete_contexts(self):
+    def complete_contexts(self, memo=None):
         '''
         Return a list of interfaces that have satisfied contexts.
         '''
         if self._complete_contexts:
             return self._complete_contexts
-        self.context()
+        self.context(memo)
         return self._complete_contexts
 
     @property
@@ -209,6 +301,15 @@ class OSConfigRenderer(object):
     of generators.  When a template is rendered and written, all context
     generates are called in a chain to generate the context dictionary
     passed to the jinja2 template. See context.py for more info.
+
+    Within a render pass each context generator is called only once, even
+    if it is registered for several config files.  write_all() and
+    complete_contexts() are render passes of their own; wrap several calls
+    in render_pass() to share context generator results between them::
+
+        with configs.render_pass():
+            configs.write_all()
+            interfaces = configs.complete_contexts()
     """
     def __init__(self, templates_dir, openstack_release):
         if not os.path.isdir(templates_dir):
@@ -220,6 +321,9 @@ class OSConfigRenderer(object):
         self.openstack_release = openstack_release
         self.templates = {}
         self._tmpl_env = None
+        self._memo = None
+        # config file -> seconds its last render took
+        self.render_times = {}
 
         if None in [Environment, ChoiceLoader, FileSystemLoader]:
             # if this code is running, the object is created pre-install hook.
@@ -251,7 +355,8 @@ class OSConfigRenderer(object):
     def _get_tmpl_env(self):
         if not self._tmpl_env:
             loader = get_loader(self.templates_dir, self.openstack_release)
-            self._tmpl_env = Environment(loader=loader)
+            self._tmpl_env = Environment(loader=loader,
+                                         bytecode_cache=bytecode_cache())
 
     def _get_template(self, template):
         self._get_tmpl_env()
@@ -278,7 +383,7 @@ class OSConfigRenderer(object):
             raise OSConfigException
 
         ostmpl = self.templates[config_file]
-        ctxt = ostmpl.context()
+        ctxt = ostmpl.context(self._memo)
 
         if ostmpl.is_string_template:
             template = self._get_template_from_string(ostmpl)
@@ -308,11 +413,22 @@ class OSConfigRenderer(object):
 
             log('Rendering from template: {}'.format(config_file),
                 level=INFO)
-        return template.render(ctxt)
+        started = time.time()
+        try:
+            return template.render(ctxt)
+        finally:
+            self.render_times[config_file] = time.time() - started
+            log('Rendered {} in {:.3f}s'.format(
+                config_file, self.render_times[config_file]), level=DEBUG)
 
     def write(self, config_file):
         """
         Write a single config file, raises if config file is not registered.
+
+        The file is left untouched if it already has the rendered content,
+        otherwise it is replaced atomically.
+
+        :returns: True if the file was written, False if it was unchanged.
         """
         if config_file not in self.templates:
             log('Config not registered: %s' % config_file, level=ERROR)
@@ -322,16 +438,69 @@ class OSConfigRenderer(object):
         if six.PY3:
             _out = _out.encode('UTF-8')
 
-        with open(config_file, 'wb') as out:
-            out.write(_out)
+        try:
+            if os.path.getsize(config_file) == len(_out):
+                with open(config_file, 'rb') as current:
+                    if current.read() == _out:
+                        log('Template %s is unchanged.' % config_file,
+                            level=DEBUG)
+                        return False
+        except (IOError, OSError):
+            pass
+        _write_atomic(config_file, _out)
 
         log('Wrote template %s.' % config_file, level=INFO)
+        return True
 
-    def write_all(self):
+    def write_all(self, workers=1):
         """
         Write out all registered config files.
+
+        :param workers (int): render and write up to this many config files
+            at once.  The context generators are all called first, one at a
+            time, so only rendering and writing run concurrently.
+        :returns: the set of config files whose content changed, e.g. to
+            restart the services that use them.  The time each one took to
+            render is in render_times.
+        """
+        config_files = list(self.templates)
+        with self.render_pass() as memo:
+            if workers > 1 and len(config_files) > 1:
+                for config_file in config_files:
+                    self.templates[config_file].context(memo)
+                self._get_tmpl_env()
+            written = parallel_map(self.write, config_files, workers)
+        return set(k for k, changed in zip(config_files, written) if changed)
+
+    @contextmanager
+    def render_pass(self):
+        """
+        Call each context generator at most once for the config files
+        rendered and contexts checked within the block.  Nested passes are
+        part of the outermost one.
+
+        :returns: the ContextMemo of the pass.
+        """
+        if self._memo is not None:
+            yield self._memo
+            return
+        self._memo = ContextMemo()
+        try:
+            yield self._memo
+        finally:
+            memo, self._memo = self._memo, None
+            for generator, runs, hits in memo.stats():
+                log('Context {} ran {} times, reused {} times'.format(
+                    generator.__class__.__name__, runs, hits), level=DEBUG)
+
+    def invalidate_contexts(self, generator=None):
+        """
+        Call generator, or all context generators if it is None, again the
+        next time they are needed in the current render pass.  Use this
+        after changing what a generator reads, e.g. relation data.
         """
-        [self.write(k) for k in six.iterkeys(self.templates)]
+        if self._memo is not None:
+            self._memo.invalidate(generator)
 
     def set_release(self, openstack_release):
         """
@@ -347,8 +516,9 @@ class OSConfigRenderer(object):
         Returns a list of context interfaces that yield a complete context.
         '''
         interfaces = []
-        [interfaces.extend(i.complete_contexts())
-         for i in six.itervalues(self.templates)]
+        with self.render_pass() as memo:
+            [interfaces.extend(i.complete_contexts(memo))
+             for i in six.itervalues(self.templates)]
         return interfaces
 
     def get_incomplete_context_data(self, interfaces):
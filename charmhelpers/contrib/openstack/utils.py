@@ -70,7 +70,7 @@ from charmhelpers.core.host import (
     lsb_release,
     mounts,
     umount,
-    service_running,
+    services_running,
     service_pause,
     service_resume,
     restart_on_change_helper,
@@ -85,8 +85,7 @@ from charmhelpers.fetch import (
 )
 
 from charmhelpers.fetch.snap import (
-    snap_install,
-    snap_refresh,
+    snap_many,
     valid_snap_channel,
 )
 
@@ -1041,8 +1040,8 @@ def _check_running_services(services):
     @returns [(service, boolean), ...], : results for checks
              [boolean]                  : just the result of the service checks
     """
-    services_running = [service_running(s) for s in services]
-    return list(zip(services, services_running)), services_running
+    states = services_running(services)
+    return list(zip(services, states)), states
 
 
 def _check_listening_on_services_ports(services, test=False):
@@ -1412,7 +1411,8 @@ def make_assess_status_func(*args, **kwargs):
 
 
 def pausable_restart_on_change(restart_map, stopstart=False,
-                               restart_functions=None):
+                               restart_functions=None,
+                               restart_workers=None, restart_graph=None):
     """A restart_on_change decorator that checks to see if the unit is
     paused. If it is paused then the decorated function doesn't fire.
 
@@ -1436,6 +1436,8 @@ def pausable_restart_on_change(restart_map, stopstart=False,
     @param f: the function to decorate
     @param restart_map: the restart map {conf_file: [services]}
     @param stopstart: DEFAULT false; whether to stop, start or just restart
+    @param restart_workers: restart independent services concurrently
+    @param restart_graph: {service: [service it depends on, ...]}
     @returns decorator to use a restart_on_change with pausability
     """
     def wrap(f):
@@ -1446,7 +1448,8 @@ def pausable_restart_on_change(restart_map, stopstart=False,
             # otherwise, normal restart_on_change functionality
             return restart_on_change_helper(
                 (lambda: f(*args, **kwargs)), restart_map, stopstart,
-                restart_functions)
+                restart_functions, restart_workers=restart_workers,
+                restart_graph=restart_graph)
         return wrapped_f
     return wrap
 
@@ -1668,6 +1671,14 @@ def install_os_snaps(snaps, refresh=False):
         or --jailmode.
     @param post_snap_install: Callback function to run after snaps have been
     installed
+    @param refresh: Refresh installed snaps instead of installing them
+    @raises: the exception of the first snap command that failed
+
+    snap only accepts channel and mode flags for a single snap, so each snap
+    still takes its own snap command. They are run one at a time, as
+    concurrent changes mostly wait on each other in snapd; only the snaps
+    which are already installed, or not installed when refreshing, are
+    skipped without running snap.
     """
 
     def _ensure_flag(flag):
@@ -1675,13 +1686,9 @@ def install_os_snaps(snaps, refresh=False):
             return flag
         return '--{}'.format(flag)
 
-    if refresh:
-        for snap in snaps.keys():
-            snap_refresh(snap,
-                         _ensure_flag(snaps[snap]['channel']),
-                         _ensure_flag(snaps[snap]['mode']))
-    else:
-        for snap in snaps.keys():
-            snap_install(snap,
-                         _ensure_flag(snaps[snap]['channel']),
-                         _ensure_flag(snaps[snap]['mode']))
+    _, errors = snap_many(
+        'refresh' if refresh else 'install',
+        {snap: [_ensure_flag(info['channel']), _ensure_flag(info['mode'])]
+         for snap, info in snaps.items()}, workers=1)
+    if errors:
+        raise list(errors.values())[0]
@@ -16,6 +16,7 @@
 Templating using the python-jinja2 package.
 """
 import six
+from charmhelpers.core.templating import get_environment
 from charmhelpers.fetch import apt_install, apt_update
 try:
     import jinja2
@@ -32,7 +33,6 @@ DEFAULT_TEMPLATES_DIR = 'templates'
 
 
 def render(template_name, context, template_dir=DEFAULT_TEMPLATES_DIR):
-    templates = jinja2.Environment(
-        loader=jinja2.FileSystemLoader(template_dir))
+    templates = get_environment(jinja2.FileSystemLoader(template_dir))
     template = templates.get_template(template_name)
     return template.render(context)
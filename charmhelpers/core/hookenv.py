@@ -24,6 +24,7 @@ from distutils.version import LooseVersion
 from functools import wraps
 from collections import namedtuple
 import glob
+import itertools
 import os
 import json
 import yaml
@@ -32,6 +33,7 @@ import subprocess
 import sys
 import errno
 import tempfile
+import threading
 from subprocess import CalledProcessError
 
 import six
@@ -49,7 +51,103 @@ DEBUG = "DEBUG"
 TRACE = "TRACE"
 MARKER = object()
 
-cache = {}
+
+class FunctionCache(object):
+    """Return values of cached functions, stored per function and indexed
+    by the string arguments (unit names, relation ids, ...) that each
+    value was computed from.
+
+    A value inherits the arguments of any cached function called while
+    computing it, so invalidating a unit also drops derived values such
+    as relations() or relation_for_unit() for that unit. The functions
+    being computed are tracked per thread, so cached functions can be
+    called from worker threads.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._index = {}
+        self._lock = threading.RLock()
+        self._local = threading.local()
+
+    @property
+    def _computing(self):
+        """The tags of the values being computed by the current thread"""
+        try:
+            return self._local.computing
+        except AttributeError:
+            self._local.computing = []
+            return self._local.computing
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(entries) for entries in self._entries.values())
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._index.clear()
+
+    def get(self, func, key):
+        """Return the cached value of func for key, or MARKER"""
+        try:
+            value, tags = self._entries[func][key]
+        except KeyError:
+            return MARKER
+        computing = self._computing
+        if computing:
+            computing[-1].update(tags)
+        return value
+
+    def call(self, func, args, kwargs):
+        """Return func(*args, **kwargs), computing it only on a miss"""
+        key = _cache_key(args, kwargs)
+        value = self.get(func, key)
+        if value is not MARKER:
+            return value
+        tags = set(arg for arg in itertools.chain(args, kwargs.values())
+                   if isinstance(arg, six.string_types))
+        computing = self._computing
+        computing.append(tags)
+        try:
+            value = func(*args, **kwargs)
+        finally:
+            computing.pop()
+        with self._lock:
+            self._entries.setdefault(func, {})[key] = (value, tags)
+            for tag in tags:
+                self._index.setdefault(tag, set()).add((func, key))
+        if computing:
+            computing[-1].update(tags)
+        return value
+
+    def invalidate(self, tag):
+        """Drop every value computed from the string argument tag"""
+        with self._lock:
+            for func, key in self._index.pop(tag, ()):
+                self._drop(func, key)
+
+    def flush(self, key):
+        """Drop every value where key is a substring of function+args"""
+        with self._lock:
+            for func, entries in list(self._entries.items()):
+                for entry_key in list(entries):
+                    if key in json.dumps((func, entry_key), default=str):
+                        self._drop(func, entry_key)
+
+    def _drop(self, func, key):
+        entry = self._entries.get(func, {}).pop(key, None)
+        if entry is None:
+            return
+        for tag in entry[1]:
+            refs = self._index.get(tag)
+            if refs is not None:
+                refs.discard((func, key))
+                if not refs:
+                    del self._index[tag]
+
+
+cache = FunctionCache()
 
 
 def cached(func):
@@ -67,28 +165,159 @@ def cached(func):
     """
     @wraps(func)
     def wrapper(*args, **kwargs):
-        global cache
-        key = json.dumps((func, args, kwargs), sort_keys=True, default=str)
-        try:
-            return cache[key]
-        except KeyError:
-            pass  # Drop out of the exception handler scope.
-        res = func(*args, **kwargs)
-        cache[key] = res
-        return res
+        return cache.call(func, args, kwargs)
     wrapper._wrapped = func
     return wrapper
 
 
+def _cache_key(args, kwargs):
+    """Build the function cache key for args, falling back to a json
+    encoding when an argument is not hashable"""
+    try:
+        key = (args, frozenset(kwargs.items())) if kwargs else args
+        hash(key)
+    except TypeError:
+        key = json.dumps((args, kwargs), sort_keys=True, default=str)
+    return key
+
+
+def _cache_get(cached_func, *args, **kwargs):
+    """Return the cached result of cached_func(*args, **kwargs) without
+    calling it, or MARKER if nothing has been cached for those arguments"""
+    return cache.get(cached_func._wrapped, _cache_key(args, kwargs))
+
+
 def flush(key):
     """Flushes any entries from function cache where the
     key is found in the function+args """
-    flush_list = []
-    for item in cache:
-        if key in item:
-            flush_list.append(item)
-    for item in flush_list:
-        del cache[item]
+    cache.flush(key)
+
+
+def invalidate(key):
+    """Flushes the entries from function cache that were computed
+    from the argument key (e.g. a unit name or relation id), including
+    results of cached functions derived from them"""
+    cache.invalidate(key)
+
+
+# unitdata.Storage holding the persistent cache, None unless enabled.
+_persistent_cache = None
+PERSISTENT_CACHE_PREFIX = 'hookenv.cache.'
+# Maps the name of each persistent_cached function to its invalidate_on.
+_persistent_invalidate_on = {}
+# The hook whose invalidations have been applied to the persistent cache.
+_persistent_cache_hook = None
+
+
+def enable_persistent_cache(kv=None):
+    """Opt in to keeping the results of functions decorated with
+    persistent_cached in unitdata, so later hooks start with a warm cache.
+
+    Entries are written with the other unitdata changes, so they persist
+    when the storage is flushed (e.g. at the end of a ``hook_scope``).
+    Call it early in each hook, so results invalidated by the current hook
+    are dropped even if the hook never calls the functions concerned.
+
+    :param kv: unitdata.Storage to use, defaults to ``unitdata.kv()``.
+    """
+    global _persistent_cache, _persistent_cache_hook
+    if kv is None:
+        from charmhelpers.core import unitdata
+        kv = unitdata.kv()
+    _persistent_cache = kv
+    _persistent_cache_hook = None
+    _apply_persistent_invalidations(kv)
+
+
+def disable_persistent_cache():
+    """Stop reading and writing the persistent cache"""
+    global _persistent_cache, _persistent_cache_hook
+    _persistent_cache = None
+    _persistent_cache_hook = None
+
+
+def flush_persistent_cache(name=None):
+    """Remove persisted results of the function called name, or of every
+    persistent_cached function if name is None"""
+    if _persistent_cache is not None:
+        prefix = PERSISTENT_CACHE_PREFIX
+        if name:
+            prefix = '{}{}.'.format(prefix, name)
+        _persistent_cache.unsetrange(prefix=prefix)
+
+
+def _apply_persistent_invalidations(db):
+    """Remove persisted results of the functions invalidated by the
+    current hook, once per hook"""
+    global _persistent_cache_hook
+    hook = hook_name()
+    if hook == _persistent_cache_hook:
+        return
+    _persistent_cache_hook = hook
+    for name, invalidate_on in _persistent_invalidate_on.items():
+        if hook in invalidate_on:
+            db.unsetrange(prefix='{}{}.'.format(PERSISTENT_CACHE_PREFIX,
+                                                name))
+
+
+def _persistent_cache_generation(charm_files=()):
+    """Values which invalidate every persisted result when they change,
+    plus the modification time and size of the given charm files"""
+    revision = ''
+    try:
+        with open(os.path.join(charm_dir() or '', 'revision')) as f:
+            revision = f.read().strip()
+    except (IOError, OSError):
+        pass
+    generation = [revision, os.environ.get('JUJU_VERSION', '')]
+    for name in charm_files:
+        try:
+            st = os.stat(os.path.join(charm_dir() or '', name))
+            generation.append([st.st_mtime, st.st_size])
+        except OSError:
+            generation.append(None)
+    return generation
+
+
+def persistent_cached(invalidate_on=(), charm_files=()):
+    """Persist return values across hook executions of func + args
+
+    This is a no-op unless the charm has called enable_persistent_cache().
+    Persisted results are keyed by the charm revision, the Juju version
+    and the modification time and size of charm_files (paths relative to
+    the charm directory). They are dropped at the start of any hook in
+    invalidate_on, even if that hook does not call func.
+    ``None`` results are never persisted. Combine with cached to also
+    avoid the unitdata lookup on repeated calls within a hook::
+
+        @cached
+        @persistent_cached(invalidate_on=('upgrade-charm',),
+                           charm_files=('metadata.yaml',))
+        def metadata():
+            pass
+    """
+    def decorator(func):
+        _persistent_invalidate_on[func.__name__] = tuple(invalidate_on)
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            db = _persistent_cache
+            if db is None:
+                return func(*args, **kwargs)
+            _apply_persistent_invalidations(db)
+            key = '{}{}.{}'.format(
+                PERSISTENT_CACHE_PREFIX, func.__name__,
+                json.dumps((args, kwargs), sort_keys=True, default=str))
+            generation = _persistent_cache_generation(charm_files)
+            entry = db.get(key)
+            if entry and entry.get('generation') == generation:
+                return entry['value']
+            res = func(*args, **kwargs)
+            if res is not None:
+                db.set(key, {'generation': generation, 'value': res})
+            return res
+        return wrapper
+    return decorator
 
 
 def log(message, level=None):
@@ -385,6 +614,13 @@ def config(scope=None):
 @cached
 def relation_get(attribute=None, unit=None, rid=None):
     """Get relation information"""
+    if attribute:
+        # Answer from the unit's full settings if they have already been
+        # fetched, e.g. by prefetch_relations(), rather than forking again.
+        settings = _cache_get(relation_get, unit=unit or remote_unit(),
+                              rid=rid or os.environ.get('JUJU_RELATION_ID'))
+        if settings is not MARKER:
+            return (settings or {}).get(attribute)
     _args = ['relation-get', '--format=json']
     if rid:
         _args.append('-r')
@@ -435,7 +671,7 @@ def relation_set(relation_id=None, relation_settings=None, **kwargs):
                 relation_cmd_line.append('{}={}'.format(key, value))
         subprocess.check_call(relation_cmd_line)
     # Flush cache of any relation-gets for local unit
-    flush(local_unit())
+    invalidate(local_unit())
 
 
 def relation_clear(r_id=None):
@@ -476,7 +712,8 @@ def related_units(relid=None):
 def relation_for_unit(unit=None, rid=None):
     """Get the json represenation of a unit's relation"""
     unit = unit or remote_unit()
-    relation = relation_get(unit=unit, rid=rid)
+    # Copy so the cached relation_get() result is left unmodified.
+    relation = dict(relation_get(unit=unit, rid=rid))
     for key in relation:
         if key.endswith('-list'):
             relation[key] = relation[key].split()
@@ -509,6 +746,8 @@ def relations_of_type(reltype=None):
 
 
 @cached
+@persistent_cached(invalidate_on=('upgrade-charm',),
+                   charm_files=('metadata.yaml',))
 def metadata():
     """Get the current charm metadata.yaml contents as a python object"""
     with open(os.path.join(charm_dir(), 'metadata.yaml')) as md:
@@ -534,6 +773,8 @@ def _metadata_unit(unit):
 
 
 @cached
+@persistent_cached(invalidate_on=('upgrade-charm',),
+                   charm_files=('metadata.yaml',))
 def relation_types():
     """Get a list of relation types supported by this charm"""
     rel_types = []
@@ -616,6 +857,8 @@ def interface_to_relations(interface_name):
 
 
 @cached
+@persistent_cached(invalidate_on=('upgrade-charm',),
+                   charm_files=('metadata.yaml',))
 def charm_name():
     """Get the name of the current charm as is specified on metadata.yaml"""
     return metadata().get('name')
@@ -637,6 +880,31 @@ def relations():
     return rels
 
 
+def prefetch_relations(reltypes=None):
+    """Fetch all relation ids, related units and unit settings up front
+
+    Juju has no bulk hook tool, so this issues one ``relation-ids`` per
+    relation type, one ``relation-list`` per relation id and one
+    ``relation-get`` per unit (including the local unit), fetching each
+    unit's complete settings. The results populate the function cache so
+    that subsequent calls to ``relation_ids``, ``related_units``,
+    ``relation_get`` (with or without an attribute), ``relations`` and
+    ``relations_of_type`` for those relations do not fork any processes.
+
+    :param reltypes: relation name or list of relation names to prefetch,
+                     defaults to every relation type in metadata.yaml.
+    """
+    if reltypes is None:
+        reltypes = relation_types()
+    elif isinstance(reltypes, six.string_types):
+        reltypes = [reltypes]
+    local = local_unit()
+    for reltype in reltypes:
+        for relid in relation_ids(reltype):
+            for unit in [local] + related_units(relid):
+                relation_get(unit=unit, rid=relid)
+
+
 @cached
 def is_relation_made(relation, keys='private-address'):
     '''
@@ -709,7 +977,9 @@ def opened_ports():
     return json.loads(subprocess.check_output(_args).decode('UTF-8'))
 
 
+# Juju runs config-changed when the addresses of a unit change.
 @cached
+@persistent_cached(invalidate_on=('config-changed', 'upgrade-charm'))
 def unit_get(attribute):
     """Get the unit ID for the remote unit"""
     _args = ['unit-get', '--format=json', attribute]
@@ -1045,6 +1315,7 @@ def resource_get(name):
 
 
 @cached
+@persistent_cached()
 def juju_version():
     """Full version string (eg. '1.23.3.1-trusty-amd64')"""
     # Per https://bugs.launchpad.net/juju-core/+bug/1455368/comments/1
@@ -28,12 +28,14 @@ import random
 import string
 import subprocess
 import hashlib
+import time
 import functools
 import itertools
 import six
 
 from contextlib import contextmanager
 from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 from .hookenv import log, DEBUG, local_unit
 from .fstab import Fstab
 from charmhelpers.osplatform import get_platform
@@ -57,6 +59,12 @@ elif __platform__ == "centos":
     )  # flake8: noqa -- ignore F401 for this import
 
 UPDATEDB_PATH = '/etc/updatedb.conf'
+HASH_BUFFER_SIZE = 64 * 1024
+# hashlib releases the GIL while hashing, so files can be hashed in threads.
+HASH_WORKERS = 4
+# Files modified this recently are hashed even if their stat is unchanged.
+SNAPSHOT_RACY_SECONDS = 2
+SNAPSHOTS_KEY = 'charmhelpers.host.path_snapshots'
 
 def service_start(service_name, **kwargs):
     """Start a system service.
@@ -254,6 +262,7 @@ def service(action, service_name, **kwargs):
     :param **kwargs: additional params to be passed to the service command in
                     the form of key=value.
     """
+    _services_running_cache.pop(service_name, None)
     if init_is_systemd():
         cmd = ['systemctl', action, service_name]
     else:
@@ -264,6 +273,26 @@ def service(action, service_name, **kwargs):
     return subprocess.call(cmd) == 0
 
 
+def service_many(action, service_names):
+    """Control several system services at once.
+
+    On systemd a single systemctl command is issued for all services,
+    otherwise the service command is run for each of them in turn.
+
+    :param action: the action to take on the services
+    :param service_names: the names of the services to perform the action on
+    :returns: True if the action succeeded for all services
+    """
+    service_names = list(service_names)
+    if not service_names:
+        return True
+    for name in service_names:
+        _services_running_cache.pop(name, None)
+    if init_is_systemd():
+        return subprocess.call(['systemctl', action] + service_names) == 0
+    return all([service(action, name) for name in service_names])
+
+
 _UPSTART_CONF = "/etc/init/{}.conf"
 _INIT_D_CONF = "/etc/init.d/{}"
 
@@ -305,6 +334,68 @@ def service_running(service_name, **kwargs):
         return False
 
 
+# How long the results of services_running() are reused, in seconds.
+SERVICES_RUNNING_TTL = 5
+_SYSTEMD_ACTIVE_STATES = ('active', 'reloading')
+_services_running_cache = {}
+
+
+def _systemd_services_running(service_names):
+    """Query the ActiveState of service_names with a single systemctl call,
+    returning a list of booleans or None if the output can't be used."""
+    try:
+        output = subprocess.check_output(
+            ['systemctl', 'show', '-p', 'ActiveState', '--'] +
+            service_names).decode('UTF-8')
+    except subprocess.CalledProcessError:
+        return None
+    states = []
+    for block in output.strip().split('\n\n'):
+        properties = dict(line.split('=', 1)
+                          for line in block.splitlines() if '=' in line)
+        states.append(
+            properties.get('ActiveState') in _SYSTEMD_ACTIVE_STATES)
+    if len(states) != len(service_names):
+        return None
+    return states
+
+
+def services_running(service_names, ttl=None):
+    """Determine whether several system services are running.
+
+    On systemd the state of all the services is queried with a single
+    `systemctl show` call, otherwise service_running() is used for each
+    service. Results are reused for `ttl` seconds, and are dropped for a
+    service when it is controlled with service() or service_many().
+
+    :param service_names: the names of the services
+    :param ttl: seconds to reuse results for, defaults to
+                SERVICES_RUNNING_TTL; 0 always queries the services
+    :returns: list of booleans, in the same order as service_names
+    """
+    if ttl is None:
+        ttl = SERVICES_RUNNING_TTL
+    service_names = list(service_names)
+    now = time.time()
+    results = {}
+    for name in service_names:
+        expires, running = _services_running_cache.get(name, (0, None))
+        if ttl and expires > now:
+            results[name] = running
+    missing = [name for name in OrderedDict.fromkeys(service_names)
+               if name not in results]
+    if missing:
+        states = None
+        if init_is_systemd():
+            states = _systemd_services_running(missing)
+        if states is None:
+            states = [service_running(name) for name in missing]
+        for name, running in zip(missing, states):
+            results[name] = running
+            _services_running_cache[name] = (now + ttl, running)
+    return [results[name] for name in service_names]
+
+
 SYSTEMD_SYSTEM = '/run/systemd/system'
 
 
@@ -626,33 +717,126 @@ def fstab_mount(mountpoint):
     return True
 
 
+def _new_hash(hash_type):
+    try:
+        return getattr(hashlib, hash_type)()
+    except AttributeError:
+        return hashlib.new(hash_type)
+
+
+def file_hashes(path, hash_types=('md5',)):
+    """Generate several hash checksums of the contents of 'path' in a single
+    pass over the file, or None if not found.
+
+    The file is read in fixed size chunks, so large files are not loaded
+    into memory.
+
+    :param list hash_types: Hash algorithms supported by :mod:`hashlib`,
+                            such as md5, sha1, sha256, sha512, etc.
+    :return: dict: A { hash_type: hash } dictionary.
+    """
+    if not os.path.exists(path):
+        return None
+    hashers = [(hash_type, _new_hash(hash_type)) for hash_type in hash_types]
+    with open(path, 'rb') as source:
+        for chunk in iter(lambda: source.read(HASH_BUFFER_SIZE), b''):
+            for _, h in hashers:
+                h.update(chunk)
+    return {hash_type: h.hexdigest() for hash_type, h in hashers}
+
+
 def file_hash(path, hash_type='md5'):
     """Generate a hash checksum of the contents of 'path' or None if not found.
 
     :param str hash_type: Any hash alrgorithm supported by :mod:`hashlib`,
                           such as md5, sha1, sha256, sha512, etc.
     """
-    if os.path.exists(path):
-        h = getattr(hashlib, hash_type)()
-        with open(path, 'rb') as source:
-            h.update(source.read())
-        return h.hexdigest()
-    else:
+    hashes = file_hashes(path, (hash_type,))
+    if hashes is None:
         return None
+    return hashes[hash_type]
+
+
+def parallel_map(func, items, workers=1):
+    """Apply func to each of items, using a pool of worker threads when
+    there is more than one item.
+
+    :param int workers: maximum number of items to process at once.
+    :returns: list of the results, in the order of items.
+    """
+    items = list(items)
+    if workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    pool = ThreadPool(min(workers, len(items)))
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
 
 
-def path_hash(path):
+def path_hash(path, workers=HASH_WORKERS):
     """Generate a hash checksum of all files matching 'path'. Standard
     wildcards like '*' and '?' are supported, see documentation for the 'glob'
     module for more information.
 
+    :param int workers: Number of threads used to hash files in parallel.
     :return: dict: A { filename: hash } dictionary for all matched files.
                    Empty if none found.
     """
-    return {
-        filename: file_hash(filename)
-        for filename in glob.iglob(path)
-    }
+    filenames = list(glob.iglob(path))
+    return dict(zip(filenames, parallel_map(file_hash, filenames, workers)))
+
+
+def _snapshot_stat(filename, now):
+    """Return [size, mtime_ns, ctime_ns, inode] for filename, or None if
+    it can't be used to tell whether the file's contents changed."""
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    mtime = getattr(st, 'st_mtime_ns', int(st.st_mtime * 1e9))
+    ctime = getattr(st, 'st_ctime_ns', int(st.st_ctime * 1e9))
+    # A file modified within the filesystem's timestamp granularity of the
+    # snapshot could be modified again without its stat changing.
+    if max(mtime, ctime) >= int((now - SNAPSHOT_RACY_SECONDS) * 1e9):
+        return None
+    return [st.st_size, mtime, ctime, st.st_ino]
+
+
+def path_snapshot(path, previous=None):
+    """Take a snapshot of all files matching 'path' to detect changes.
+
+    Each file is recorded with its size, mtime, ctime and inode along with
+    its md5 digest. Digests are reused from the `previous` snapshot for
+    files whose stat is unchanged, so only new or modified files are read.
+    Snapshots only contain lists and strings, so they can be stored in
+    :mod:`charmhelpers.core.unitdata`.
+
+    :param dict previous: An earlier snapshot of the same path.
+    :return: dict: A { filename: [size, mtime_ns, ctime_ns, inode, md5] }
+                   dictionary for all matched files. Empty if none found.
+    """
+    previous = previous or {}
+    now = time.time()
+    snapshot = {}
+    changed = []
+    for filename in glob.iglob(path):
+        stat = _snapshot_stat(filename, now)
+        old = previous.get(filename)
+        if stat is not None and old and old[:-1] == stat:
+            snapshot[filename] = old
+        else:
+            snapshot[filename] = stat or [None] * 4
+            changed.append(filename)
+    digests = parallel_map(file_hash, changed, HASH_WORKERS)
+    for filename, digest in zip(changed, digests):
+        snapshot[filename] = snapshot[filename] + [digest]
+    return snapshot
+
+
+def _snapshot_digests(snapshot):
+    return {filename: entry[-1] for filename, entry in snapshot.items()}
 
 
 def check_hash(path, checksum, hash_type='md5'):
@@ -670,12 +854,30 @@ def check_hash(path, checksum, hash_type='md5'):
         raise ChecksumError("'%s' != '%s'" % (checksum, actual_checksum))
 
 
+def check_hashes(path, checksums):
+    """Validate a file against several cryptographic checksums, reading the
+    file only once.
+
+    :param dict checksums: A { hash_type: checksum } dictionary, where
+        hash_type is any hash algorithm supported by :mod:`hashlib`.
+    :raises ChecksumError: If the file fails any of the checksums
+
+    """
+    actual_checksums = file_hashes(path, list(checksums)) or {}
+    for hash_type, checksum in checksums.items():
+        actual_checksum = actual_checksums.get(hash_type)
+        if checksum != actual_checksum:
+            raise ChecksumError("'%s' != '%s'" % (checksum, actual_checksum))
+
+
 class ChecksumError(ValueError):
     """A class derived from Value error to indicate the checksum failed."""
     pass
 
 
-def restart_on_change(restart_map, stopstart=False, restart_functions=None):
+def restart_on_change(restart_map, stopstart=False, restart_functions=None,
+                      persist_snapshots=False, restart_workers=None,
+                      restart_graph=None):
     """Restart services based on configuration files changing
 
     This function is used a decorator, for example::
@@ -698,6 +900,12 @@ def restart_on_change(restart_map, stopstart=False, restart_functions=None):
     @param stopstart: DEFAULT false; whether to stop, start OR restart
     @param restart_functions: nonstandard functions to use to restart services
                               {svc: func, ...}
+    @param persist_snapshots: keep file snapshots in unitdata between hooks
+                              so unchanged files are not re-read
+    @param restart_workers: restart independent services concurrently with
+                            this many workers, see restart_services()
+    @param restart_graph: {service: [service it depends on, ...]} used to
+                          order concurrent restarts
     @returns result from decorated function
     """
     def wrap(f):
@@ -705,36 +913,60 @@ def restart_on_change(restart_map, stopstart=False, restart_functions=None):
         def wrapped_f(*args, **kwargs):
             return restart_on_change_helper(
                 (lambda: f(*args, **kwargs)), restart_map, stopstart,
-                restart_functions)
+                restart_functions, persist_snapshots, restart_workers,
+                restart_graph)
         return wrapped_f
     return wrap
 
 
 def restart_on_change_helper(lambda_f, restart_map, stopstart=False,
-                             restart_functions=None):
+                             restart_functions=None, persist_snapshots=False,
+                             restart_workers=None, restart_graph=None):
     """Helper function to perform the restart_on_change function.
 
     This is provided for decorators to restart services if files described
     in the restart_map have changed after an invocation of lambda_f().
 
+    Changes are detected with path_snapshot(), so only files whose stat
+    changed while lambda_f() ran are hashed again.
+
     @param lambda_f: function to call.
     @param restart_map: {file: [service, ...]}
     @param stopstart: whether to stop, start or restart a service
     @param restart_functions: nonstandard functions to use to restart services
                               {svc: func, ...}
+    @param persist_snapshots: keep file snapshots in unitdata between hooks
+                              so unchanged files are not re-read
+    @param restart_workers: restart independent services concurrently with
+                            this many workers, see restart_services()
+    @param restart_graph: {service: [service it depends on, ...]} used to
+                          order concurrent restarts
     @returns result of lambda_f()
     """
     if restart_functions is None:
         restart_functions = {}
-    checksums = {path: path_hash(path) for path in restart_map}
+    stored = {}
+    if persist_snapshots:
+        from charmhelpers.core import unitdata
+        stored = unitdata.kv().get(SNAPSHOTS_KEY, {})
+    snapshots = {path: path_snapshot(path, stored.get(path))
+                 for path in restart_map}
     r = lambda_f()
     # create a list of lists of the services to restart
-    restarts = [restart_map[path]
-                for path in restart_map
-                if path_hash(path) != checksums[path]]
+    restarts = []
+    for path in restart_map:
+        snapshot = path_snapshot(path, snapshots[path])
+        if _snapshot_digests(snapshot) != _snapshot_digests(snapshots[path]):
+            restarts.append(restart_map[path])
+        stored[path] = snapshot
+    if persist_snapshots:
+        unitdata.kv().set(SNAPSHOTS_KEY, stored)
     # create a flat list of ordered services without duplicates from lists
     services_list = list(OrderedDict.fromkeys(itertools.chain(*restarts)))
-    if services_list:
+    if services_list and (restart_workers or restart_graph):
+        restart_services(services_list, stopstart, restart_functions,
+                         restart_workers or 1, restart_graph)
+    elif services_list:
         actions = ('stop', 'start') if stopstart else ('restart',)
         for service_name in services_list:
             if service_name in restart_functions:
@@ -745,6 +977,66 @@ def restart_on_change_helper(lambda_f, restart_map, stopstart=False,
     return r
 
 
+def _restart_levels(service_names, restart_graph):
+    """Group service_names into levels, so that each service is in a later
+    level than the services it depends on in restart_graph. Dependencies
+    on services that are not being restarted are ignored."""
+    remaining = list(service_names)
+    levels = []
+    while remaining:
+        level = [name for name in remaining
+                 if not any(dep in remaining and dep != name
+                            for dep in restart_graph.get(name, ()))]
+        if not level:
+            raise ValueError("Circular dependency in restart graph between "
+                             "%s" % ', '.join(remaining))
+        levels.append(level)
+        remaining = [name for name in remaining if name not in level]
+    return levels
+
+
+def restart_services(service_names, stopstart=False, restart_functions=None,
+                     workers=1, restart_graph=None):
+    """Restart services, restarting independent services concurrently.
+
+    Services are restarted in levels ordered by restart_graph: a service is
+    only restarted once all the services it depends on have been. Within a
+    level, services are restarted with a single batched systemctl command on
+    systemd, or with up to `workers` concurrent service commands otherwise.
+    When stopping and starting, services are stopped in the reverse order.
+
+    @param service_names: [service, ...] to restart
+    @param stopstart: whether to stop, start or restart services
+    @param restart_functions: nonstandard functions to use to restart services
+                              {svc: func, ...}
+    @param workers: number of services or functions to run at once
+    @param restart_graph: {service: [service it depends on, ...]}
+    @raises ValueError: if restart_graph has a circular dependency
+    """
+    restart_functions = restart_functions or {}
+    levels = _restart_levels(service_names, restart_graph or {})
+    if stopstart:
+        phases = ([('stop', level) for level in reversed(levels)] +
+                  [('start', level) for level in levels])
+    else:
+        phases = [('restart', level) for level in levels]
+    systemd = init_is_systemd()
+    for action, level in phases:
+        calls = []
+        standard = []
+        for name in level:
+            if name not in restart_functions:
+                standard.append(name)
+            elif action != 'stop':
+                calls.append(functools.partial(restart_functions[name], name))
+        if systemd and standard:
+            calls.append(functools.partial(service_many, action, standard))
+        else:
+            calls.extend(functools.partial(service, action, name)
+                         for name in standard)
+        parallel_map(lambda call: call(), calls, workers)
+
+
 def pwgen(length=None):
     """Generate a random pasword."""
     if length is None:
@@ -18,6 +18,66 @@ import sys
 from charmhelpers.core import host
 from charmhelpers.core import hookenv
 
+# Directory of the charm in which compiled templates are cached.
+TEMPLATE_CACHE_DIR = '.jinja2-cache'
+
+
+def _jinja2():
+    """Import jinja2, installing it first if needed."""
+    try:
+        import jinja2
+    except ImportError:
+        try:
+            from charmhelpers.fetch import apt_install
+        except ImportError:
+            hookenv.log('Could not import jinja2, and could not import '
+                        'charmhelpers.fetch to install it',
+                        level=hookenv.ERROR)
+            raise
+        if sys.version_info.major == 2:
+            apt_install('python-jinja2', fatal=True)
+        else:
+            apt_install('python3-jinja2', fatal=True)
+        import jinja2
+    return jinja2
+
+
+def bytecode_cache():
+    """
+    Return a jinja2 bytecode cache in the charm directory, or None if there
+    is no charm directory or the cache cannot be created.
+
+    Templates loaded by an Environment using it are compiled once and the
+    compiled code is reused by later hooks. jinja2 looks templates up in
+    the cache by name and path, and recompiles them if their source
+    changed. The cache is kept per jinja2 version.
+    """
+    charm_dir = hookenv.charm_dir()
+    if not charm_dir:
+        return None
+    jinja2 = _jinja2()
+    cache_dir = os.path.join(charm_dir, TEMPLATE_CACHE_DIR, jinja2.__version__)
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, 0o700)
+    except OSError as e:
+        hookenv.log('Not caching compiled templates in {}: {}'.format(
+            cache_dir, e), level=hookenv.WARNING)
+        return None
+    return jinja2.FileSystemBytecodeCache(cache_dir)
+
+
+def get_environment(loader, **kwargs):
+    """
+    Create a jinja2.Environment loading templates with `loader`, which
+    caches compiled templates with bytecode_cache().
+
+    Additional keyword arguments are passed to jinja2.Environment.
+    """
+    jinja2 = _jinja2()
+    kwargs.setdefault('bytecode_cache', bytecode_cache())
+    return jinja2.Environment(loader=loader, **kwargs)
+
 
 def render(source, target, context, owner='root', group='root',
            perms=0o444, templates_dir=None, encoding='UTF-8',
@@ -47,28 +107,14 @@ def render(source, target, context, owner='root', group='root',
     installed, calling this will attempt to use charmhelpers.fetch.apt_install
     to install it.
     """
-    try:
-        from jinja2 import FileSystemLoader, Environment, exceptions
-    except ImportError:
-        try:
-            from charmhelpers.fetch import apt_install
-        except ImportError:
-            hookenv.log('Could not import jinja2, and could not import '
-                        'charmhelpers.fetch to install it',
-                        level=hookenv.ERROR)
-            raise
-        if sys.version_info.major == 2:
-            apt_install('python-jinja2', fatal=True)
-        else:
-            apt_install('python3-jinja2', fatal=True)
-        from jinja2 import FileSystemLoader, Environment, exceptions
+    jinja2 = _jinja2()
 
     if template_loader:
-        template_env = Environment(loader=template_loader)
+        template_env = get_environment(template_loader)
     else:
         if templates_dir is None:
             templates_dir = os.path.join(hookenv.charm_dir(), 'templates')
-        template_env = Environment(loader=FileSystemLoader(templates_dir))
+        template_env = get_environment(jinja2.FileSystemLoader(templates_dir))
 
     # load from a string if provided explicitly
     if config_template is not None:
@@ -77,7 +123,7 @@ def render(source, target, context, owner='root', group='root',
         try:
             source = source
             template = template_env.get_template(source)
-        except exceptions.TemplateNotFound as e:
+        except jinja2.exceptions.TemplateNotFound as e:
             hookenv.log('Could not load template %s from %s.' %
                         (source, templates_dir),
                         level=hookenv.ERROR)
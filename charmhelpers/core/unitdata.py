@@ -146,6 +146,7 @@ associated to the hookname.
 
 """
 
+import bisect
 import collections
 import contextlib
 import datetime
@@ -156,22 +157,44 @@ import pprint
 import sqlite3
 import sys
 
+import six
+
 __author__ = 'Kapil Thangavelu <kapil.foss@gmail.com>'
 
+# Default upper bound on the number of host parameters in a single
+# SQLite statement.
+SQLITE_MAX_VARIABLES = 999
+
+JOURNAL_MODES = ('delete', 'truncate', 'persist', 'memory', 'wal', 'off')
+SYNCHRONOUS_MODES = ('off', 'normal', 'full', 'extra', '0', '1', '2', '3')
+
 
 class Storage(object):
     """Simple key value database for local unit state within charms.
 
     Modifications are not persisted unless :meth:`flush` is called.
 
+    Writes are buffered in memory and applied to the database in bulk
+    when they are flushed, or before a range, history or delete query
+    needs to see them. Values read are kept in an in-process cache, so
+    repeated reads of a key or key prefix do not query the database;
+    this assumes no other process writes to the database while the
+    Storage is open.
+
     To support dicts, lists, integer, floats, and booleans values
     are automatically json encoded/decoded.
 
+    The SQLite journal mode and synchronous setting can be chosen with
+    the journal_mode and synchronous parameters, or the
+    UNIT_STATE_DB_JOURNAL_MODE and UNIT_STATE_DB_SYNCHRONOUS environment
+    variables. In 'wal' mode, synchronous defaults to 'normal', which only
+    syncs at checkpoints rather than on every commit.
+
     Note: to facilitate unit testing, ':memory:' can be passed as the
     path parameter which causes sqlite3 to only build the db in memory.
     This should only be used for testing purposes.
     """
-    def __init__(self, path=None):
+    def __init__(self, path=None, journal_mode=None, synchronous=None):
         self.db_path = path
         if path is None:
             if 'UNIT_STATE_DB' in os.environ:
@@ -182,28 +205,54 @@ class Storage(object):
         if self.db_path != ':memory:':
             with open(self.db_path, 'a') as f:
                 os.fchmod(f.fileno(), 0o600)
+        journal_mode = (journal_mode or
+                        os.environ.get('UNIT_STATE_DB_JOURNAL_MODE'))
+        synchronous = (synchronous or
+                       os.environ.get('UNIT_STATE_DB_SYNCHRONOUS'))
+        if journal_mode and journal_mode.lower() not in JOURNAL_MODES:
+            raise ValueError('Invalid journal mode: %s' % journal_mode)
+        if synchronous and synchronous.lower() not in SYNCHRONOUS_MODES:
+            raise ValueError('Invalid synchronous setting: %s' % synchronous)
+        if not synchronous and journal_mode and journal_mode.lower() == 'wal':
+            synchronous = 'normal'
         self.conn = sqlite3.connect('%s' % self.db_path)
         self.cursor = self.conn.cursor()
+        if journal_mode:
+            self.cursor.execute('pragma journal_mode=%s' % journal_mode)
+        if synchronous:
+            self.cursor.execute('pragma synchronous=%s' % synchronous)
         self.revision = None
         self._closed = False
+        self._pending = {}
+        self._reset_cache()
         self._init()
 
     def close(self):
         if self._closed:
             return
         self.flush(False)
+        self._reset_cache()
         self.cursor.close()
         self.conn.close()
         self._closed = True
 
     def get(self, key, default=None, record=False):
-        self.cursor.execute('select data from kv where key=?', [key])
-        result = self.cursor.fetchone()
-        if not result:
+        if key in self._pending:
+            data = self._pending[key][0]
+        elif key in self._cache:
+            data = self._cache[key]
+        elif self._prefix_cached(key):
+            data = None
+        else:
+            self.cursor.execute('select data from kv where key=?', [key])
+            result = self.cursor.fetchone()
+            data = result[0] if result else None
+            self._cache_put(key, data)
+        if data is None:
             return default
         if record:
-            return Record(json.loads(result[0]))
-        return json.loads(result[0])
+            return Record(self._decode(data))
+        return self._decode(data)
 
     def getrange(self, key_prefix, strip=False):
         """
@@ -215,16 +264,24 @@ class Storage(object):
             names in the returned dict
         :return dict: A (possibly empty) dict of key-value mappings
         """
-        self.cursor.execute("select key, data from kv where key like ?",
-                            ['%s%%' % key_prefix])
-        result = self.cursor.fetchall()
-
-        if not result:
-            return {}
-        if not strip:
-            key_prefix = ''
+        self._write_pending()
+        if not self._prefix_cached(key_prefix):
+            lower, upper = _prefix_range(key_prefix)
+            if upper is None:
+                self.cursor.execute(
+                    'select key, data from kv where key >= ?', [lower])
+            else:
+                self.cursor.execute(
+                    'select key, data from kv where key >= ? and key < ?',
+                    [lower, upper])
+            for k, v in self.cursor.fetchall():
+                self._cache_put(k, v)
+            self._cached_prefixes.add(key_prefix)
+
+        keys = self._cached_keys_with_prefix(key_prefix)
+        strip_len = len(key_prefix) if strip else 0
         return dict([
-            (k[len(key_prefix):], json.loads(v)) for k, v in result])
+            (k[strip_len:], self._decode(self._cache[k])) for k in keys])
 
     def update(self, mapping, prefix=""):
         """
@@ -234,14 +291,16 @@ class Storage(object):
         :param str prefix: Optional prefix to apply to all keys in `mapping`
             before setting
         """
-        for k, v in mapping.items():
-            self.set("%s%s" % (prefix, k), v)
+        self.set_many(dict(
+            ("%s%s" % (prefix, k), v) for k, v in mapping.items()))
 
     def unset(self, key):
         """
         Remove a key from the database entirely.
         """
+        self._write_pending()
         self.cursor.execute('delete from kv where key=?', [key])
+        self._cache_put(key, None)
         if self.revision and self.cursor.rowcount:
             self.cursor.execute(
                 'insert into kv_revisions values (?, ?, ?)',
@@ -256,16 +315,26 @@ class Storage(object):
         :param str prefix: Optional prefix to apply to all keys in ``keys``
             before removing.
         """
+        self._write_pending()
         if keys is not None:
             keys = ['%s%s' % (prefix, key) for key in keys]
             self.cursor.execute('delete from kv where key in (%s)' % ','.join(['?'] * len(keys)), keys)
+            for key in keys:
+                self._cache_put(key, None)
             if self.revision and self.cursor.rowcount:
                 self.cursor.execute(
                     'insert into kv_revisions values %s' % ','.join(['(?, ?, ?)'] * len(keys)),
                     list(itertools.chain.from_iterable((key, self.revision, json.dumps('DELETED')) for key in keys)))
         else:
-            self.cursor.execute('delete from kv where key like ?',
-                                ['%s%%' % prefix])
+            lower, upper = _prefix_range(prefix)
+            if upper is None:
+                self.cursor.execute('delete from kv where key >= ?', [lower])
+            else:
+                self.cursor.execute(
+                    'delete from kv where key >= ? and key < ?',
+                    [lower, upper])
+            for key in self._cached_keys_with_prefix(prefix):
+                self._cache_put(key, None)
             if self.revision and self.cursor.rowcount:
                 self.cursor.execute(
                     'insert into kv_revisions values (?, ?, ?)',
@@ -278,49 +347,86 @@ class Storage(object):
         :param str key: Key to set the value for
         :param value: Any JSON-serializable value to be set
         """
-        serialized = json.dumps(value)
-
-        self.cursor.execute('select data from kv where key=?', [key])
-        exists = self.cursor.fetchone()
-
-        # Skip mutations to the same value
-        if exists:
-            if exists[0] == serialized:
-                return value
-
-        if not exists:
-            self.cursor.execute(
-                'insert into kv (key, data) values (?, ?)',
-                (key, serialized))
-        else:
-            self.cursor.execute('''
-            update kv
-            set data = ?
-            where key = ?''', [serialized, key])
+        self._pending[key] = (json.dumps(value), self.revision)
+        return value
 
-        # Save
-        if not self.revision:
-            return value
+    def set_many(self, mapping):
+        """
+        Set the values of multiple keys at once.
 
-        self.cursor.execute(
-            'select 1 from kv_revisions where key=? and revision=?',
-            [key, self.revision])
-        exists = self.cursor.fetchone()
+        :param dict mapping: Mapping of keys to JSON-serializable values
+        """
+        for key, value in mapping.items():
+            self._pending[key] = (json.dumps(value), self.revision)
 
-        if not exists:
-            self.cursor.execute(
-                '''insert into kv_revisions (
-                revision, key, data) values (?, ?, ?)''',
-                (self.revision, key, serialized))
-        else:
+    def _write_pending(self):
+        """
+        Apply buffered writes to the database with one bulk statement per
+        table, skipping mutations to the same value. Repeated writes of a
+        key within a revision are collapsed into a single revision row.
+        """
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        current = {}
+        for keys in _chunks(list(pending), SQLITE_MAX_VARIABLES):
             self.cursor.execute(
-                '''
-                update kv_revisions
-                set data = ?
-                where key = ?
-                and   revision = ?''',
-                [serialized, key, self.revision])
-
+                'select key, data from kv where key in (%s)' %
+                ','.join(['?'] * len(keys)), keys)
+            current.update(self.cursor.fetchall())
+        changed = [(key, data, revision)
+                   for key, (data, revision) in pending.items()
+                   if current.get(key) != data]
+        self.cursor.executemany(
+            'insert or replace into kv (key, data) values (?, ?)',
+            [(key, data) for key, data, _ in changed])
+        self.cursor.executemany(
+            'insert or replace into kv_revisions (revision, key, data) '
+            'values (?, ?, ?)',
+            [(revision, key, data)
+             for key, data, revision in changed if revision])
+        for key, (data, _) in pending.items():
+            self._cache_put(key, data)
+
+    def _reset_cache(self):
+        # Serialized value of each key read or written, None if absent.
+        self._cache = {}
+        # Decoded scalar values by serialized value.
+        self._decoded = {}
+        # Prefixes for which every existing key is in the cache.
+        self._cached_prefixes = set()
+        self._sorted_keys = None
+
+    def _cache_put(self, key, data):
+        if (self._cache.get(key) is None) != (data is None):
+            self._sorted_keys = None
+        self._cache[key] = data
+
+    def _prefix_cached(self, key_prefix):
+        return any(key_prefix.startswith(p) for p in self._cached_prefixes)
+
+    def _cached_keys_with_prefix(self, prefix):
+        """Return the cached existing keys starting with prefix"""
+        if self._sorted_keys is None:
+            self._sorted_keys = sorted(
+                k for k, v in self._cache.items() if v is not None)
+        lower, upper = _prefix_range(prefix)
+        start = bisect.bisect_left(self._sorted_keys, lower)
+        if upper is None:
+            return self._sorted_keys[start:]
+        end = bisect.bisect_left(self._sorted_keys, upper, start)
+        return self._sorted_keys[start:end]
+
+    def _decode(self, data):
+        """Decode a serialized value, memoizing immutable results. Lists
+        and dicts are decoded afresh so callers may modify them."""
+        try:
+            return self._decoded[data]
+        except KeyError:
+            pass
+        value = json.loads(data)
+        if not isinstance(value, (list, dict)):
+            self._decoded[data] = value
         return value
 
     def delta(self, mapping, prefix):
@@ -374,10 +480,13 @@ class Storage(object):
 
     def flush(self, save=True):
         if save:
+            self._write_pending()
             self.conn.commit()
         elif self._closed:
             return
         else:
+            self._pending.clear()
+            self._reset_cache()
             self.conn.rollback()
 
     def _init(self):
@@ -402,7 +511,52 @@ class Storage(object):
                )''')
         self.conn.commit()
 
+    def compact(self, keep_revisions=None, keep_days=None, vacuum=False):
+        """
+        Remove old history from the database.
+
+        :param int keep_revisions: Keep only this many of the most recent
+            revisions of each key.
+        :param int keep_days: Remove the records of hooks run more than
+            this many days ago, together with the revisions they made.
+        :param bool vacuum: Flush and then rebuild the database file to
+            return the freed space to the filesystem.
+        :return int: The number of revisions removed.
+        """
+        self._write_pending()
+        removed = 0
+        if keep_revisions is not None:
+            if keep_revisions > 0:
+                self.cursor.execute(
+                    '''
+                    delete from kv_revisions
+                    where revision < (
+                        select newer.revision from kv_revisions newer
+                        where newer.key = kv_revisions.key
+                        order by newer.revision desc
+                        limit 1 offset ?)''', [keep_revisions - 1])
+            else:
+                self.cursor.execute('delete from kv_revisions')
+            removed += self.cursor.rowcount
+        if keep_days is not None:
+            cutoff = (datetime.datetime.utcnow() -
+                      datetime.timedelta(days=keep_days)).isoformat()
+            self.cursor.execute(
+                '''
+                delete from kv_revisions
+                where revision in (
+                    select version from hooks where date < ?)''', [cutoff])
+            removed += self.cursor.rowcount
+            self.cursor.execute('delete from hooks where date < ?', [cutoff])
+        if vacuum:
+            self.flush()
+            self.cursor.execute('vacuum')
+            # In wal mode the rebuilt pages are in the log until copied back.
+            self.cursor.execute('pragma wal_checkpoint')
+        return removed
+
     def gethistory(self, key, deserialize=False):
+        self._write_pending()
         self.cursor.execute(
             '''
             select kv.revision, kv.key, kv.data, h.hook, h.date
@@ -416,12 +570,30 @@ class Storage(object):
         return map(_parse_history, self.cursor.fetchall())
 
     def debug(self, fh=sys.stderr):
+        self._write_pending()
         self.cursor.execute('select * from kv')
         pprint.pprint(self.cursor.fetchall(), stream=fh)
         self.cursor.execute('select * from kv_revisions')
         pprint.pprint(self.cursor.fetchall(), stream=fh)
 
 
+def _prefix_range(prefix):
+    """Return the (lower, upper) key bounds of the keys starting with
+    prefix, so ranges use the primary key index. upper is None when the
+    range is unbounded."""
+    upper = prefix
+    while upper and ord(upper[-1]) == sys.maxunicode:
+        upper = upper[:-1]
+    if not upper:
+        return prefix, None
+    return prefix, upper[:-1] + six.unichr(ord(upper[-1]) + 1)
+
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
 def _parse_history(d):
     return (d[0], d[1], json.loads(d[2]), d[3],
             datetime.datetime.strptime(d[-1], "%Y-%m-%dT%H:%M:%S.%f"))
@@ -13,12 +13,15 @@
 # limitations under the License.
 
 import importlib
+import os
+from collections import OrderedDict
 from charmhelpers.osplatform import get_platform
 from yaml import safe_load
 from charmhelpers.core.hookenv import (
     config,
     log,
 )
+from charmhelpers.core.host import parallel_map
 
 import six
 if six.PY3:
@@ -78,6 +81,28 @@ class BaseFetchHandler(object):
         parts[4:] = ['' for i in parts[4:]]
         return urlunparse(parts)
 
+    def restore_from_cache(self, key, dest):
+        """Recreate a missing dest from the tree stored under key in the
+        fetch cache, so only changes since it was stored need fetching.
+        Returns True if dest was restored."""
+        from charmhelpers.fetch.cache import fetch_cache
+        cache = fetch_cache()
+        if cache is None or os.path.exists(dest):
+            return False
+        return cache.extract_tree(key, dest)
+
+    def store_in_cache(self, key, path, version=None):
+        """Store the tree at path under key in the fetch cache, if it is
+        enabled. If version is given and the cache already holds that
+        version of the tree, it is not stored again."""
+        from charmhelpers.fetch.cache import fetch_cache
+        cache = fetch_cache()
+        if cache is None:
+            return
+        if version is not None and cache.tree_version(key) == version:
+            return
+        cache.add_tree(key, path, version)
+
 
 __platform__ = get_platform()
 module = "charmhelpers.fetch.%s" % __platform__
@@ -99,6 +124,7 @@ if __platform__ == "ubuntu":
     apt_mark = fetch.apt_mark
     apt_hold = fetch.apt_hold
     apt_unhold = fetch.apt_unhold
+    apt_transaction = fetch.apt_transaction
     import_key = fetch.import_key
     get_upstream_version = fetch.get_upstream_version
 elif __platform__ == "centos":
@@ -107,7 +133,8 @@ elif __platform__ == "centos":
 
 def configure_sources(update=False,
                       sources_var='install_sources',
-                      keys_var='install_keys'):
+                      keys_var='install_keys',
+                      skip_unchanged=False):
     """Configure multiple sources from charm configuration.
 
     The lists are encoded as yaml fragments in the configuration.
@@ -123,6 +150,10 @@ def configure_sources(update=False,
           - "a1b2c3d4"
 
     Note that 'null' (a.k.a. None) should not be quoted.
+
+    If update is True the package index is updated afterwards. Pass
+    skip_unchanged=True to skip that update when the configured package
+    sources have not changed since the last one, see apt_update().
     """
     sources = safe_load((config(sources_var) or '').strip()) or []
     keys = safe_load((config(keys_var) or '').strip()) or None
@@ -143,7 +174,7 @@ def configure_sources(update=False,
         for source, key in zip(sources, keys):
             add_source(source, key)
     if update:
-        _fetch_update(fatal=True)
+        _fetch_update(fatal=True, skip_unchanged=skip_unchanged)
 
 
 def install_remote(source, *args, **kwargs):
@@ -179,6 +210,52 @@ def install_remote(source, *args, **kwargs):
     raise UnhandledSource("No handler found for source {}".format(source))
 
 
+def install_remote_many(sources, max_workers=4):
+    """Install several file trees from remote sources concurrently.
+
+    Each source is downloaded, validated and extracted by install_remote()
+    on a pool of up to `max_workers` threads. Sources that would be
+    downloaded to the same file name are installed one after the other.
+    The threads share the fetch cache, if it is enabled.
+
+    For example::
+
+        results, errors = install_remote_many([
+            'http://example.com/one.tgz#sha256=...',
+            ('http://example.com/two.tgz', {'checksum': 'deadbeef',
+                                            'hash_type': 'sha1'}),
+        ])
+
+    :param sources: list of sources, each a url or a (url, kwargs) tuple of
+                    the arguments to pass to install_remote().
+    :param int max_workers: maximum number of sources to install at once.
+    :returns: ({url: path}, {url: exception}) for the sources that were
+              installed and for those that failed.
+    """
+    groups = OrderedDict()
+    for item in sources:
+        if isinstance(item, six.string_types):
+            source, kwargs = item, {}
+        else:
+            source, kwargs = item
+        name = os.path.basename(urlparse(source).path.rstrip('/'))
+        groups.setdefault(name, []).append((source, kwargs))
+    results = {}
+    errors = {}
+
+    def install_group(group):
+        for source, kwargs in group:
+            try:
+                results[source] = install_remote(source, **kwargs)
+            except Exception as e:
+                log('Unable to install {}: {}'.format(source, e),
+                    level='WARNING')
+                errors[source] = e
+
+    parallel_map(install_group, list(groups.values()), max_workers)
+    return results, errors
+
+
 def install_from_config(config_var_name):
     """Install a file from config."""
     charm_config = config()
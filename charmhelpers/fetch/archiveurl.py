@@ -14,32 +14,42 @@
 
 import os
 import hashlib
+import json
 import re
 
 from charmhelpers.fetch import (
     BaseFetchHandler,
     UnhandledSource
 )
+from charmhelpers.fetch.cache import (
+    fetch_cache,
+    CACHE_HASH_TYPE,
+)
+from charmhelpers.core.hookenv import log, DEBUG
 from charmhelpers.payload.archive import (
     get_archive_handler,
     extract,
 )
-from charmhelpers.core.host import mkdir, check_hash
+from charmhelpers.core.host import (
+    mkdir,
+    check_hash,
+    ChecksumError,
+)
 
 import six
 if six.PY3:
     from urllib.request import (
         build_opener, install_opener, urlopen, urlretrieve,
-        HTTPPasswordMgrWithDefaultRealm, HTTPBasicAuthHandler,
+        HTTPPasswordMgrWithDefaultRealm, HTTPBasicAuthHandler, Request,
     )
     from urllib.parse import urlparse, urlunparse, parse_qs
-    from urllib.error import URLError
+    from urllib.error import URLError, HTTPError
 else:
     from urllib import urlretrieve
     from urllib2 import (
         build_opener, install_opener, urlopen,
         HTTPPasswordMgrWithDefaultRealm, HTTPBasicAuthHandler,
-        URLError
+        URLError, HTTPError, Request
     )
     from urlparse import urlparse, urlunparse, parse_qs
 
@@ -62,6 +72,14 @@ def splitpasswd(user):
     return user, None
 
 
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# Suffix of the file a download is written to until it is complete.
+PARTIAL_SUFFIX = '.partial'
+# Suffix added to a partial file's name for the file recording its URL and
+# validators.
+PARTIAL_INFO_SUFFIX = '.json'
+
+
 class ArchiveUrlFetchHandler(BaseFetchHandler):
     """
     Handler to download archive files from arbitrary URLs.
@@ -82,12 +100,30 @@ class ArchiveUrlFetchHandler(BaseFetchHandler):
             return True
         return False
 
-    def download(self, source, dest):
+    def download(self, source, dest, hash_types=()):
         """
         Download an archive file.
 
+        The file is streamed in chunks to `dest` + PARTIAL_SUFFIX and renamed
+        to `dest` once complete, so `dest` never holds a partial download.
+        If an http or https download fails, the partial file is kept along
+        with the URL and the ETag or Last-Modified validator of the
+        response. The next download of the same URL to `dest` resumes it
+        with a Range request conditional on the validator (If-Range), so
+        the rest of a file that changed since is not appended to it. A
+        partial file from another URL, or without a validator, is
+        discarded.
+
+        When the fetch cache is enabled, downloaded files are added to it and
+        an http or https file already in the cache is revalidated with a
+        conditional GET, then copied from the cache if it is not modified.
+
         :param str source: URL pointing to an archive file.
         :param str dest: Local path location to download archive file to.
+        :param list hash_types: Hash algorithms supported by :mod:`hashlib`
+            to compute while the file is downloaded.
+        :returns: dict: A { hash_type: hash } dictionary for the downloaded
+            file.
         """
         # propogate all exceptions
         # URLError, OSError, etc
@@ -104,14 +140,117 @@ class ArchiveUrlFetchHandler(BaseFetchHandler):
                 authhandler = HTTPBasicAuthHandler(passman)
                 opener = build_opener(authhandler)
                 install_opener(opener)
-        response = urlopen(source)
+        resumable = proto in ('http', 'https')
+        partial = dest + PARTIAL_SUFFIX
+        cache = fetch_cache()
+        if cache is not None and CACHE_HASH_TYPE not in hash_types:
+            hash_types = list(hash_types) + [CACHE_HASH_TYPE]
+        hashers = [(hash_type, hashlib.new(hash_type))
+                   for hash_type in hash_types]
+        offset = 0
+        validator = None
+        if resumable and os.path.isfile(partial):
+            validator = self._partial_validator(source, partial)
+            if validator:
+                offset = os.path.getsize(partial)
+        request = Request(source)
+        if offset:
+            request.add_header('Range', 'bytes=%d-' % offset)
+            request.add_header('If-Range', validator)
+        elif resumable and cache is not None:
+            for header, value in cache.conditional_headers(source).items():
+                request.add_header(header, value)
+        try:
+            response = urlopen(request)
+        except HTTPError as e:
+            if e.code == 304 and cache is not None:
+                # The file in the fetch cache is still current.
+                cached = cache.lookup_url(source)
+                if cached:
+                    log('{} not modified, using fetch cache'.format(source),
+                        level=DEBUG)
+                    with open(cached, 'rb') as cached_file:
+                        self._hash_chunks(cached_file, hashers)
+                    cache.copy(cached, dest)
+                    return {hash_type: h.hexdigest()
+                            for hash_type, h in hashers}
+            elif not offset or e.code != 416:
+                raise
+            # The partial file can't be resumed, or the cached file was
+            # evicted since it was revalidated, so start over.
+            offset = 0
+            response = urlopen(source)
+        if offset and response.getcode() != 206:
+            # The server ignored the Range header, or the file changed, and
+            # it sent the whole file.
+            offset = 0
         try:
-            with open(dest, 'wb') as dest_file:
-                dest_file.write(response.read())
+            if offset:
+                with open(partial, 'rb') as partial_file:
+                    self._hash_chunks(partial_file, hashers)
+            elif resumable:
+                self._write_partial_info(source, partial, response.info())
+            with open(partial, 'ab' if offset else 'wb') as dest_file:
+                self._hash_chunks(response, hashers, dest_file)
+            os.rename(partial, dest)
         except Exception as e:
-            if os.path.isfile(dest):
-                os.unlink(dest)
+            if not resumable and os.path.isfile(partial):
+                os.unlink(partial)
             raise e
+        if os.path.isfile(partial + PARTIAL_INFO_SUFFIX):
+            os.unlink(partial + PARTIAL_INFO_SUFFIX)
+        digests = {hash_type: h.hexdigest() for hash_type, h in hashers}
+        if cache is not None:
+            info = response.info()
+            cache.add(dest, checksums=digests,
+                      url=source if resumable else None,
+                      etag=info.get('ETag'),
+                      last_modified=info.get('Last-Modified'))
+        return digests
+
+    @staticmethod
+    def _partial_validator(source, partial):
+        """Return the validator to resume partial from source with, or None
+        if it was not downloaded from source or can't be resumed safely."""
+        try:
+            with open(partial + PARTIAL_INFO_SUFFIX) as f:
+                info = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if not isinstance(info, dict) or info.get('url') != source:
+            return None
+        etag = info.get('etag')
+        # Weak ETags can't be used in If-Range.
+        if etag and not etag.startswith('W/'):
+            return etag
+        return info.get('last_modified')
+
+    @staticmethod
+    def _write_partial_info(source, partial, headers):
+        with open(partial + PARTIAL_INFO_SUFFIX, 'w') as f:
+            json.dump({'url': source, 'etag': headers.get('ETag'),
+                       'last_modified': headers.get('Last-Modified')}, f)
+
+    @staticmethod
+    def _hash_chunks(source, hashers, dest_file=None):
+        for chunk in iter(lambda: source.read(DOWNLOAD_CHUNK_SIZE), b''):
+            for _, h in hashers:
+                h.update(chunk)
+            if dest_file is not None:
+                dest_file.write(chunk)
+
+    @staticmethod
+    def _lookup_cache(checksums):
+        """Return the path of the file in the fetch cache matching all of
+        checksums, or None."""
+        cache = fetch_cache()
+        if cache is None or not checksums:
+            return None
+        paths = set(cache.lookup(hash_type, checksum)
+                    for hash_type, checksum in checksums.items())
+        if len(paths) == 1:
+            return paths.pop()
+        return None
 
     # Mandatory file validation via Sha1 or MD5 hashing.
     def download_and_validate(self, url, hashsum, validate="sha1"):
@@ -138,16 +277,7 @@ class ArchiveUrlFetchHandler(BaseFetchHandler):
 
         """
         url_parts = self.parse_url(source)
-        dest_dir = os.path.join(os.environ.get('CHARM_DIR'), 'fetched')
-        if not os.path.exists(dest_dir):
-            mkdir(dest_dir, perms=0o755)
-        dld_file = os.path.join(dest_dir, os.path.basename(url_parts.path))
-        try:
-            self.download(source, dld_file)
-        except URLError as e:
-            raise UnhandledSource(e.reason)
-        except OSError as e:
-            raise UnhandledSource(e.strerror)
+        checksums = {}
         options = parse_qs(url_parts.fragment)
         for key, value in options.items():
             if not six.PY3:
@@ -158,8 +288,36 @@ class ArchiveUrlFetchHandler(BaseFetchHandler):
                 if len(value) != 1:
                     raise TypeError(
                         "Expected 1 hash value, not %d" % len(value))
-                expected = value[0]
-                check_hash(dld_file, expected, key)
+                checksums[key] = value[0]
         if checksum:
-            check_hash(dld_file, checksum, hash_type)
+            expected = checksums.setdefault(hash_type, checksum)
+            if expected != checksum:
+                raise ChecksumError("'%s' != '%s'" % (checksum, expected))
+        dest_dir = os.path.join(os.environ.get('CHARM_DIR'), 'fetched')
+        if not os.path.exists(dest_dir):
+            try:
+                mkdir(dest_dir, perms=0o755)
+            except OSError:
+                # Created by a concurrent install.
+                if not os.path.isdir(dest_dir):
+                    raise
+        dld_file = os.path.join(dest_dir, os.path.basename(url_parts.path))
+        cached = self._lookup_cache(checksums)
+        if cached:
+            log('Using {} from fetch cache'.format(source), level=DEBUG)
+            fetch_cache().copy(cached, dld_file)
+            return extract(dld_file, dest)
+        # Checksums are computed while downloading, so the archive is not
+        # read again to validate it.
+        try:
+            digests = self.download(source, dld_file,
+                                    hash_types=sorted(checksums))
+        except URLError as e:
+            raise UnhandledSource(e.reason)
+        except OSError as e:
+            raise UnhandledSource(e.strerror)
+        for key, expected in checksums.items():
+            actual = digests.get(key)
+            if expected != actual:
+                raise ChecksumError("'%s' != '%s'" % (expected, actual))
         return extract(dld_file, dest)
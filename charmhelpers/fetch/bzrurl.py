@@ -13,7 +13,7 @@
 # limitations under the License.
 
 import os
-from subprocess import check_call
+from subprocess import check_call, check_output, CalledProcessError
 from charmhelpers.fetch import (
     BaseFetchHandler,
     UnhandledSource,
@@ -57,6 +57,13 @@ class BzrUrlFetchHandler(BaseFetchHandler):
             cmd += [source, dest]
         check_call(cmd)
 
+    def revno(self, dest):
+        """Return the revno of the branch at dest, or None if unknown."""
+        try:
+            return check_output(['bzr', 'revno', dest]).decode('UTF-8').strip()
+        except (OSError, CalledProcessError):
+            return None
+
     def install(self, source, dest=None, revno=None):
         url_parts = self.parse_url(source)
         branch_name = url_parts.path.strip("/").split("/")[-1]
@@ -69,8 +76,12 @@ class BzrUrlFetchHandler(BaseFetchHandler):
         if dest and not os.path.exists(dest):
             mkdir(dest, perms=0o755)
 
+        # A tree restored from the fetch cache is updated with a pull.
+        cache_key = 'bzr+{}#{}'.format(source, revno)
         try:
+            self.restore_from_cache(cache_key, dest_dir)
             self.branch(source, dest_dir, revno)
         except OSError as e:
             raise UnhandledSource(e.strerror)
+        self.store_in_cache(cache_key, dest_dir, self.revno(dest_dir))
         return dest_dir
@@ -0,0 +1,342 @@
+# Copyright 2014-2015 Canonical Limited.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A content-addressed cache of fetched artifacts.
+
+The cache is shared by every charm on a machine, so a payload fetched by
+one hook or charm is not downloaded again by the next::
+
+    from charmhelpers.fetch import install_remote
+    from charmhelpers.fetch.cache import enable_fetch_cache
+
+    enable_fetch_cache()
+    install_remote('http://example.com/payload.tgz#sha256=...')
+
+Files are stored under the sha256 digest of their content and can be
+looked up by any checksum recorded for them, or by the URL they were
+downloaded from. URL entries keep the ETag and Last-Modified validators
+of the response, so a download can be revalidated with a conditional GET
+instead of being transferred again. Once the cache grows beyond its size
+limit, the least recently used files are evicted.
+
+The git fetch handler also keeps a bare mirror of each repository it
+clones in the cache's git directory. Mirrors are not counted towards the
+size limit.
+"""
+
+import json
+import os
+import shutil
+import sqlite3
+import tarfile
+import tempfile
+import time
+from contextlib import contextmanager
+
+from charmhelpers.core.hookenv import log, DEBUG
+from charmhelpers.core.host import file_hashes
+from charmhelpers.core.unitdata import _prefix_range
+
+FETCH_CACHE_DIR = '/var/cache/charmhelpers/fetch'
+FETCH_CACHE_MAX_SIZE = 2 * 1024 ** 3
+# Hash algorithm used to address the files in the cache.
+CACHE_HASH_TYPE = 'sha256'
+# Seconds to wait for another process to release the index.
+INDEX_TIMEOUT = 60
+
+_fetch_cache = None
+
+
+def enable_fetch_cache(path=None, max_size=None):
+    """Use a FetchCache for fetch handlers in this process.
+
+    :param str path: Directory of the cache, defaults to FETCH_CACHE_DIR.
+    :param int max_size: Size in bytes above which files are evicted,
+                         defaults to FETCH_CACHE_MAX_SIZE.
+    :returns: the FetchCache in use.
+    """
+    global _fetch_cache
+    _fetch_cache = FetchCache(path, max_size)
+    return _fetch_cache
+
+
+def disable_fetch_cache():
+    """Stop using the fetch cache in this process."""
+    global _fetch_cache
+    _fetch_cache = None
+
+
+def fetch_cache():
+    """Return the FetchCache in use, or None if it is not enabled."""
+    return _fetch_cache
+
+
+class CacheIndex(object):
+    """The key value index of a FetchCache, in an sqlite database.
+
+    Other processes update the index at any time, so nothing is kept in
+    memory: every transaction opens its own connection and reads the
+    current state of the database. This also makes the index safe to use
+    from several threads.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with self.transaction() as txn:
+            txn.conn.execute('create table if not exists kv ('
+                             'key text primary key, data text)')
+
+    @contextmanager
+    def transaction(self):
+        """Yield an IndexTransaction whose changes are committed together.
+
+        The database is locked for writing for the whole transaction, so
+        values read in it are not changed by another process before it
+        is committed.
+        """
+        conn = sqlite3.connect(self.path, timeout=INDEX_TIMEOUT,
+                               isolation_level=None)
+        try:
+            conn.execute('begin immediate')
+            try:
+                yield IndexTransaction(conn)
+            except BaseException:
+                conn.execute('rollback')
+                raise
+            conn.execute('commit')
+        finally:
+            conn.close()
+
+    def get(self, key):
+        with self.transaction() as txn:
+            return txn.get(key)
+
+    def getrange(self, key_prefix, strip=False):
+        with self.transaction() as txn:
+            return txn.getrange(key_prefix, strip)
+
+
+class IndexTransaction(object):
+    """Reads and changes of a CacheIndex within one transaction."""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def get(self, key):
+        row = self.conn.execute('select data from kv where key = ?',
+                                [key]).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def getrange(self, key_prefix, strip=False):
+        lower, upper = _prefix_range(key_prefix)
+        if upper is None:
+            rows = self.conn.execute(
+                'select key, data from kv where key >= ?', [lower])
+        else:
+            rows = self.conn.execute(
+                'select key, data from kv where key >= ? and key < ?',
+                [lower, upper])
+        strip_len = len(key_prefix) if strip else 0
+        return dict((k[strip_len:], json.loads(v)) for k, v in rows)
+
+    def set(self, key, value):
+        self.set_many({key: value})
+
+    def set_many(self, mapping):
+        self.conn.executemany(
+            'insert or replace into kv (key, data) values (?, ?)',
+            [(k, json.dumps(v)) for k, v in mapping.items()])
+
+    def unset(self, key):
+        self.conn.execute('delete from kv where key = ?', [key])
+
+
+class FetchCache(object):
+    """A size-bounded, content-addressed store of fetched files.
+
+    The index is kept in a CacheIndex next to the files, which sqlite
+    keeps consistent between the processes and threads sharing the cache.
+    """
+
+    def __init__(self, path=None, max_size=None):
+        self.path = path or FETCH_CACHE_DIR
+        if max_size is None:
+            max_size = FETCH_CACHE_MAX_SIZE
+        self.max_size = max_size
+        self.objects = os.path.join(self.path, 'objects')
+        if not os.path.isdir(self.objects):
+            os.makedirs(self.objects)
+        self.index = CacheIndex(os.path.join(self.path, 'index.db'))
+
+    def object_path(self, digest):
+        return os.path.join(self.objects, digest[:2], digest)
+
+    def _object(self, txn, digest):
+        """Return the path of the file with digest and mark it as used, or
+        None if it is not in the cache."""
+        if not digest:
+            return None
+        path = self.object_path(digest)
+        entry = txn.get('object.%s' % digest)
+        if entry is None or not os.path.isfile(path):
+            self._remove(txn, [digest])
+            return None
+        entry['used'] = time.time()
+        txn.set('object.%s' % digest, entry)
+        return path
+
+    def lookup(self, hash_type, checksum):
+        """Return the path of the cached file with checksum, or None."""
+        with self.index.transaction() as txn:
+            return self._object(
+                txn, txn.get('checksum.%s.%s' % (hash_type, checksum)))
+
+    def lookup_url(self, url):
+        """Return the path of the file last downloaded from url, or None."""
+        with self.index.transaction() as txn:
+            entry = txn.get('url.%s' % url)
+            return entry and self._object(txn, entry['object'])
+
+    def conditional_headers(self, url):
+        """Return the headers to revalidate the file cached for url with a
+        conditional GET. Empty if there is nothing to revalidate."""
+        with self.index.transaction() as txn:
+            entry = txn.get('url.%s' % url)
+            if not entry or not self._object(txn, entry['object']):
+                return {}
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def add(self, path, checksums=None, url=None, etag=None,
+            last_modified=None):
+        """Store a copy of the file at path in the cache.
+
+        :param dict checksums: { hash_type: checksum } of the file's content
+                               to look it up by. The CACHE_HASH_TYPE digest
+                               is computed if it isn't given.
+        :param str url: URL the file was downloaded from.
+        :param str etag: ETag of the response the file was downloaded with.
+        :param str last_modified: Last-Modified of that response.
+        :returns: the CACHE_HASH_TYPE digest of the file.
+        """
+        checksums = dict(checksums or {})
+        if CACHE_HASH_TYPE not in checksums:
+            checksums.update(file_hashes(path, [CACHE_HASH_TYPE]))
+        digest = checksums[CACHE_HASH_TYPE]
+        target = self.object_path(digest)
+        if not os.path.isfile(target):
+            if not os.path.isdir(os.path.dirname(target)):
+                os.makedirs(os.path.dirname(target))
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(target))
+            os.close(fd)
+            shutil.copyfile(path, tmp)
+            os.chmod(tmp, 0o444)
+            os.rename(tmp, target)
+        with self.index.transaction() as txn:
+            txn.set('object.%s' % digest, {
+                'size': os.path.getsize(target), 'used': time.time()})
+            txn.set_many({'checksum.%s.%s' % item: digest
+                          for item in checksums.items()})
+            if url:
+                txn.set('url.%s' % url, {
+                    'object': digest, 'etag': etag,
+                    'last_modified': last_modified})
+        self.evict()
+        return digest
+
+    def copy(self, path, dest):
+        """Place the cached file at path at dest, hard linking it if
+        possible."""
+        tmp = dest + '.cached'
+        if os.path.lexists(tmp):
+            os.unlink(tmp)
+        try:
+            os.link(path, tmp)
+        except OSError:
+            shutil.copyfile(path, tmp)
+        os.rename(tmp, dest)
+        return dest
+
+    def add_tree(self, key, path, version=None):
+        """Store the directory tree at path under key, see extract_tree().
+
+        :param str version: revision of the tree, see tree_version().
+        """
+        fd, archive = tempfile.mkstemp(dir=self.path, suffix='.tar')
+        os.close(fd)
+        try:
+            with tarfile.open(archive, 'w') as tar:
+                tar.add(path, arcname='.')
+            return self.add(archive, url=key, etag=version)
+        finally:
+            os.unlink(archive)
+
+    def tree_version(self, key):
+        """Return the version the tree stored under key was added with, or
+        None if there is no such tree or it had no version."""
+        with self.index.transaction() as txn:
+            entry = txn.get('url.%s' % key)
+            if entry and self._object(txn, entry['object']):
+                return entry['etag']
+        return None
+
+    def extract_tree(self, key, dest):
+        """Recreate the directory tree stored under key at dest.
+
+        :returns: True if a tree was found and extracted, False otherwise.
+        """
+        archive = self.lookup_url(key)
+        if not archive:
+            return False
+        log('Restoring {} from fetch cache'.format(key), level=DEBUG)
+        with tarfile.open(archive) as tar:
+            tar.extractall(dest)
+        return True
+
+    def evict(self):
+        """Remove least recently used files until the cache fits in
+        max_size."""
+        with self.index.transaction() as txn:
+            objects = txn.getrange('object.', strip=True)
+            total = sum(entry['size'] for entry in objects.values())
+            evicted = []
+            for digest, entry in sorted(objects.items(),
+                                        key=lambda item: item[1]['used']):
+                if total <= self.max_size:
+                    break
+                total -= entry['size']
+                evicted.append(digest)
+            if evicted:
+                log('Evicting {} files from fetch cache'.format(
+                    len(evicted)), level=DEBUG)
+                self._remove(txn, evicted)
+        return evicted
+
+    def _remove(self, txn, digests):
+        digests = set(digests)
+        for digest in digests:
+            txn.unset('object.%s' % digest)
+            path = self.object_path(digest)
+            if os.path.isfile(path):
+                os.unlink(path)
+        for key, digest in txn.getrange('checksum.').items():
+            if digest in digests:
+                txn.unset(key)
+        for key, entry in txn.getrange('url.').items():
+            if entry['object'] in digests:
+                txn.unset(key)
@@ -0,0 +1,115 @@
+# Copyright 2014-2015 Canonical Limited.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Package state read directly from the dpkg status database.
+
+Building an apt_pkg.Cache can take seconds, while whether a package is
+installed, and at which version, only needs the dpkg status file::
+
+    from charmhelpers.fetch.dpkg import dpkg_status
+
+    if not dpkg_status().installed('haproxy'):
+        ...
+"""
+
+import mmap
+import os
+import re
+
+DPKG_STATUS = '/var/lib/dpkg/status'
+# dpkg states of packages that apt considers to have no current version.
+NOT_INSTALLED_STATES = ('not-installed', 'config-files')
+_FIELDS_RE = re.compile(br'^(Status|Architecture|Version):[ \t]*(.*)$', re.M)
+
+_status = None
+
+
+def _stamp(st):
+    return (st.st_ino, st.st_size,
+            getattr(st, 'st_mtime_ns', int(st.st_mtime * 1e9)))
+
+
+class DpkgStatus(object):
+    """A snapshot of the dpkg status database.
+
+    The file is memory mapped and only the paragraphs of the packages that
+    are looked up are parsed.
+    """
+
+    def __init__(self, path=DPKG_STATUS):
+        self.path = path
+        with open(path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            self.stamp = _stamp(st)
+            if st.st_size:
+                self._data = mmap.mmap(f.fileno(), 0,
+                                       access=mmap.ACCESS_READ)
+            else:
+                self._data = b''
+        self._packages = {}
+
+    def _lookup(self, name):
+        """Return {arch: (state, version)} for package name."""
+        if name not in self._packages:
+            data = self._data
+            needle = b'Package: ' + name.encode('utf-8') + b'\n'
+            arches = {}
+            start = data.find(needle)
+            while start != -1:
+                # Skip matches within another field's continuation lines.
+                if start == 0 or data[start - 1:start] == b'\n':
+                    end = data.find(b'\n\n', start)
+                    fields = dict(_FIELDS_RE.findall(
+                        data[start:end if end != -1 else len(data)]))
+                    state = fields.get(b'Status', b'').split()[-1:]
+                    arch = fields.get(b'Architecture', b'').strip()
+                    version = fields.get(b'Version', b'').strip()
+                    arches[arch.decode('utf-8')] = (
+                        (state or [b'not-installed'])[0].decode('utf-8'),
+                        version.decode('utf-8') or None)
+                start = data.find(needle, start + len(needle))
+            self._packages[name] = arches
+        return self._packages[name]
+
+    def installed_version(self, package):
+        """Return the installed version of package, or None if it is not
+        installed.
+
+        :param str package: the package name, optionally qualified with an
+                            architecture, e.g. libc6:i386.
+        """
+        name, _, arch = package.partition(':')
+        for pkg_arch, (state, version) in sorted(self._lookup(name).items()):
+            if arch and pkg_arch not in (arch, 'all'):
+                continue
+            if state not in NOT_INSTALLED_STATES:
+                return version
+        return None
+
+    def installed(self, package):
+        """Return True if package is installed."""
+        return self.installed_version(package) is not None
+
+
+def dpkg_status(path=DPKG_STATUS):
+    """Return a DpkgStatus of path.
+
+    The same snapshot is returned until dpkg modifies the file, which is
+    detected from its inode, size and mtime.
+    """
+    global _status
+    if (_status is None or _status.path != path or
+            _status.stamp != _stamp(os.stat(path))):
+        _status = DpkgStatus(path)
+    return _status
@@ -12,23 +12,36 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
 import os
-from subprocess import check_call, CalledProcessError
+import re
+import shutil
+import tempfile
+from subprocess import check_call, check_output, CalledProcessError
+from charmhelpers.core.hookenv import log, DEBUG
 from charmhelpers.fetch import (
     BaseFetchHandler,
     UnhandledSource,
     filter_installed_packages,
     install,
 )
+from charmhelpers.fetch.cache import fetch_cache
 
 if filter_installed_packages(['git']) != []:
     install(['git'])
     if filter_installed_packages(['git']) != []:
         raise NotImplementedError('Unable to install git')
 
+COMMIT_RE = re.compile(r'^[0-9a-f]{40}$')
+
 
 class GitUrlFetchHandler(BaseFetchHandler):
-    """Handler for git branches via generic and github URLs."""
+    """Handler for git branches via generic and github URLs.
+
+    When the fetch cache is enabled, a bare mirror of each remote is kept
+    in it. Mirrors are updated with git fetch and used as a reference
+    repository for checkouts, so only new objects are downloaded.
+    """
 
     def can_handle(self, source):
         url_parts = self.parse_url(source)
@@ -40,14 +53,83 @@ class GitUrlFetchHandler(BaseFetchHandler):
         else:
             return True
 
+    def mirror(self, source):
+        """Create or update the bare mirror of source in the fetch cache.
+
+        :returns: the path of the mirror, or None if the fetch cache is not
+                  enabled.
+        """
+        cache = fetch_cache()
+        if cache is None:
+            return None
+        mirrors = os.path.join(cache.path, 'git')
+        path = os.path.join(mirrors, hashlib.sha256(
+            source.encode('utf-8')).hexdigest() + '.git')
+        if os.path.isdir(path):
+            check_call(['git', '-C', path, 'fetch', '--prune', 'origin'])
+            return path
+        if not os.path.isdir(mirrors):
+            os.makedirs(mirrors)
+        tmp = tempfile.mkdtemp(dir=mirrors)
+        try:
+            check_call(['git', 'clone', '--mirror', source, tmp])
+            try:
+                os.rename(tmp, path)
+            except OSError:
+                # Another process created the mirror meanwhile.
+                if not os.path.isdir(path):
+                    raise
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+        return path
+
+    def revision(self, source, branch, mirror=None):
+        """Return the commit branch points to in source, or None if it
+        cannot be determined."""
+        if COMMIT_RE.match(branch):
+            return branch
+        try:
+            if mirror:
+                return check_output(
+                    ['git', '-C', mirror, 'rev-parse', '--verify', '--quiet',
+                     '{}^{{commit}}'.format(branch)],
+                    universal_newlines=True).strip() or None
+            refs = check_output(['git', 'ls-remote', source, branch],
+                                universal_newlines=True).split()
+        except CalledProcessError:
+            return None
+        return refs[0] if refs else None
+
+    def checked_out(self, dest):
+        """Return the commit checked out at dest, or None."""
+        try:
+            return check_output(['git', '-C', dest, 'rev-parse', 'HEAD'],
+                                universal_newlines=True).strip()
+        except CalledProcessError:
+            return None
+
     def clone(self, source, dest, branch="master", depth=None):
         if not self.can_handle(source):
             raise UnhandledSource("Cannot handle {}".format(source))
 
+        head = self.checked_out(dest) if os.path.exists(dest) else None
+        # A commit that is already checked out needs no access to source.
+        if head and COMMIT_RE.match(branch) and branch == head:
+            log('{} is already at {}'.format(dest, branch), level=DEBUG)
+            return
+
+        mirror = self.mirror(source)
         if os.path.exists(dest):
-            cmd = ['git', '-C', dest, 'pull', source, branch]
+            revision = self.revision(source, branch, mirror)
+            if revision and revision == head:
+                log('{} is already at {} of {}'.format(dest, branch, source),
+                    level=DEBUG)
+                return
+            cmd = ['git', '-C', dest, 'pull', mirror or source, branch]
         else:
             cmd = ['git', 'clone', source, dest, '--branch', branch]
+            if mirror:
+                cmd.extend(['--reference', mirror, '--dissociate'])
             if depth:
                 cmd.extend(['--depth', depth])
         check_call(cmd)
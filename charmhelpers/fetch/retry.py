@@ -0,0 +1,165 @@
+# Copyright 2014-2015 Canonical Limited.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Retrying package manager commands.
+
+apt, dpkg and snap fail when another process, typically
+unattended-upgrades, holds their lock. run_with_retries() retries such
+commands with jittered exponential backoff and, if it is given the lock
+files the command needs, waits for them to be released instead of
+sleeping blindly::
+
+    result = run_with_retries(['apt-get', 'install', 'haproxy'],
+                              retry_exitcodes=(1, 100),
+                              lock_paths=DPKG_LOCKS)
+    log('waited {:.1f}s for the dpkg lock'.format(result.lock_wait_time))
+"""
+
+import fcntl
+import os
+import random
+import struct
+import subprocess
+import time
+
+from charmhelpers.core.hookenv import log, DEBUG, INFO
+
+DPKG_LOCKS = ('/var/lib/dpkg/lock-frontend', '/var/lib/dpkg/lock')
+# Give up waiting for a lock after this many seconds per command.
+LOCK_WAIT_TIMEOUT = 300
+LOCK_POLL_INTERVAL = 0.1
+LOCK_POLL_MAX_INTERVAL = 2
+
+
+class RetryResult(object):
+    """The outcome of run_with_retries() and where its time went."""
+
+    def __init__(self, cmd):
+        self.cmd = cmd
+        self.returncode = None
+        self.attempts = 0
+        # Seconds spent running the command, waiting for its locks to be
+        # released, and backing off between attempts.
+        self.run_time = 0
+        self.lock_wait_time = 0
+        self.backoff_time = 0
+
+    def __str__(self):
+        return ("'{}' exited {} after {} attempts: {:.1f}s running, "
+                "{:.1f}s waiting for locks, {:.1f}s backing off".format(
+                    " ".join(self.cmd), self.returncode, self.attempts,
+                    self.run_time, self.lock_wait_time, self.backoff_time))
+
+
+def backoff_delay(attempt, base_delay, max_delay):
+    """Return the jittered delay before retry number attempt, counting
+    from 1."""
+    delay = min(max_delay, base_delay * 2 ** (attempt - 1))
+    return random.uniform(delay / 2.0, delay)
+
+
+def lock_held(path):
+    """Return True if another process holds the fcntl lock on path.
+
+    The lock is queried with F_GETLK and never taken, so probing it can't
+    make the process waiting for it fail. Returns False if the lock cannot
+    be probed, e.g. if path does not exist.
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return False
+    try:
+        # struct flock: l_type, l_whence, l_start, l_len, l_pid
+        query = struct.pack('hhqqi', fcntl.F_WRLCK, os.SEEK_SET, 0, 0, 0)
+        result = fcntl.fcntl(fd, fcntl.F_GETLK, query)
+    except (IOError, OSError):
+        return False
+    finally:
+        os.close(fd)
+    return struct.unpack('hhqqi', result)[0] != fcntl.F_UNLCK
+
+
+def wait_for_locks(lock_paths, timeout=LOCK_WAIT_TIMEOUT):
+    """Wait until none of lock_paths is held, for up to timeout seconds.
+
+    :returns: the number of seconds waited.
+    """
+    started = time.time()
+    waited = 0
+    attempt = 0
+    while waited < timeout and any(lock_held(p) for p in lock_paths):
+        attempt += 1
+        time.sleep(min(timeout - waited,
+                       backoff_delay(attempt, LOCK_POLL_INTERVAL,
+                                     LOCK_POLL_MAX_INTERVAL)))
+        waited = time.time() - started
+    return waited
+
+
+def run_with_retries(cmd, max_retries=3, retry_exitcodes=(1,), base_delay=1,
+                     max_delay=10, lock_paths=(),
+                     lock_timeout=LOCK_WAIT_TIMEOUT, retry_message="",
+                     **kwargs):
+    """Run cmd with subprocess.check_call() until it succeeds, fails with
+    an exit code not in retry_exitcodes, or max_retries is reached.
+
+    After a failed attempt, if one of lock_paths is held by another process
+    the next attempt is made as soon as it is released. Otherwise it is
+    made after a jittered delay doubling from base_delay up to max_delay.
+
+    :param list lock_paths: Lock files the command takes, see DPKG_LOCKS.
+    :param int lock_timeout: Seconds to wait for each release of the locks.
+    :param str retry_message: Log prefix emitted during retries.
+    :param kwargs: Passed on to subprocess.check_call().
+    :raises: subprocess.CalledProcessError if the command still fails
+             after max_retries.
+    :returns: RetryResult, which is also logged (at DEBUG if the first
+              attempt succeeded).
+    """
+    result = RetryResult(cmd)
+    if not retry_message:
+        retry_message = "Failed executing '{}'".format(" ".join(cmd))
+
+    while True:
+        result.attempts += 1
+        started = time.time()
+        try:
+            subprocess.check_call(cmd, **kwargs)
+            result.returncode = 0
+        except subprocess.CalledProcessError as e:
+            result.returncode = e.returncode
+            if (e.returncode in retry_exitcodes and
+                    result.attempts > max_retries):
+                result.run_time += time.time() - started
+                log(str(result))
+                raise
+        result.run_time += time.time() - started
+        if result.returncode not in retry_exitcodes:
+            break
+
+        if lock_paths and any(lock_held(p) for p in lock_paths):
+            log("{}. Waiting for its lock to be released".format(
+                retry_message))
+            result.lock_wait_time += wait_for_locks(lock_paths,
+                                                    lock_timeout)
+        else:
+            delay = backoff_delay(result.attempts, base_delay, max_delay)
+            log("{}. Will retry in {:.1f} seconds".format(
+                retry_message, delay))
+            time.sleep(delay)
+            result.backoff_time += delay
+
+    log(str(result), level=DEBUG if result.attempts == 1 else INFO)
+    return result
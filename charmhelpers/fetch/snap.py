@@ -19,16 +19,24 @@ https://lists.ubuntu.com/archives/snapcraft/2016-September/001114.html
 """
 import subprocess
 import os
-from time import sleep
+from collections import OrderedDict
 from charmhelpers.core.hookenv import log
+from charmhelpers.core.host import parallel_map
+from charmhelpers.fetch.retry import run_with_retries
 
 __author__ = 'Joseph Borg <joseph.borg@canonical.com>'
 
 # The return code for "couldn't acquire lock" in Snap
 # (hopefully this will be improved).
 SNAP_NO_LOCK = 1
-SNAP_NO_LOCK_RETRY_DELAY = 10  # Wait X seconds between Snap lock checks.
+SNAP_NO_LOCK_RETRY_DELAY = 10  # Wait up to X seconds between Snap lock checks.
 SNAP_NO_LOCK_RETRY_COUNT = 30  # Retry to acquire the lock X times.
+# snap only accepts these flags for a single snap name.
+SNAP_SINGLE_NAME_FLAGS = (
+    '--channel', '--edge', '--beta', '--candidate', '--stable', '--classic',
+    '--devmode', '--jailmode', '--revision', '--cohort', '--name',
+)
+SNAP_WORKERS = 4  # Run up to X snap commands at once in snap_many().
 SNAP_CHANNELS = [
     'edge',
     'beta',
@@ -45,34 +53,30 @@ class InvalidSnapChannel(Exception):
     pass
 
 
-def _snap_exec(commands):
+def _snap_exec(commands, return_result=False):
     """
     Execute snap commands.
 
     :param commands: List commands
-    :return: Integer exit code
+    :param return_result: Return the RetryResult instead of the exit code
+    :return: Integer exit code, or the RetryResult
     """
     assert type(commands) == list
 
-    retry_count = 0
-    return_code = None
-
-    while return_code is None or return_code == SNAP_NO_LOCK:
-        try:
-            return_code = subprocess.check_call(['snap'] + commands,
-                                                env=os.environ)
-        except subprocess.CalledProcessError as e:
-            retry_count += + 1
-            if retry_count > SNAP_NO_LOCK_RETRY_COUNT:
-                raise CouldNotAcquireLockException(
-                    'Could not aquire lock after {} attempts'
-                    .format(SNAP_NO_LOCK_RETRY_COUNT))
-            return_code = e.returncode
-            log('Snap failed to acquire lock, trying again in {} seconds.'
-                .format(SNAP_NO_LOCK_RETRY_DELAY, level='WARN'))
-            sleep(SNAP_NO_LOCK_RETRY_DELAY)
-
-    return return_code
+    try:
+        result = run_with_retries(
+            ['snap'] + commands, max_retries=SNAP_NO_LOCK_RETRY_COUNT,
+            retry_exitcodes=(SNAP_NO_LOCK,),
+            max_delay=SNAP_NO_LOCK_RETRY_DELAY,
+            retry_message='Snap failed to acquire lock',
+            env=os.environ)
+    except subprocess.CalledProcessError:
+        raise CouldNotAcquireLockException(
+            'Could not aquire lock after {} attempts'
+            .format(SNAP_NO_LOCK_RETRY_COUNT))
+    if return_result:
+        return result
+    return result.returncode
 
 
 def snap_install(packages, *flags):
@@ -138,6 +142,83 @@ def snap_refresh(packages, *flags):
     return _snap_exec(['refresh'] + flags + packages)
 
 
+def snap_list():
+    """
+    List the installed snaps.
+
+    :return: Dictionary of installed snaps of the form:
+        {'snap_name': {'version': '1.0', 'rev': '42', ...}}
+        with the lower cased columns of `snap list` as keys.
+    """
+    output = subprocess.check_output(['snap', 'list']).decode('utf-8',
+                                                              'replace')
+    lines = output.splitlines()
+    if not lines:
+        return {}
+    columns = [column.lower() for column in lines[0].split()]
+    snaps = {}
+    for line in lines[1:]:
+        values = line.split()
+        if values:
+            snaps[values[0]] = dict(zip(columns, values))
+    return snaps
+
+
+def snap_many(action, snaps, workers=SNAP_WORKERS):
+    """
+    Install, remove or refresh several snaps with as few snap commands as
+    possible.
+
+    `snap list` is run once and snaps that are already installed, or not
+    installed for remove and refresh, are skipped. Snaps with the same
+    flags are passed to a single snap command, except those with channel
+    or mode flags which snap only accepts for one snap at a time. Up to
+    `workers` of the commands are run at once.
+
+    :param action: String 'install', 'remove' or 'refresh'
+    :param snaps: Dictionary of snap names and the List of String flags to
+        pass to snap for them
+    :param workers: Integer maximum number of snap commands to run at once
+    :return: Tuple of dictionaries ({name: changed}, {name: exception}) for
+        the snaps that succeeded, changed being False for skipped ones, and
+        those that failed.
+    """
+    installed = snap_list()
+    results = {}
+    errors = {}
+    groups = OrderedDict()
+    for name, flags in snaps.items():
+        if (name in installed) == (action == 'install'):
+            log('Snap "{}" is {}installed, skipping {}'.format(
+                name, '' if action == 'install' else 'not ', action),
+                level='DEBUG')
+            results[name] = False
+            continue
+        flags = tuple(flags)
+        single = any(flag.split('=')[0] in SNAP_SINGLE_NAME_FLAGS
+                     for flag in flags)
+        groups.setdefault((flags, name if single else None), []).append(name)
+
+    def run(group):
+        (flags, _), names = group
+        log('Running snap {} for "{}" with option(s) "{}"'.format(
+            action, ', '.join(names), ', '.join(flags)), level='INFO')
+        try:
+            return_code = _snap_exec([action] + list(flags) + names)
+            if return_code:
+                raise subprocess.CalledProcessError(
+                    return_code, ['snap', action] + list(flags) + names)
+        except Exception as e:
+            log('Snap {} failed for "{}": {}'.format(
+                action, ', '.join(names), e), level='WARNING')
+            errors.update((name, e) for name in names)
+        else:
+            results.update((name, True) for name in names)
+
+    parallel_map(run, list(groups.items()), workers)
+    return results, errors
+
+
 def valid_snap_channel(channel):
     """ Validate snap channel exists
 
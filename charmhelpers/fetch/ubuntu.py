@@ -13,16 +13,19 @@
 # limitations under the License.
 
 from collections import OrderedDict
+from contextlib import contextmanager
+import json
 import os
 import platform
 import re
 import six
 import time
 import subprocess
-from tempfile import NamedTemporaryFile
+from tempfile import NamedTemporaryFile, mkstemp
 
 from charmhelpers.core.host import (
-    lsb_release
+    file_hash,
+    lsb_release,
 )
 from charmhelpers.core.hookenv import (
     log,
@@ -30,6 +33,8 @@ from charmhelpers.core.hookenv import (
     WARNING,
 )
 from charmhelpers.fetch import SourceConfigError, GPGKeyError
+from charmhelpers.fetch.dpkg import dpkg_status
+from charmhelpers.fetch.retry import DPKG_LOCKS, run_with_retries
 
 PROPOSED_POCKET = (
     "# Proposed\n"
@@ -162,22 +167,40 @@ CLOUD_ARCHIVE_POCKETS = {
 
 
 APT_NO_LOCK = 100  # The return code for "couldn't acquire lock" in APT.
-CMD_RETRY_DELAY = 10  # Wait 10 seconds between command retries.
+CMD_RETRY_BASE_DELAY = 1  # Wait 1, 2, 4... seconds between command retries,
+CMD_RETRY_DELAY = 10  # up to 10 seconds.
 CMD_RETRY_COUNT = 3  # Retry a failing fatal command X times.
 
+# The AptTransaction queueing apt operations, see apt_transaction().
+_transaction = None
+
+# Files and directories whose content apt-get update depends on.
+APT_SOURCE_LIST = '/etc/apt/sources.list'
+APT_SOURCE_PARTS = '/etc/apt/sources.list.d'
+APT_KEYRINGS = ('/etc/apt/trusted.gpg', '/etc/apt/trusted.gpg.d')
+# Extensions of the files apt reads from the directories above.
+APT_SOURCE_EXTENSIONS = ('.list', '.sources', '.gpg', '.asc')
+# Run a full apt-get update at least this often, in seconds, so that
+# packages published since the last update are seen.
+APT_UPDATE_MAX_AGE = 24 * 60 * 60
+# Records the apt sources as of the last apt_update(skip_unchanged=True).
+APT_SOURCES_STATE = '/var/cache/charmhelpers/apt-sources.json'
+
 
 def filter_installed_packages(packages):
     """Return a list of packages that require installation."""
-    cache = apt_cache()
-    _pkgs = []
-    for package in packages:
-        try:
-            p = cache[package]
-            p.current_ver or _pkgs.append(package)
-        except KeyError:
-            log('Package {} has no installation candidate.'.format(package),
-                level='WARNING')
-            _pkgs.append(package)
+    status = dpkg_status()
+    _pkgs = [package for package in packages
+             if not status.installed(package)]
+    if _pkgs:
+        # Only apt knows whether missing packages can be installed.
+        cache = apt_cache()
+        for package in _pkgs:
+            try:
+                cache[package]
+            except KeyError:
+                log('Package {} has no installation candidate.'.format(
+                    package), level='WARNING')
     return _pkgs
 
 
@@ -196,6 +219,10 @@ def apt_install(packages, options=None, fatal=False):
     if options is None:
         options = ['--option=Dpkg::Options::=--force-confold']
 
+    if _transaction is not None:
+        _transaction.install(packages, options, fatal)
+        return
+
     cmd = ['apt-get', '--assume-yes']
     cmd.extend(options)
     cmd.append('install')
@@ -223,14 +250,96 @@ def apt_upgrade(options=None, fatal=False, dist=False):
     _run_apt_command(cmd, fatal)
 
 
-def apt_update(fatal=False):
-    """Update local apt cache."""
-    cmd = ['apt-get', 'update']
-    _run_apt_command(cmd, fatal)
+def _apt_sources_fingerprint():
+    """Return { path: sha256 } of the apt source lists and keyrings."""
+    fingerprint = {}
+    for path in (APT_SOURCE_LIST, APT_SOURCE_PARTS) + APT_KEYRINGS:
+        if os.path.isdir(path):
+            paths = [os.path.join(path, name) for name in os.listdir(path)
+                     if name.endswith(APT_SOURCE_EXTENSIONS)]
+        else:
+            paths = [path]
+        for path in paths:
+            if os.path.isfile(path):
+                fingerprint[path] = file_hash(path, 'sha256')
+    return fingerprint
+
+
+def _read_apt_sources_state():
+    try:
+        with open(APT_SOURCES_STATE) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def _write_apt_sources_state(state):
+    """Atomically replace APT_SOURCES_STATE with state. A failure is only
+    logged, as it just means that the next update is not skipped."""
+    state_dir = os.path.dirname(APT_SOURCES_STATE)
+    try:
+        if not os.path.isdir(state_dir):
+            os.makedirs(state_dir)
+        fd, tmp = mkstemp(dir=state_dir)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(state, f)
+        os.rename(tmp, APT_SOURCES_STATE)
+    except (IOError, OSError) as e:
+        log("Unable to record apt sources: {}".format(e), level=WARNING)
+
+
+def apt_update(fatal=False, skip_unchanged=False):
+    """Update local apt cache.
+
+    :param bool skip_unchanged: Skip the update if the apt source lists and
+        keyrings are unchanged since the last successful update made with
+        skip_unchanged, unless that update is older than APT_UPDATE_MAX_AGE.
+        If the only changes are files added to or modified in
+        APT_SOURCE_PARTS, just those sources are updated.
+
+        Note that packages published in the archives since the last full
+        update are not seen until the next one, up to APT_UPDATE_MAX_AGE
+        later. Only skip updates when the packages to install are already
+        known to apt, or come from sources that were just added.
+    """
+    cmds = [['apt-get', 'update']]
+    if skip_unchanged:
+        fingerprint = _apt_sources_fingerprint()
+        last = _read_apt_sources_state()
+        updated = time.time()
+        if last and updated - last['updated'] < APT_UPDATE_MAX_AGE:
+            changed = [path for path, digest in sorted(fingerprint.items())
+                       if last['sources'].get(path) != digest]
+            removed = set(last['sources']) - set(fingerprint)
+            if not changed and not removed:
+                log("apt sources unchanged, skipping apt-get update",
+                    level=DEBUG)
+                return
+            if not removed and all(
+                    os.path.dirname(path) == APT_SOURCE_PARTS
+                    for path in changed):
+                log("Updating changed apt sources {}".format(changed),
+                    level=DEBUG)
+                cmds = [['apt-get', 'update',
+                         '-o', 'Dir::Etc::sourcelist={}'.format(path),
+                         '-o', 'Dir::Etc::sourceparts=-',
+                         '-o', 'APT::Get::List-Cleanup=0']
+                        for path in changed]
+                # The other sources were not updated.
+                updated = last['updated']
+
+    succeeded = all([_run_apt_command(cmd, fatal) == 0 for cmd in cmds])
+    if succeeded and skip_unchanged:
+        _write_apt_sources_state({'sources': fingerprint,
+                                  'updated': updated})
 
 
 def apt_purge(packages, fatal=False):
     """Purge one or more packages."""
+    if _transaction is not None:
+        _transaction.purge(packages, fatal)
+        return
+
     cmd = ['apt-get', '--assume-yes', 'purge']
     if isinstance(packages, six.string_types):
         cmd.append(packages)
@@ -242,6 +351,10 @@ def apt_purge(packages, fatal=False):
 
 def apt_mark(packages, mark, fatal=False):
     """Flag one or more packages using apt-mark."""
+    if _transaction is not None:
+        _transaction.mark(packages, mark, fatal)
+        return
+
     log("Marking {} as {}".format(packages, mark))
     cmd = ['apt-mark', mark]
     if isinstance(packages, six.string_types):
@@ -263,6 +376,132 @@ def apt_unhold(packages, fatal=False):
     return apt_mark(packages, 'unhold', fatal=fatal)
 
 
+class AptTransaction(object):
+    """apt operations queued by an apt_transaction()."""
+
+    def __init__(self):
+        # package -> (options, fatal), options being None for a purge.
+        self.packages = OrderedDict()
+        # package -> (mark, fatal)
+        self.marks = OrderedDict()
+
+    @staticmethod
+    def _names(packages):
+        if isinstance(packages, six.string_types):
+            return [packages]
+        return list(packages)
+
+    def install(self, packages, options, fatal):
+        for package in self._names(packages):
+            # A later operation on a package supersedes an earlier one.
+            self.packages.pop(package, None)
+            self.packages[package] = (tuple(options), fatal)
+
+    def purge(self, packages, fatal):
+        for package in self._names(packages):
+            self.packages.pop(package, None)
+            self.packages[package] = (None, fatal)
+
+    def mark(self, packages, mark, fatal):
+        for package in self._names(packages):
+            self.marks.pop(package, None)
+            self.marks[package] = (mark, fatal)
+
+    def _mark_commands(self, marks):
+        """Return (mark, packages, fatal) for each apt-mark to run."""
+        commands = OrderedDict()
+        for package, (mark, fatal) in self.marks.items():
+            if mark in marks:
+                commands.setdefault((mark, fatal), []).append(package)
+        return [(mark, packages, fatal)
+                for (mark, fatal), packages in commands.items()]
+
+    def commands(self):
+        """Return the commands to run as (cmd, fatal) tuples.
+
+        Held packages are released first so they can be installed or
+        purged. Installs sharing options and fatality are run as one
+        apt-get, the last of which also purges the packages queued for
+        purging with the same fatality, and the remaining marks are
+        applied last.
+        """
+        installs = OrderedDict()
+        purges = OrderedDict()
+        for package, (options, fatal) in self.packages.items():
+            if options is None:
+                purges.setdefault(fatal, []).append(package)
+            else:
+                installs.setdefault((options, fatal), []).append(package)
+
+        # Fold each set of purges into the last install sharing its fatality.
+        folded = {}
+        for i, (options, fatal) in enumerate(installs):
+            if fatal in purges:
+                folded[fatal] = i
+
+        marks = set(mark for mark, _ in self.marks.values())
+        commands = [(['apt-mark', mark] + packages, fatal)
+                    for mark, packages, fatal
+                    in self._mark_commands(['unhold'])]
+        for i, ((options, fatal), packages) in enumerate(installs.items()):
+            cmd = ['apt-get', '--assume-yes'] + list(options)
+            if folded.get(fatal) == i:
+                # apt-get removes packages suffixed with - while installing.
+                cmd.append('--purge')
+                packages = packages + ['{}-'.format(p) for p in purges[fatal]]
+            commands.append((cmd + ['install'] + packages, fatal))
+        for fatal, packages in purges.items():
+            if fatal not in folded:
+                commands.append(
+                    (['apt-get', '--assume-yes', 'purge'] + packages, fatal))
+        commands.extend((['apt-mark', mark] + packages, fatal)
+                        for mark, packages, fatal
+                        in self._mark_commands(marks - set(['unhold'])))
+        return commands
+
+    def commit(self):
+        """Run the queued operations."""
+        for cmd, fatal in self.commands():
+            log("Running {}".format(" ".join(cmd)))
+            if cmd[0] == 'apt-mark':
+                if fatal:
+                    subprocess.check_call(cmd, universal_newlines=True)
+                else:
+                    subprocess.call(cmd, universal_newlines=True)
+            else:
+                _run_apt_command(cmd, fatal)
+
+
+@contextmanager
+def apt_transaction():
+    """Queue the apt_install(), apt_purge() and apt_mark() calls made in
+    the block, and run them with as few apt-get and apt-mark commands as
+    possible when it exits::
+
+        with apt_transaction():
+            apt_install(['haproxy'], fatal=True)
+            apt_purge(['apache2'])
+            apt_hold(['haproxy'])
+
+    Nothing is run if the block raises an exception. Nested transactions
+    are part of the outermost one. Note that filter_installed_packages()
+    does not know about queued operations.
+    """
+    global _transaction
+    if _transaction is not None:
+        yield _transaction
+        return
+    transaction = _transaction = AptTransaction()
+    try:
+        yield transaction
+    except Exception:
+        log("Discarding queued apt operations", level=WARNING)
+        raise
+    finally:
+        _transaction = None
+    transaction.commit()
+
+
 def import_key(key):
     """Import an ASCII Armor key.
 
@@ -503,7 +742,8 @@ def _verify_is_ubuntu_rel(release, os_release):
 
 
 def _run_with_retries(cmd, max_retries=CMD_RETRY_COUNT, retry_exitcodes=(1,),
-                      retry_message="", cmd_env=None):
+                      retry_message="", cmd_env=None, lock_paths=(),
+                      return_result=False):
     """Run a command and retry until success or max_retries is reached.
 
     :param: cmd: str: The apt command to run.
@@ -513,34 +753,24 @@ def _run_with_retries(cmd, max_retries=CMD_RETRY_COUNT, retry_exitcodes=(1,),
         Defaults to retry on exit code 1.
     :param: retry_message: str: Optional log prefix emitted during retries.
     :param: cmd_env: dict: Environment variables to add to the command run.
+    :param: lock_paths: tuple: Lock files to wait for between retries.
+    :param: return_result: bool: Return the RetryResult, with the attempts
+        made and the time spent running, waiting for locks and backing off.
+    :returns: int: the exit code of the command, or the RetryResult.
     """
-
-    env = None
     kwargs = {}
     if cmd_env:
         env = os.environ.copy()
         env.update(cmd_env)
         kwargs['env'] = env
 
-    if not retry_message:
-        retry_message = "Failed executing '{}'".format(" ".join(cmd))
-    retry_message += ". Will retry in {} seconds".format(CMD_RETRY_DELAY)
-
-    retry_count = 0
-    result = None
-
-    retry_results = (None,) + retry_exitcodes
-    while result in retry_results:
-        try:
-            # result = subprocess.check_call(cmd, env=env)
-            result = subprocess.check_call(cmd, **kwargs)
-        except subprocess.CalledProcessError as e:
-            retry_count = retry_count + 1
-            if retry_count > max_retries:
-                raise
-            result = e.returncode
-            log(retry_message)
-            time.sleep(CMD_RETRY_DELAY)
+    result = run_with_retries(
+        cmd, max_retries=max_retries, retry_exitcodes=retry_exitcodes,
+        base_delay=CMD_RETRY_BASE_DELAY, max_delay=CMD_RETRY_DELAY,
+        lock_paths=lock_paths, retry_message=retry_message, **kwargs)
+    if return_result:
+        return result
+    return result.returncode
 
 
 def _run_apt_command(cmd, fatal=False):
@@ -549,19 +779,21 @@ def _run_apt_command(cmd, fatal=False):
     :param: cmd: str: The apt command to run.
     :param: fatal: bool: Whether the command's output should be checked and
         retried.
+    :returns: int: the exit code of the command.
     """
     # Provide DEBIAN_FRONTEND=noninteractive if not present in the environment.
     cmd_env = {
         'DEBIAN_FRONTEND': os.environ.get('DEBIAN_FRONTEND', 'noninteractive')}
 
     if fatal:
-        _run_with_retries(
+        return _run_with_retries(
             cmd, cmd_env=cmd_env, retry_exitcodes=(1, APT_NO_LOCK,),
-            retry_message="Couldn't acquire DPKG lock")
+            retry_message="Couldn't acquire DPKG lock",
+            lock_paths=DPKG_LOCKS)
     else:
         env = os.environ.copy()
         env.update(cmd_env)
-        subprocess.call(cmd, env=env)
+        return subprocess.call(cmd, env=env)
 
 
 def get_upstream_version(package):
@@ -570,15 +802,8 @@ def get_upstream_version(package):
     @returns None (if not installed) or the upstream version
     """
     import apt_pkg
-    cache = apt_cache()
-    try:
-        pkg = cache[package]
-    except Exception:
-        # the package is unknown to the current apt cache.
-        return None
-
-    if not pkg.current_ver:
-        # package is known, but no version is currently installed.
+    version = dpkg_status().installed_version(package)
+    if not version:
         return None
 
-    return apt_pkg.upstream_version(pkg.current_ver.ver_str)
+    return apt_pkg.upstream_version(version)
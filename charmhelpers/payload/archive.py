@@ -12,14 +12,30 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import fcntl
+import hashlib
+import json
 import os
+import stat
 import tarfile
+import tempfile
+import threading
 import zipfile
+from contextlib import contextmanager
 from charmhelpers.core import (
     host,
     hookenv,
 )
 
+# Written to the destination of extract() to record what was extracted.
+MANIFEST_FILE = '.archive-manifest.json'
+# Locked while the manifest is updated, which replaces MANIFEST_FILE.
+MANIFEST_LOCK_FILE = '.archive-manifest.lock'
+CHUNK_SIZE = 64 * 1024
+
+# fcntl locks don't exclude the other threads of this process.
+_manifest_thread_lock = threading.Lock()
+
 
 class ArchiveError(Exception):
     pass
@@ -46,26 +62,244 @@ def archive_dest_default(archive_name):
     return os.path.join(hookenv.charm_dir(), "archives", archive_file)
 
 
+def _manifest_key(archive_name):
+    return os.path.basename(archive_name)
+
+
+def read_manifests(destpath):
+    """Return the manifests extract() recorded in destpath, keyed by the
+    name of the archive they were recorded for."""
+    try:
+        with open(os.path.join(destpath, MANIFEST_FILE)) as f:
+            manifests = json.load(f)
+    except (IOError, ValueError):
+        return {}
+    return manifests if isinstance(manifests, dict) else {}
+
+
+def _members(manifest):
+    """Return the members recorded in manifest, or {} if it is malformed."""
+    if not isinstance(manifest, dict):
+        return {}
+    members = manifest.get('members') or {}
+    return members if isinstance(members, dict) else {}
+
+
+def read_manifest(destpath, archive_name):
+    """Return the manifest extract() recorded in destpath for archive_name,
+    or {} if none or if it is malformed."""
+    manifest = read_manifests(destpath).get(_manifest_key(archive_name))
+    if not isinstance(manifest, dict) or not isinstance(
+            manifest.get('members'), dict):
+        return {}
+    return manifest
+
+
+@contextmanager
+def _manifest_lock(destpath):
+    """Serialize updates of the manifest in destpath between threads and
+    processes."""
+    with _manifest_thread_lock:
+        with open(os.path.join(destpath, MANIFEST_LOCK_FILE), 'a') as f:
+            fcntl.lockf(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.lockf(f, fcntl.LOCK_UN)
+
+
+def _update_manifest(destpath, archive_name, manifest, recorded=None):
+    """Record manifest for archive_name in destpath, keeping the manifests
+    of the other archives extracted there.
+
+    The files of recorded, the members of the previous manifest, which are
+    no longer in manifest are removed, unless another archive recorded
+    them too.
+    """
+    key = _manifest_key(archive_name)
+    with _manifest_lock(destpath):
+        manifests = read_manifests(destpath)
+        if recorded:
+            others = set()
+            for name, other in manifests.items():
+                if name != key:
+                    others.update(_members(other))
+            for name in set(recorded) - set(manifest['members']) - others:
+                path = os.path.join(destpath, name)
+                if os.path.isfile(path):
+                    os.unlink(path)
+        manifests[key] = manifest
+        fd, tmp = tempfile.mkstemp(dir=destpath, prefix=MANIFEST_FILE)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(manifests, f, sort_keys=True)
+        os.rename(tmp, os.path.join(destpath, MANIFEST_FILE))
+
+
+def write_manifest(destpath, archive_name, manifest):
+    """Record manifest for archive_name in destpath, keeping the manifests
+    of the other archives extracted there."""
+    _update_manifest(destpath, archive_name, manifest)
+
+
+def _mtime(st):
+    return getattr(st, 'st_mtime_ns', int(st.st_mtime * 1e9))
+
+
+def _unchanged(destpath, name, entry, recorded):
+    """Whether member name, of size and digest entry[:2], was recorded with
+    the same content and is still in destpath with the recorded size and
+    modification time.
+
+    Local changes to a file are only noticed if they change its size or
+    modification time.
+    """
+    if (not isinstance(recorded, list) or len(recorded) != 3 or
+            recorded[:2] != list(entry[:2])):
+        return False
+    try:
+        st = os.stat(os.path.join(destpath, name))
+    except OSError:
+        return False
+    return (stat.S_ISREG(st.st_mode) and st.st_size == entry[0] and
+            _mtime(st) == recorded[2])
+
+
+def _entry(destpath, name, size, digest):
+    """Return the manifest entry of member name, extracted to destpath."""
+    try:
+        mtime = _mtime(os.stat(os.path.join(destpath, name)))
+    except OSError:
+        # e.g. a zip member whose name was sanitized when extracted.
+        mtime = None
+    return [size, digest, mtime]
+
+
 def extract(archive_name, destpath=None):
+    """Unpack an archive, by default to $CHARM_DIR/archives/<archive name>.
+
+    The digest of the archive and the size, digest and modification time of
+    each file in it are recorded in a manifest in destpath, under the
+    archive's file name. Extracting the same archive again does nothing
+    while its files are in place and unmodified. Extracting a new version
+    of an archive with the same file name
+    only replaces the files that changed, and removes the files that the
+    previous version had but the new one does not. Files of the other
+    archives extracted to destpath are left alone.
+    """
     handler = get_archive_handler(archive_name)
     if handler:
         if not destpath:
             destpath = archive_dest_default(archive_name)
         if not os.path.isdir(destpath):
             host.mkdir(destpath)
-        handler(archive_name, destpath)
+        digest = host.file_hash(archive_name, 'sha256')
+        manifest = read_manifest(destpath, archive_name)
+        members = manifest.get('members') or {}
+        if digest and manifest.get('archive') == digest and all(
+                _unchanged(destpath, name, entry, entry)
+                for name, entry in members.items()):
+            hookenv.log('{} is already extracted to {}'.format(
+                archive_name, destpath), level=hookenv.DEBUG)
+            return destpath
+        new_members = handler(archive_name, destpath, members)
+        if digest:
+            _update_manifest(destpath, archive_name,
+                             {'archive': digest, 'members': new_members},
+                             members)
         return destpath
     else:
         raise ArchiveError("No handler for archive")
 
 
-def extract_tarfile(archive_name, destpath):
-    "Unpack a tar archive, optionally compressed"
-    archive = tarfile.open(archive_name)
-    archive.extractall(destpath)
+def _set_tar_attrs(archive, member, path):
+    if os.geteuid() == 0:
+        try:
+            archive.chown(member, path, False)
+        except TypeError:
+            # Python < 3.5 has no numeric_owner argument.
+            archive.chown(member, path)
+    archive.chmod(member, path)
+    archive.utime(member, path)
+
+
+def _extract_tar_member(archive, member, destpath, recorded):
+    """Extract a regular file member unless it is unchanged since it was
+    recorded, returning its [size, sha256, mtime]."""
+    target = os.path.join(destpath, member.name)
+    parent = os.path.dirname(target)
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    # The member is written to a temporary file while it is hashed, as the
+    # archive is read as a stream and can't be read again.
+    fd, tmp = tempfile.mkstemp(dir=parent,
+                               prefix='.' + os.path.basename(target))
+    h = hashlib.sha256()
+    source = archive.extractfile(member)
+    with os.fdopen(fd, 'wb') as f:
+        for chunk in iter(lambda: source.read(CHUNK_SIZE), b''):
+            h.update(chunk)
+            f.write(chunk)
+    entry = [member.size, h.hexdigest()]
+    if _unchanged(destpath, member.name, entry, recorded):
+        os.unlink(tmp)
+    else:
+        _set_tar_attrs(archive, member, tmp)
+        os.rename(tmp, target)
+    return _entry(destpath, member.name, *entry)
+
+
+def extract_tarfile(archive_name, destpath, manifest=None):
+    """Unpack a tar archive, optionally compressed.
+
+    The archive is read as a stream. Regular files whose size, digest and
+    modification time match the `manifest` of a previous extraction are
+    left untouched.
+
+    :returns: dict: A { member name: [size, sha256, mtime] } manifest of
+                    the regular files in the archive.
+    """
+    manifest = manifest or {}
+    members = {}
+    directories = []
+    with tarfile.open(archive_name, 'r|*') as archive:
+        for member in archive:
+            if member.isfile():
+                members[member.name] = _extract_tar_member(
+                    archive, member, destpath, manifest.get(member.name))
+            elif member.isdir():
+                path = os.path.join(destpath, member.name)
+                if not os.path.isdir(path):
+                    os.makedirs(path)
+                directories.append(member)
+            else:
+                archive.extract(member, destpath)
+        # Like TarFile.extractall(), set directory attributes last so they
+        # don't prevent or record the extraction of their contents.
+        for member in reversed(directories):
+            _set_tar_attrs(archive, member,
+                           os.path.join(destpath, member.name))
+    return members
+
+
+def extract_zipfile(archive_name, destpath, manifest=None):
+    """Unpack a zip file.
 
+    Files whose size, CRC and modification time match the `manifest` of a
+    previous extraction are left untouched.
 
-def extract_zipfile(archive_name, destpath):
-    "Unpack a zip file"
-    archive = zipfile.ZipFile(archive_name)
-    archive.extractall(destpath)
+    :returns: dict: A { member name: [size, crc, mtime] } manifest of the
+                    files in the archive.
+    """
+    manifest = manifest or {}
+    members = {}
+    with zipfile.ZipFile(archive_name) as archive:
+        for info in archive.infolist():
+            if info.filename.endswith('/'):
+                archive.extract(info, destpath)
+                continue
+            entry = [info.file_size, 'crc32:%08x' % info.CRC]
+            if not _unchanged(destpath, info.filename, entry,
+                              manifest.get(info.filename)):
+                archive.extract(info, destpath)
+            members[info.filename] = _entry(destpath, info.filename, *entry)
+    return members
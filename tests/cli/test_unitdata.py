@@ -0,0 +1,37 @@
+from unittest import TestCase
+from mock import patch, MagicMock
+
+from charmhelpers.cli import cmdline
+from charmhelpers.cli import unitdata  # noqa
+from charmhelpers.core.unitdata import Storage
+
+
+class UnitdataCommandTest(TestCase):
+
+    def setUp(self):
+        super(UnitdataCommandTest, self).setUp()
+        self.kv = Storage(':memory:')
+        patcher = patch('charmhelpers.core.unitdata._KV', self.kv)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch.object(cmdline, 'formatter', MagicMock())
+        self.formatter = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_cmd(self, *args):
+        with patch('sys.argv', ['chlp', 'unitdata'] + list(args)):
+            cmdline.run()
+        return self.formatter.format_output.call_args[0][0]
+
+    def test_set_get(self):
+        self.assertEqual(self.run_cmd('set', 'foo', 'bar'), '')
+        self.assertEqual(self.run_cmd('get', 'foo'), 'bar')
+
+    def test_compact(self):
+        for i in range(3):
+            with self.kv.hook_scope('hook-%d' % i):
+                self.kv.set('foo', i)
+        self.assertEqual(
+            self.run_cmd('compact', '--keep-revisions', '1', '--vacuum'), 2)
+        self.assertEqual(len(self.kv.gethistory('foo')), 1)
+        self.assertEqual(self.run_cmd('compact', '--keep-days', '1'), 0)
@@ -148,6 +148,11 @@ class FakeDNS(object):
 
 class IPTest(unittest.TestCase):
 
+    def setUp(self):
+        # Each test mocks netifaces, so take a new snapshot of it.
+        net_ip._interface_snapshot = None
+        self.addCleanup(setattr, net_ip, '_interface_snapshot', None)
+
     def mock_ifaddresses(self, iface):
         return DUMMY_ADDRESSES[iface]
 
@@ -632,6 +637,71 @@ class IPTest(unittest.TestCase):
         with nose.tools.assert_raises(Exception):
             net_ip.get_iface_from_addr('1.2.3.4')
 
+    @patch.object(netifaces, 'ifaddresses')
+    @patch.object(netifaces, 'interfaces')
+    def test_interface_snapshot_is_reused(self, _interfaces, _ifaddresses):
+        _interfaces.return_value = sorted(DUMMY_ADDRESSES.keys())
+        _ifaddresses.side_effect = DUMMY_ADDRESSES.__getitem__
+        for i in range(2):
+            self.assertEqual(net_ip.get_address_in_network('10.5.0.0/16'),
+                             '10.5.0.1')
+            self.assertEqual(net_ip.get_iface_for_address('10.5.1.1'),
+                             'eth1')
+            self.assertEqual(net_ip.get_iface_addr('eth0'), ['192.168.1.55'])
+            with patch.object(net_ip, 'log'):
+                self.assertEqual(net_ip.get_iface_from_addr('10.6.0.2'),
+                                 'eth1')
+        self.assertEqual(_interfaces.call_count, 1)
+        self.assertEqual(_ifaddresses.call_count, len(DUMMY_ADDRESSES))
+
+        _interfaces.return_value = ['eth1']
+        _ifaddresses.side_effect = lambda iface: {
+            netifaces.AF_INET: [{'addr': '10.5.0.2',
+                                 'netmask': '255.255.0.0'}]}
+        self.assertEqual(net_ip.get_address_in_network('10.5.0.0/16'),
+                         '10.5.0.1')
+        net_ip.interface_snapshot(refresh=True)
+        self.assertEqual(net_ip.get_address_in_network('10.5.0.0/16'),
+                         '10.5.0.2')
+        self.assertEqual(net_ip.get_iface_for_address('192.168.1.1'), None)
+
+    @patch.object(netifaces, 'ifaddresses')
+    @patch.object(netifaces, 'interfaces')
+    def test_interface_snapshot_nested_networks(self, _interfaces,
+                                                _ifaddresses):
+        addresses = {
+            'eth0': {netifaces.AF_INET: [{'addr': '10.0.0.5',
+                                          'netmask': '255.0.0.0'}]},
+            'eth1': {netifaces.AF_INET: [{'addr': '10.1.0.5',
+                                          'netmask': '255.255.0.0'}]},
+            'gone': None,
+        }
+
+        def ifaddresses(iface):
+            if addresses[iface] is None:
+                raise ValueError(iface)
+            return addresses[iface]
+
+        _ifaddresses.side_effect = ifaddresses
+        for interfaces, first, first_addr in (
+                (['gone', 'eth0', 'eth1'], 'eth0', '10.0.0.5'),
+                (['eth1', 'eth0'], 'eth1', '10.1.0.5')):
+            _interfaces.return_value = interfaces
+            snapshot = net_ip.interface_snapshot(refresh=True)
+            self.assertEqual(snapshot.ifaddresses('gone'), {})
+            # Both interfaces are within both networks where they can be,
+            # the first interface wins.
+            self.assertEqual(net_ip.get_address_in_network('10.0.0.0/8'),
+                             first_addr)
+            self.assertEqual(net_ip.get_address_in_network('10.1.0.0/16'),
+                             '10.1.0.5')
+            self.assertEqual(net_ip.get_address_in_network('10.1.0.0/24'),
+                             None)
+            self.assertEqual(net_ip.get_iface_for_address('10.1.2.3'),
+                             first)
+            self.assertEqual(net_ip.get_iface_for_address('10.2.0.1'),
+                             'eth0')
+
     def test_is_ip(self):
         self.assertTrue(net_ip.is_ip('10.0.0.1'))
         self.assertTrue(net_ip.is_ip('2001:db8:1:0:2918:3444:852:5b8a'))
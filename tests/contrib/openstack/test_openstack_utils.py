@@ -2,6 +2,7 @@ import io
 import os
 import contextlib
 import unittest
+import subprocess
 from copy import copy
 from tests.helpers import patch_open
 from testtools import TestCase
@@ -911,7 +912,7 @@ class OpenStackHelpersTestCase(TestCase):
         self.assertTrue(actual_parm1 == 'blocked')
         self.assertTrue(actual_parm2 == expected1 or actual_parm2 == expected2)
 
-    @patch('charmhelpers.contrib.openstack.utils.service_running')
+    @patch('charmhelpers.contrib.openstack.utils.services_running')
     @patch('charmhelpers.contrib.openstack.utils.port_has_listener')
     @patch.object(openstack, 'juju_log')
     @patch('charmhelpers.contrib.openstack.utils.status_set')
@@ -919,7 +920,7 @@ class OpenStackHelpersTestCase(TestCase):
            return_value=False)
     def test_set_os_workload_status_complete_with_services_list(
             self, is_unit_paused_set, status_set, log,
-            port_has_listener, service_running):
+            port_has_listener, services_running):
         configs = MagicMock()
         configs.complete_contexts.return_value = []
         required_interfaces = {}
@@ -927,13 +928,13 @@ class OpenStackHelpersTestCase(TestCase):
         services = ['database', 'identity']
         # Assume that the service and ports are open.
         port_has_listener.return_value = True
-        service_running.return_value = True
+        services_running.side_effect = lambda names: [True] * len(names)
 
         openstack.set_os_workload_status(
             configs, required_interfaces, services=services)
         status_set.assert_called_with('active', 'Unit is ready')
 
-    @patch('charmhelpers.contrib.openstack.utils.service_running')
+    @patch('charmhelpers.contrib.openstack.utils.services_running')
     @patch('charmhelpers.contrib.openstack.utils.port_has_listener')
     @patch.object(openstack, 'juju_log')
     @patch('charmhelpers.contrib.openstack.utils.status_set')
@@ -941,7 +942,7 @@ class OpenStackHelpersTestCase(TestCase):
            return_value=False)
     def test_set_os_workload_status_complete_services_list_not_running(
             self, is_unit_paused_set, status_set, log,
-            port_has_listener, service_running):
+            port_has_listener, services_running):
         configs = MagicMock()
         configs.complete_contexts.return_value = []
         required_interfaces = {}
@@ -949,7 +950,7 @@ class OpenStackHelpersTestCase(TestCase):
         services = ['database', 'identity']
         port_has_listener.return_value = True
         # Fail the identity service
-        service_running.side_effect = [True, False]
+        services_running.return_value = [True, False]
 
         openstack.set_os_workload_status(
             configs, required_interfaces, services=services)
@@ -957,7 +958,7 @@ class OpenStackHelpersTestCase(TestCase):
             'blocked',
             'Services not running that should be: identity')
 
-    @patch('charmhelpers.contrib.openstack.utils.service_running')
+    @patch('charmhelpers.contrib.openstack.utils.services_running')
     @patch('charmhelpers.contrib.openstack.utils.port_has_listener')
     @patch.object(openstack, 'juju_log')
     @patch('charmhelpers.contrib.openstack.utils.status_set')
@@ -965,7 +966,7 @@ class OpenStackHelpersTestCase(TestCase):
            return_value=False)
     def test_set_os_workload_status_complete_with_services(
             self, is_unit_paused_set, status_set, log,
-            port_has_listener, service_running):
+            port_has_listener, services_running):
         configs = MagicMock()
         configs.complete_contexts.return_value = []
         required_interfaces = {}
@@ -976,13 +977,13 @@ class OpenStackHelpersTestCase(TestCase):
         ]
         # Assume that the service and ports are open.
         port_has_listener.return_value = True
-        service_running.return_value = True
+        services_running.side_effect = lambda names: [True] * len(names)
 
         openstack.set_os_workload_status(
             configs, required_interfaces, services=services)
         status_set.assert_called_with('active', 'Unit is ready')
 
-    @patch('charmhelpers.contrib.openstack.utils.service_running')
+    @patch('charmhelpers.contrib.openstack.utils.services_running')
     @patch('charmhelpers.contrib.openstack.utils.port_has_listener')
     @patch.object(openstack, 'juju_log')
     @patch('charmhelpers.contrib.openstack.utils.status_set')
@@ -990,7 +991,7 @@ class OpenStackHelpersTestCase(TestCase):
            return_value=False)
     def test_set_os_workload_status_complete_service_not_running(
             self, is_unit_paused_set, status_set, log,
-            port_has_listener, service_running):
+            port_has_listener, services_running):
         configs = MagicMock()
         configs.complete_contexts.return_value = []
         required_interfaces = {}
@@ -1001,7 +1002,7 @@ class OpenStackHelpersTestCase(TestCase):
         ]
         port_has_listener.return_value = True
         # Fail the identity service
-        service_running.side_effect = [True, False]
+        services_running.return_value = [True, False]
 
         openstack.set_os_workload_status(
             configs, required_interfaces, services=services)
@@ -1009,7 +1010,7 @@ class OpenStackHelpersTestCase(TestCase):
             'blocked',
             'Services not running that should be: identity')
 
-    @patch('charmhelpers.contrib.openstack.utils.service_running')
+    @patch('charmhelpers.contrib.openstack.utils.services_running')
     @patch('charmhelpers.contrib.openstack.utils.port_has_listener')
     @patch.object(openstack, 'juju_log')
     @patch('charmhelpers.contrib.openstack.utils.status_set')
@@ -1017,7 +1018,7 @@ class OpenStackHelpersTestCase(TestCase):
            return_value=False)
     def test_set_os_workload_status_complete_port_not_open(
             self, is_unit_paused_set, status_set, log,
-            port_has_listener, service_running):
+            port_has_listener, services_running):
         configs = MagicMock()
         configs.complete_contexts.return_value = []
         required_interfaces = {}
@@ -1028,7 +1029,7 @@ class OpenStackHelpersTestCase(TestCase):
         ]
         port_has_listener.side_effect = [True, False, True]
         # Fail the identity service
-        service_running.return_value = True
+        services_running.side_effect = lambda names: [True] * len(names)
 
         openstack.set_os_workload_status(
             configs, required_interfaces, services=services)
@@ -1072,7 +1073,7 @@ class OpenStackHelpersTestCase(TestCase):
             'maintenance',
             "Paused. Use 'resume' action to resume normal service.")
 
-    @patch('charmhelpers.contrib.openstack.utils.service_running')
+    @patch('charmhelpers.contrib.openstack.utils.services_running')
     @patch('charmhelpers.contrib.openstack.utils.port_has_listener')
     @patch.object(openstack, 'juju_log')
     @patch('charmhelpers.contrib.openstack.utils.status_set')
@@ -1080,7 +1081,7 @@ class OpenStackHelpersTestCase(TestCase):
            return_value=True)
     def test_set_os_workload_status_paused_services_check(
             self, is_unit_paused_set, status_set, log,
-            port_has_listener, service_running):
+            port_has_listener, services_running):
         configs = MagicMock()
         configs.complete_contexts.return_value = []
         required_interfaces = {}
@@ -1090,7 +1091,7 @@ class OpenStackHelpersTestCase(TestCase):
             {'service': 'identity', 'ports': [30]},
         ]
         port_has_listener.return_value = False
-        service_running.side_effect = [False, False]
+        services_running.return_value = [False, False]
 
         openstack.set_os_workload_status(
             configs, required_interfaces, services=services)
@@ -1098,7 +1099,7 @@ class OpenStackHelpersTestCase(TestCase):
             'maintenance',
             "Paused. Use 'resume' action to resume normal service.")
 
-    @patch('charmhelpers.contrib.openstack.utils.service_running')
+    @patch('charmhelpers.contrib.openstack.utils.services_running')
     @patch('charmhelpers.contrib.openstack.utils.port_has_listener')
     @patch.object(openstack, 'juju_log')
     @patch('charmhelpers.contrib.openstack.utils.status_set')
@@ -1106,7 +1107,7 @@ class OpenStackHelpersTestCase(TestCase):
            return_value=True)
     def test_set_os_workload_status_paused_services_fail(
             self, is_unit_paused_set, status_set, log,
-            port_has_listener, service_running):
+            port_has_listener, services_running):
         configs = MagicMock()
         configs.complete_contexts.return_value = []
         required_interfaces = {}
@@ -1117,7 +1118,7 @@ class OpenStackHelpersTestCase(TestCase):
         ]
         port_has_listener.return_value = False
         # Fail the identity service
-        service_running.side_effect = [False, True]
+        services_running.return_value = [False, True]
 
         openstack.set_os_workload_status(
             configs, required_interfaces, services=services)
@@ -1125,7 +1126,7 @@ class OpenStackHelpersTestCase(TestCase):
             'blocked',
             "Services should be paused but these services running: identity")
 
-    @patch('charmhelpers.contrib.openstack.utils.service_running')
+    @patch('charmhelpers.contrib.openstack.utils.services_running')
     @patch('charmhelpers.contrib.openstack.utils.port_has_listener')
     @patch.object(openstack, 'juju_log')
     @patch('charmhelpers.contrib.openstack.utils.status_set')
@@ -1133,7 +1134,7 @@ class OpenStackHelpersTestCase(TestCase):
            return_value=True)
     def test_set_os_workload_status_paused_services_ports_fail(
             self, is_unit_paused_set, status_set, log,
-            port_has_listener, service_running):
+            port_has_listener, services_running):
         configs = MagicMock()
         configs.complete_contexts.return_value = []
         required_interfaces = {}
@@ -1144,7 +1145,7 @@ class OpenStackHelpersTestCase(TestCase):
         ]
         # make the service 20 port be still listening.
         port_has_listener.side_effect = [False, True, False]
-        service_running.return_value = False
+        services_running.side_effect = lambda names: [False] * len(names)
 
         openstack.set_os_workload_status(
             configs, required_interfaces, services=services)
@@ -1197,26 +1198,26 @@ class OpenStackHelpersTestCase(TestCase):
             "Services should be paused but "
             "these ports which should be closed, but are open: 70")
 
-    @patch('charmhelpers.contrib.openstack.utils.service_running')
+    @patch('charmhelpers.contrib.openstack.utils.services_running')
     @patch('charmhelpers.contrib.openstack.utils.port_has_listener')
     def test_check_actually_paused_simple_services(
-            self, port_has_listener, service_running):
+            self, port_has_listener, services_running):
         services = ['database', 'identity']
         port_has_listener.return_value = False
-        service_running.return_value = False
+        services_running.side_effect = lambda names: [False] * len(names)
 
         state, message = openstack.check_actually_paused(
             services)
         self.assertEquals(state, None)
         self.assertEquals(message, None)
 
-    @patch('charmhelpers.contrib.openstack.utils.service_running')
+    @patch('charmhelpers.contrib.openstack.utils.services_running')
     @patch('charmhelpers.contrib.openstack.utils.port_has_listener')
     def test_check_actually_paused_simple_services_fail(
-            self, port_has_listener, service_running):
+            self, port_has_listener, services_running):
         services = ['database', 'identity']
         port_has_listener.return_value = False
-        service_running.side_effect = [False, True]
+        services_running.return_value = [False, True]
 
         state, message = openstack.check_actually_paused(
             services)
@@ -1225,34 +1226,34 @@ class OpenStackHelpersTestCase(TestCase):
             message,
             "Services should be paused but these services running: identity")
 
-    @patch('charmhelpers.contrib.openstack.utils.service_running')
+    @patch('charmhelpers.contrib.openstack.utils.services_running')
     @patch('charmhelpers.contrib.openstack.utils.port_has_listener')
     def test_check_actually_paused_services_dict(
-            self, port_has_listener, service_running):
+            self, port_has_listener, services_running):
         services = [
             {'service': 'database', 'ports': [10, 20]},
             {'service': 'identity', 'ports': [30]},
         ]
         # Assume that the service and ports are open.
         port_has_listener.return_value = False
-        service_running.return_value = False
+        services_running.side_effect = lambda names: [False] * len(names)
 
         state, message = openstack.check_actually_paused(
             services)
         self.assertEquals(state, None)
         self.assertEquals(message, None)
 
-    @patch('charmhelpers.contrib.openstack.utils.service_running')
+    @patch('charmhelpers.contrib.openstack.utils.services_running')
     @patch('charmhelpers.contrib.openstack.utils.port_has_listener')
     def test_check_actually_paused_services_dict_fail(
-            self, port_has_listener, service_running):
+            self, port_has_listener, services_running):
         services = [
             {'service': 'database', 'ports': [10, 20]},
             {'service': 'identity', 'ports': [30]},
         ]
         # Assume that the service and ports are open.
         port_has_listener.return_value = False
-        service_running.side_effect = [False, True]
+        services_running.return_value = [False, True]
 
         state, message = openstack.check_actually_paused(
             services)
@@ -1261,17 +1262,17 @@ class OpenStackHelpersTestCase(TestCase):
             message,
             "Services should be paused but these services running: identity")
 
-    @patch('charmhelpers.contrib.openstack.utils.service_running')
+    @patch('charmhelpers.contrib.openstack.utils.services_running')
     @patch('charmhelpers.contrib.openstack.utils.port_has_listener')
     def test_check_actually_paused_services_dict_ports_fail(
-            self, port_has_listener, service_running):
+            self, port_has_listener, services_running):
         services = [
             {'service': 'database', 'ports': [10, 20]},
             {'service': 'identity', 'ports': [30]},
         ]
         # Assume that the service and ports are open.
         port_has_listener.side_effect = [False, True, False]
-        service_running.return_value = False
+        services_running.side_effect = lambda names: [False] * len(names)
 
         state, message = openstack.check_actually_paused(
             services)
@@ -1280,12 +1281,12 @@ class OpenStackHelpersTestCase(TestCase):
                           'Services should be paused but these service:ports'
                           ' are open: database: [20]')
 
-    @patch('charmhelpers.contrib.openstack.utils.service_running')
+    @patch('charmhelpers.contrib.openstack.utils.services_running')
     @patch('charmhelpers.contrib.openstack.utils.port_has_listener')
     def test_check_actually_paused_ports_okay(
-            self, port_has_listener, service_running):
+            self, port_has_listener, services_running):
         port_has_listener.side_effect = [False, False, False]
-        service_running.return_value = False
+        services_running.side_effect = lambda names: [False] * len(names)
         ports = [50, 60, 70]
 
         state, message = openstack.check_actually_paused(
@@ -1293,12 +1294,12 @@ class OpenStackHelpersTestCase(TestCase):
         self.assertEquals(state, None)
         self.assertEquals(state, None)
 
-    @patch('charmhelpers.contrib.openstack.utils.service_running')
+    @patch('charmhelpers.contrib.openstack.utils.services_running')
     @patch('charmhelpers.contrib.openstack.utils.port_has_listener')
     def test_check_actually_paused_ports_fail(
-            self, port_has_listener, service_running):
+            self, port_has_listener, services_running):
         port_has_listener.side_effect = [False, True, False]
-        service_running.return_value = False
+        services_running.side_effect = lambda names: [False] * len(names)
         ports = [50, 60, 70]
 
         state, message = openstack.check_actually_paused(
@@ -1674,8 +1675,9 @@ class OpenStackHelpersTestCase(TestCase):
             openstack.get_snaps_install_info_from_origin(snaps, src,
                                                          mode=mode))
 
-    @patch.object(openstack, 'snap_install')
-    def test_install_os_snaps(self, mock_snap_install):
+    @patch.object(openstack, 'snap_many')
+    def test_install_os_snaps(self, mock_snap_many):
+        mock_snap_many.return_value = ({'os_project': True}, {})
         snaps = ['os_project']
         mode = 'jailmode'
 
@@ -1684,16 +1686,27 @@ class OpenStackHelpersTestCase(TestCase):
         openstack.install_os_snaps(
             openstack.get_snaps_install_info_from_origin(
                 snaps, src, mode=mode))
-        mock_snap_install.assert_called_with(
-            'os_project', '--channel=ocata/beta', '--jailmode')
+        mock_snap_many.assert_called_with(
+            'install', {'os_project': ['--channel=ocata/beta', '--jailmode']},
+            workers=1)
 
         # snap:track
         src = 'snap:pike'
         openstack.install_os_snaps(
             openstack.get_snaps_install_info_from_origin(
-                snaps, src, mode=mode))
-        mock_snap_install.assert_called_with(
-            'os_project', '--channel=pike', '--jailmode')
+                snaps, src, mode=mode), refresh=True)
+        mock_snap_many.assert_called_with(
+            'refresh', {'os_project': ['--channel=pike', '--jailmode']},
+            workers=1)
+
+    @patch.object(openstack, 'snap_many')
+    def test_install_os_snaps_failure(self, mock_snap_many):
+        error = subprocess.CalledProcessError(2, 'snap')
+        mock_snap_many.return_value = ({}, {'os_project': error})
+        snaps = openstack.get_snaps_install_info_from_origin(
+            ['os_project'], 'snap:pike', mode='classic')
+        self.assertRaises(subprocess.CalledProcessError,
+                          openstack.install_os_snaps, snaps)
 
 
 if __name__ == '__main__':
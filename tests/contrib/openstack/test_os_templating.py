@@ -1,5 +1,7 @@
 
 import os
+import shutil
+import tempfile
 import unittest
 
 from mock import patch, call, MagicMock
@@ -169,17 +171,24 @@ class TemplatingTests(unittest.TestCase):
     def test_render_template_by_basename(self):
         '''It renders template if it finds it by config file basename'''
 
-    @patch(builtin_open)
     @patch.object(templating, 'get_loader')
-    def test_write_out_config(self, loader, _open):
+    def test_write_out_config(self, loader):
         '''It writes a templated config when provided a complete context'''
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        foo = os.path.join(tmpdir, 'foo')
         self.context.set(interfaces=['fooservice'], context={'foo': 'bar'})
-        self.renderer.register('/tmp/foo', [self.context])
+        self.renderer.register(foo, [self.context])
+        self.addCleanup(os.umask, os.umask(0o027))
         with patch.object(self.renderer, '_get_template') as _get_t:
-            fake_tmpl = MockTemplate()
-            _get_t.return_value = fake_tmpl
-            self.renderer.write('/tmp/foo')
-            _open.assert_called_with('/tmp/foo', 'wb')
+            _get_t.return_value.render.return_value = u'foo = bar\n'
+            self.assertTrue(self.renderer.write(foo))
+        # New files are written atomically too, honouring the umask.
+        self.assertEqual(os.listdir(tmpdir), ['foo'])
+        self.assertEqual(os.stat(foo).st_mode & 0o777, 0o640)
+        self.assertEqual(os.stat(foo).st_uid, os.getuid())
+        with open(foo) as f:
+            self.assertEqual(f.read(), 'foo = bar\n')
 
     def test_write_all(self):
         '''It writes out all configuration files at once'''
@@ -195,6 +204,108 @@ class TemplatingTests(unittest.TestCase):
             self.assertEquals(sorted(ex_calls), sorted(_write.call_args_list))
             pass
 
+    @patch.object(templating, 'get_loader')
+    def test_context_generators_run_once_per_pass(self, loader):
+        '''It calls shared context generators once per render pass'''
+        shared = MagicMock(interfaces=['shared'], return_value={'a': 1})
+        other = MagicMock(interfaces=['other'], return_value={'b': 2})
+        self.renderer.register('/tmp/foo', [shared])
+        self.renderer.register('/tmp/bar', [shared, other])
+        with patch.object(self.renderer, '_get_template'):
+            with self.renderer.render_pass() as memo:
+                self.renderer.render('/tmp/foo')
+                self.renderer.render('/tmp/bar')
+                self.assertEqual(sorted(self.renderer.complete_contexts()),
+                                 ['other', 'shared', 'shared'])
+                self.assertEqual(shared.call_count, 1)
+                self.assertEqual(other.call_count, 1)
+                self.assertIn((shared, 1, 1), memo.stats())
+
+                self.renderer.invalidate_contexts(shared)
+                self.renderer.render('/tmp/bar')
+                self.assertEqual(shared.call_count, 2)
+                self.assertEqual(other.call_count, 1)
+                self.renderer.invalidate_contexts()
+                self.renderer.render('/tmp/bar')
+                self.assertEqual(other.call_count, 2)
+
+            # outside of a pass generators are always called.
+            self.renderer.render('/tmp/foo')
+            self.renderer.render('/tmp/foo')
+            self.assertEqual(shared.call_count, 5)
+
+    @patch.object(templating, 'get_loader')
+    def test_write_all_is_a_render_pass(self, loader):
+        '''It calls shared context generators once when writing all'''
+        shared = MagicMock(interfaces=['shared'], return_value={'a': 1})
+        self.renderer.register('/tmp/foo', [shared])
+        self.renderer.register('/tmp/bar', [shared])
+        with patch.object(self.renderer, '_get_template') as _get_t:
+            _get_t.return_value.render.return_value = ''
+            with patch.object(templating, '_write_atomic'):
+                self.renderer.write_all()
+        self.assertEqual(shared.call_count, 1)
+
+    def test_write_skips_unchanged(self):
+        '''It only replaces config files whose content changed'''
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        foo = os.path.join(tmpdir, 'foo')
+        bar = os.path.join(tmpdir, 'bar')
+        link = os.path.join(tmpdir, 'link')
+        os.symlink(bar, link)
+        self.context.set(interfaces=['fooservice'], context={'foo': 'bar'})
+        for config_file in (foo, bar, link):
+            self.renderer.register(config_file, [self.context])
+        rendered = {foo: u'foo\n', bar: u'bar\n', link: u'bar\n'}
+        with patch.object(self.renderer, 'render', rendered.get):
+            self.assertTrue(self.renderer.write(foo))
+            os.chmod(foo, 0o640)
+            ino = os.stat(foo).st_ino
+            self.assertFalse(self.renderer.write(foo))
+            self.assertEqual(os.stat(foo).st_ino, ino)
+
+            rendered[foo] = u'foo2\n'
+            self.assertEqual(self.renderer.write_all(), set([foo, bar]))
+            self.assertNotEqual(os.stat(foo).st_ino, ino)
+            self.assertEqual(os.stat(foo).st_mode & 0o777, 0o640)
+            self.assertEqual(self.renderer.write_all(), set())
+
+            rendered[link] = rendered[bar] = u'bar2\n'
+            # bar is written through whichever of bar and link comes first
+            self.assertIn(self.renderer.write_all(),
+                          (set([bar]), set([link])))
+            self.assertTrue(os.path.islink(link))
+        with open(foo) as f:
+            self.assertEqual(f.read(), 'foo2\n')
+        with open(link) as f:
+            self.assertEqual(f.read(), 'bar2\n')
+        self.assertEqual(sorted(os.listdir(tmpdir)), ['bar', 'foo', 'link'])
+
+    @patch.object(templating, 'get_loader')
+    def test_write_all_in_parallel(self, loader):
+        '''It renders and writes config files concurrently'''
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        shared = MagicMock(interfaces=['shared'], return_value={'a': 1})
+        other = MagicMock(interfaces=['other'], return_value={'b': 2})
+        config_files = [os.path.join(tmpdir, str(i)) for i in range(8)]
+        for config_file in config_files:
+            self.renderer.register(config_file, [shared, other])
+        with patch.object(self.renderer, '_get_template') as _get_t:
+            _get_t.return_value.render.side_effect = \
+                lambda ctxt: u'{}\n'.format(sorted(ctxt.items()))
+            self.assertEqual(self.renderer.write_all(workers=4),
+                             set(config_files))
+            self.assertEqual(self.renderer.write_all(workers=4), set())
+        self.assertEqual(shared.call_count, 2)
+        self.assertEqual(other.call_count, 2)
+        self.assertEqual(sorted(self.renderer.render_times),
+                         sorted(config_files))
+        for config_file in config_files:
+            with open(config_file) as f:
+                self.assertEqual(f.read(), "[('a', 1), ('b', 2)]\n")
+
     @patch.object(templating, 'get_loader')
     def test_reset_template_loader_for_new_os_release(self, loader):
         self.loader.set('')
@@ -3,6 +3,7 @@ import json
 from subprocess import CalledProcessError
 import shutil
 import tempfile
+import threading
 from mock import call, MagicMock, mock_open, patch, sentinel
 from testtools import TestCase
 import yaml
@@ -10,7 +11,7 @@ import yaml
 import six
 import io
 
-from charmhelpers.core import hookenv
+from charmhelpers.core import hookenv, unitdata
 
 if six.PY3:
     import pickle
@@ -1249,6 +1250,122 @@ class HelpersTest(TestCase):
         self.assertEquals(cache_function(unserializable), 'qux')
         self.assertEquals(calls, ['hello', 'foo', 'baz', unserializable])
 
+    def test_cached_unhashable_args(self):
+        calls = []
+
+        @hookenv.cached
+        def cache_function(keys, default=None):
+            calls.append(keys)
+            return len(keys)
+
+        self.assertEqual(cache_function(['a', 'b']), 2)
+        self.assertEqual(cache_function(['a', 'b']), 2)
+        self.assertEqual(cache_function(['a'], default={'x': 1}), 1)
+        self.assertEqual(cache_function(['a'], default={'x': 1}), 1)
+        self.assertEqual(calls, [['a', 'b'], ['a']])
+
+    def test_flush_matches_function_and_args(self):
+        @hookenv.cached
+        def cache_function(attribute, unit=None):
+            return attribute
+
+        cache_function('foo', unit='unit/0')
+        cache_function('bar', unit='unit/1')
+        cache_function('baz')
+        hookenv.flush('unit/')
+        self.assertEqual(len(hookenv.cache), 1)
+        hookenv.flush('cache_function')
+        self.assertEqual(len(hookenv.cache), 0)
+
+    def test_invalidate_derived_entries(self):
+        calls = []
+
+        @hookenv.cached
+        def settings(unit, rid):
+            calls.append((unit, rid))
+            return {'unit': unit}
+
+        @hookenv.cached
+        def all_settings():
+            return [settings(u, 'rel:1') for u in ('unit/0', 'unit/1')]
+
+        @hookenv.cached
+        def other(rid):
+            return rid
+
+        self.assertEqual(len(all_settings()), 2)
+        other('rel:2')
+        self.assertEqual(len(hookenv.cache), 4)
+        hookenv.invalidate('unit/1')
+        # settings for unit/1 and all_settings, which was derived from it
+        self.assertEqual(len(hookenv.cache), 2)
+        all_settings()
+        self.assertEqual(calls, [('unit/0', 'rel:1'), ('unit/1', 'rel:1'),
+                                 ('unit/1', 'rel:1')])
+        hookenv.invalidate('rel:1')
+        self.assertEqual(len(hookenv.cache), 1)
+        hookenv.invalidate('unknown')
+        self.assertEqual(len(hookenv.cache), 1)
+
+    def test_invalidate_entries_computed_in_threads(self):
+        calls = []
+        u2_started = threading.Event()
+        u1_done = threading.Event()
+
+        @hookenv.cached
+        def settings(unit):
+            calls.append(unit)
+            return unit
+
+        @hookenv.cached
+        def derived(unit):
+            # Interleave the two computations: unit/1 reads its settings
+            # while unit/2 is being computed in the other thread.
+            if unit == 'unit/1':
+                u2_started.wait(5)
+                value = settings('unit/1-settings')
+                u1_done.set()
+            else:
+                u2_started.set()
+                u1_done.wait(5)
+                value = settings('unit/2-settings')
+            return value
+
+        threads = [threading.Thread(target=derived, args=(unit,))
+                   for unit in ('unit/1', 'unit/2')]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(hookenv.cache), 4)
+
+        hookenv.invalidate('unit/1-settings')
+        # derived('unit/1') is dropped with the settings it was computed
+        # from, derived('unit/2') is kept.
+        self.assertEqual(len(hookenv.cache), 2)
+        self.assertEqual(derived('unit/1'), 'unit/1-settings')
+        self.assertEqual(derived('unit/2'), 'unit/2-settings')
+        self.assertEqual(calls, ['unit/1-settings', 'unit/2-settings',
+                                 'unit/1-settings'])
+
+    @patch('charmhelpers.core.hookenv.local_unit')
+    @patch('subprocess.check_call')
+    @patch('subprocess.check_output')
+    def test_relation_set_invalidates_relations(self, check_output,
+                                                check_call, local_unit):
+        local_unit.return_value = 'local/0'
+        check_output.side_effect = [
+            b'["rel:1"]', b'{"foo": "old"}', b'["remote/0"]',
+            b'{"foo": "bar"}', '', b'{"foo": "new"}']
+        with patch.object(hookenv, 'relation_types', lambda: ['rel']):
+            rels = hookenv.relations()
+            self.assertEqual(rels['rel']['rel:1']['local/0'], {'foo': 'old'})
+            hookenv.relation_set(relation_id='rel:1', foo='new')
+            rels = hookenv.relations()
+        self.assertEqual(rels['rel']['rel:1']['local/0'], {'foo': 'new'})
+        self.assertEqual(rels['rel']['rel:1']['remote/0'], {'foo': 'bar'})
+        self.assertEqual(check_output.call_count, 6)
+
     def test_gets_charm_dir(self):
         with patch.dict('os.environ', {}):
             self.assertEqual(hookenv.charm_dir(), None)
@@ -1898,3 +2015,265 @@ ingress-addresses:
         # Return the private-address
         del d['ingress-address']
         self.assertEqual(hookenv.egress_subnets(), ['2001::D0:F00D/128'])
+
+
+STUB_HOOK_TOOL = """#!/bin/sh
+echo "$(basename $0) $*" >> "{log}"
+case "$(basename $0)" in
+    relation-ids) echo '["peer:1"]' ;;
+    relation-list) echo '[{units}]' ;;
+    relation-get)
+        for last; do :; done
+        if [ "$4" = "-" ]; then
+            echo '{{"private-address": "10.0.0.1", "unit": "'$last'"}}'
+        else
+            echo '"10.0.0.1"'
+        fi ;;
+esac
+"""
+
+
+class PrefetchRelationsTest(TestCase):
+    """Count hook tool spawns against a directory of stub hook tools."""
+
+    units = ['peer/{}'.format(i) for i in range(1, 41)]
+
+    def setUp(self):
+        super(PrefetchRelationsTest, self).setUp()
+
+        _clean_globals()
+        self.addCleanup(_clean_globals)
+
+        tools_dir = tempfile.mkdtemp()
+        self.addCleanup(lambda: shutil.rmtree(tools_dir))
+        self.log = os.path.join(tools_dir, 'spawns.log')
+        stub = STUB_HOOK_TOOL.format(
+            log=self.log,
+            units=', '.join('"{}"'.format(u) for u in self.units))
+        for tool in ('relation-ids', 'relation-list', 'relation-get'):
+            path = os.path.join(tools_dir, tool)
+            with open(path, 'w') as f:
+                f.write(stub)
+            os.chmod(path, 0o755)
+
+        patcher = patch.dict('os.environ', {
+            'PATH': tools_dir + os.pathsep + os.environ['PATH'],
+            'JUJU_UNIT_NAME': 'peer/0'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch.object(hookenv, 'relation_types', lambda: ['peer'])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def spawns(self):
+        if not os.path.exists(self.log):
+            return 0
+        with open(self.log) as f:
+            count = len(f.readlines())
+        os.remove(self.log)
+        return count
+
+    def test_relations_without_prefetch(self):
+        for unit in self.units:
+            hookenv.relation_get('private-address', unit=unit, rid='peer:1')
+        self.assertEqual(self.spawns(), len(self.units))
+        hookenv.relations_of_type('peer')
+        # relation-ids, relation-list and one relation-get per unit
+        self.assertEqual(self.spawns(), 2 + len(self.units))
+        # Attribute lookups are answered from the full unit settings
+        for unit in self.units:
+            hookenv.relation_get('unit', unit=unit, rid='peer:1')
+        self.assertEqual(self.spawns(), 0)
+
+    def test_prefetch_relations(self):
+        hookenv.prefetch_relations()
+        # relation-ids, relation-list, local unit and related units
+        self.assertEqual(self.spawns(), 2 + 1 + len(self.units))
+
+        rels = hookenv.relations()
+        self.assertEqual(len(rels['peer']['peer:1']), 1 + len(self.units))
+        self.assertEqual(rels['peer']['peer:1']['peer/0'],
+                         {'private-address': '10.0.0.1', 'unit': 'peer/0'})
+        relations = hookenv.relations_of_type('peer')
+        self.assertEqual([r['__unit__'] for r in relations], self.units)
+        for unit in self.units:
+            self.assertEqual(
+                hookenv.relation_get('private-address', unit=unit,
+                                     rid='peer:1'),
+                '10.0.0.1')
+            self.assertEqual(
+                hookenv.relation_get('missing', unit=unit, rid='peer:1'),
+                None)
+        self.assertTrue(hookenv.is_relation_made('peer'))
+        self.assertEqual(self.spawns(), 0)
+        # relation_for_unit must not leak its changes into the cache
+        self.assertNotIn('__unit__', hookenv.relation_get(unit='peer/1',
+                                                          rid='peer:1'))
+
+    def test_prefetch_relations_in_relation_hook(self):
+        hookenv.prefetch_relations('peer')
+        self.spawns()
+        with patch.dict('os.environ', {'JUJU_REMOTE_UNIT': 'peer/3',
+                                       'JUJU_RELATION_ID': 'peer:1'}):
+            self.assertEqual(hookenv.relation_get('unit'), 'peer/3')
+        self.assertEqual(self.spawns(), 0)
+
+
+class PersistentCacheTest(TestCase):
+    def setUp(self):
+        super(PersistentCacheTest, self).setUp()
+
+        _clean_globals()
+        self.addCleanup(_clean_globals)
+
+        self.charm_dir = tempfile.mkdtemp()
+        self.addCleanup(lambda: shutil.rmtree(self.charm_dir))
+        with open(os.path.join(self.charm_dir, 'metadata.yaml'), 'wb') as f:
+            f.write(CHARM_METADATA)
+        self.set_revision('1')
+
+        patcher = patch.dict('os.environ', {'CHARM_DIR': self.charm_dir,
+                                            'JUJU_VERSION': '2.3.7',
+                                            'JUJU_HOOK_NAME': 'install'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.kv = unitdata.Storage(':memory:')
+        hookenv.enable_persistent_cache(self.kv)
+        self.addCleanup(hookenv.disable_persistent_cache)
+
+    def set_revision(self, revision):
+        with open(os.path.join(self.charm_dir, 'revision'), 'w') as f:
+            f.write(revision)
+
+    def next_hook(self, name):
+        """Drop the in-process state as a new hook process would"""
+        hookenv.cache.clear()
+        hookenv._persistent_cache_hook = None
+        os.environ['JUJU_HOOK_NAME'] = name
+
+    def rewrite_metadata(self, content):
+        """Replace metadata.yaml, keeping its size and modification time"""
+        path = os.path.join(self.charm_dir, 'metadata.yaml')
+        st = os.stat(path)
+        with open(path, 'wb') as f:
+            f.write(content)
+        os.utime(path, (st.st_atime, st.st_mtime))
+
+    @patch('subprocess.check_output')
+    def test_unit_get_persisted_across_hooks(self, check_output):
+        check_output.return_value = b'"10.0.0.1"'
+        self.assertEqual(hookenv.unit_get('private-address'), '10.0.0.1')
+        self.next_hook('update-status')
+        self.assertEqual(hookenv.unit_get('private-address'), '10.0.0.1')
+        self.assertEqual(check_output.call_count, 1)
+
+        # Addresses are refreshed in config-changed
+        check_output.return_value = b'"10.0.0.2"'
+        self.next_hook('config-changed')
+        self.assertEqual(hookenv.unit_get('private-address'), '10.0.0.2')
+        self.next_hook('update-status')
+        self.assertEqual(hookenv.unit_get('private-address'), '10.0.0.2')
+        self.assertEqual(check_output.call_count, 2)
+
+    @patch('subprocess.check_output')
+    def test_none_not_persisted(self, check_output):
+        check_output.return_value = b''
+        self.assertEqual(hookenv.unit_get('foo'), None)
+        self.next_hook('update-status')
+        self.assertEqual(hookenv.unit_get('foo'), None)
+        self.assertEqual(check_output.call_count, 2)
+
+    def test_metadata_invalidated_on_upgrade_charm(self):
+        self.assertEqual(hookenv.charm_name(), 'testmock')
+        self.rewrite_metadata(CHARM_METADATA.replace(b'testmock', b'upgraded'))
+        self.next_hook('update-status')
+        self.assertEqual(hookenv.charm_name(), 'testmock')
+        self.assertEqual(hookenv.metadata()['name'], 'testmock')
+        self.next_hook('upgrade-charm')
+        self.assertEqual(hookenv.charm_name(), 'upgraded')
+        self.assertEqual(hookenv.metadata()['name'], 'upgraded')
+        self.next_hook('update-status')
+        self.assertEqual(hookenv.charm_name(), 'upgraded')
+
+    def test_invalidated_in_hook_not_calling_function(self):
+        self.assertEqual(hookenv.charm_name(), 'testmock')
+        self.assertEqual(len(hookenv.relation_types()), 3)
+        self.rewrite_metadata(CHARM_METADATA.replace(b'testmock', b'upgraded'))
+        # upgrade-charm enables the cache but never calls metadata()
+        self.next_hook('upgrade-charm')
+        hookenv.enable_persistent_cache(self.kv)
+        self.next_hook('update-status')
+        self.assertEqual(hookenv.charm_name(), 'upgraded')
+        self.assertEqual(hookenv.metadata()['name'], 'upgraded')
+
+    @patch('subprocess.check_output')
+    def test_invalidated_on_first_lookup_in_hook(self, check_output):
+        check_output.return_value = b'"10.0.0.1"'
+        hookenv.unit_get('private-address')
+        # config-changed only looks up the charm name
+        self.next_hook('config-changed')
+        hookenv.charm_name()
+        check_output.return_value = b'"10.0.0.2"'
+        self.next_hook('update-status')
+        self.assertEqual(hookenv.unit_get('private-address'), '10.0.0.2')
+        self.assertEqual(check_output.call_count, 2)
+
+    def test_metadata_invalidated_by_metadata_change(self):
+        self.assertEqual(hookenv.charm_name(), 'testmock')
+        self.assertEqual(len(hookenv.relation_types()), 3)
+        with open(os.path.join(self.charm_dir, 'metadata.yaml'), 'w') as f:
+            f.write('name: upgraded\n')
+        self.next_hook('update-status')
+        self.assertEqual(hookenv.charm_name(), 'upgraded')
+        self.assertEqual(hookenv.relation_types(), [])
+
+    def test_invalidated_by_charm_revision(self):
+        self.assertEqual(hookenv.relation_types(),
+                         ['testprov', 'testreqs', 'testpeer'])
+        self.rewrite_metadata(b'name: upgraded\n'.ljust(len(CHARM_METADATA)))
+        self.next_hook('update-status')
+        self.assertEqual(len(hookenv.relation_types()), 3)
+        self.set_revision('2')
+        self.next_hook('update-status')
+        self.assertEqual(hookenv.relation_types(), [])
+
+    @patch('glob.glob')
+    @patch('subprocess.check_output')
+    def test_juju_version_invalidated_by_juju_upgrade(self, check_output,
+                                                      glob_):
+        glob_.return_value = ['/var/lib/juju/tools/machine-0/jujud']
+        check_output.return_value = '2.3.7-xenial-amd64\n'
+        self.assertEqual(hookenv.juju_version(), '2.3.7-xenial-amd64')
+        self.next_hook('update-status')
+        self.assertEqual(hookenv.juju_version(), '2.3.7-xenial-amd64')
+        self.assertEqual(check_output.call_count, 1)
+        check_output.return_value = '2.4.1-xenial-amd64\n'
+        os.environ['JUJU_VERSION'] = '2.4.1'
+        self.next_hook('update-status')
+        self.assertEqual(hookenv.juju_version(), '2.4.1-xenial-amd64')
+
+    @patch('subprocess.check_output')
+    def test_flush_persistent_cache(self, check_output):
+        check_output.return_value = b'"10.0.0.1"'
+        hookenv.unit_get('private-address')
+        hookenv.charm_name()
+        hookenv.flush_persistent_cache('unit_get')
+        self.assertEqual(
+            sorted(self.kv.getrange(hookenv.PERSISTENT_CACHE_PREFIX)),
+            ['hookenv.cache.charm_name.[[], {}]',
+             'hookenv.cache.metadata.[[], {}]'])
+        hookenv.flush_persistent_cache()
+        self.assertEqual(
+            self.kv.getrange(hookenv.PERSISTENT_CACHE_PREFIX), {})
+
+    @patch('subprocess.check_output')
+    def test_disabled(self, check_output):
+        hookenv.disable_persistent_cache()
+        check_output.return_value = b'"10.0.0.1"'
+        hookenv.unit_get('private-address')
+        self.next_hook('update-status')
+        hookenv.unit_get('private-address')
+        self.assertEqual(check_output.call_count, 2)
+        self.assertEqual(
+            self.kv.getrange(hookenv.PERSISTENT_CACHE_PREFIX), {})
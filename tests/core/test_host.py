@@ -1,6 +1,7 @@
 import os.path
 from collections import OrderedDict
 import subprocess
+import hashlib
 from tempfile import mkdtemp
 from shutil import rmtree
 from textwrap import dedent
@@ -9,7 +10,7 @@ import apt_pkg
 import imp
 
 from charmhelpers import osplatform
-from mock import patch, call, mock_open
+from mock import patch, call, mock_open, MagicMock
 from testtools import TestCase
 from tests.helpers import patch_open
 from tests.helpers import mock_open as mocked_open
@@ -543,6 +544,66 @@ class HelpersTest(TestCase):
         check_output.side_effect = exc
         self.assertFalse(host.service_running('foo'))
 
+    @patch('time.time')
+    @patch.object(host, 'init_is_systemd')
+    @patch('subprocess.check_output')
+    def test_services_running_systemd(self, check_output, systemd, time_):
+        self.addCleanup(host._services_running_cache.clear)
+        systemd.return_value = True
+        time_.return_value = 100
+        check_output.return_value = (b'ActiveState=active\n\n'
+                                     b'ActiveState=inactive\n\n'
+                                     b'ActiveState=reloading\n')
+        self.assertEqual(host.services_running(['a', 'b', 'c', 'a']),
+                         [True, False, True, True])
+        check_output.assert_called_once_with(
+            ['systemctl', 'show', '-p', 'ActiveState', '--', 'a', 'b', 'c'])
+
+        # Cached results are reused until they expire.
+        time_.return_value = 104
+        self.assertEqual(host.services_running(['c', 'a']), [True, True])
+        self.assertEqual(check_output.call_count, 1)
+        check_output.return_value = b'ActiveState=failed\n'
+        self.assertEqual(host.services_running(['a'], ttl=0), [False])
+        time_.return_value = 106
+        check_output.return_value = b'ActiveState=active\n'
+        self.assertEqual(host.services_running(['b']), [True])
+        self.assertEqual(check_output.call_count, 3)
+
+    @patch('subprocess.call')
+    @patch.object(host, 'init_is_systemd')
+    @patch('subprocess.check_output')
+    def test_services_running_invalidated_by_service(self, check_output,
+                                                     systemd, call_):
+        self.addCleanup(host._services_running_cache.clear)
+        systemd.return_value = True
+        call_.return_value = 0
+        check_output.return_value = b'ActiveState=inactive\n'
+        self.assertEqual(host.services_running(['a']), [False])
+        host.service_start('a')
+        check_output.return_value = b'ActiveState=active\n'
+        self.assertEqual(host.services_running(['a']), [True])
+        self.assertEqual(check_output.call_count, 2)
+
+    @patch.object(host, 'service_running')
+    @patch.object(host, 'init_is_systemd')
+    @patch('subprocess.check_output')
+    def test_services_running_fallback(self, check_output, systemd,
+                                       service_running):
+        self.addCleanup(host._services_running_cache.clear)
+        service_running.side_effect = lambda name: name == 'a'
+        systemd.return_value = False
+        self.assertEqual(host.services_running(['a', 'b'], ttl=0),
+                         [True, False])
+        self.assertFalse(check_output.called)
+
+        # Unexpected systemctl output falls back to service_running()
+        systemd.return_value = True
+        check_output.return_value = b'ActiveState=inactive\n'
+        self.assertEqual(host.services_running(['a', 'b'], ttl=0),
+                         [True, False])
+        self.assertEqual(service_running.call_count, 4)
+
     @patch.object(host, 'os')
     @patch.object(host, 'service')
     @patch.object(host, 'init_is_systemd')
@@ -1285,7 +1346,7 @@ class HelpersTest(TestCase):
         m = md5()
         m.hexdigest.return_value = self._hash_files[filename]
         with patch_open() as (mock_open, mock_file):
-            mock_file.read.return_value = self._hash_files[filename]
+            mock_file.read.side_effect = [self._hash_files[filename], b'']
             result = host.file_hash(filename)
             self.assertEqual(result, self._hash_files[filename])
 
@@ -1306,7 +1367,7 @@ class HelpersTest(TestCase):
         m = sha1()
         m.hexdigest.return_value = self._hash_files[filename]
         with patch_open() as (mock_open, mock_file):
-            mock_file.read.return_value = self._hash_files[filename]
+            mock_file.read.side_effect = [self._hash_files[filename], b'']
             result = host.file_hash(filename, hash_type='sha1')
             self.assertEqual(result, self._hash_files[filename])
 
@@ -1321,6 +1382,47 @@ class HelpersTest(TestCase):
             call('file', 'sha256'),
         ])
 
+    def test_file_hashes_single_pass(self):
+        d = mkdtemp()
+        self.addCleanup(rmtree, d)
+        filename = os.path.join(d, 'archive')
+        content = b'x' * (host.HASH_BUFFER_SIZE * 2 + 1)
+        with open(filename, 'wb') as f:
+            f.write(content)
+        self.assertEqual(host.file_hashes(filename, ['md5', 'sha256']), {
+            'md5': hashlib.md5(content).hexdigest(),
+            'sha256': hashlib.sha256(content).hexdigest(),
+        })
+        self.assertEqual(host.file_hashes(os.path.join(d, 'missing')), None)
+
+    @patch.object(host, 'file_hashes')
+    def test_check_hashes(self, file_hashes):
+        file_hashes.return_value = {'md5': 'good-md5', 'sha1': 'good-sha1'}
+        host.check_hashes('file', {'md5': 'good-md5', 'sha1': 'good-sha1'})
+        self.assertRaises(host.ChecksumError, host.check_hashes,
+                          'file', {'md5': 'good-md5', 'sha1': 'bad-sha1'})
+        file_hashes.return_value = None
+        self.assertRaises(host.ChecksumError, host.check_hashes,
+                          'file', {'md5': 'good-md5'})
+        self.assertEqual(file_hashes.call_count, 3)
+
+    @patch.object(host, 'ThreadPool')
+    def test_path_hash_parallel(self, ThreadPool):
+        d = mkdtemp()
+        self.addCleanup(rmtree, d)
+        for name in ('a.conf', 'b.conf', 'c.conf'):
+            with open(os.path.join(d, name), 'w') as f:
+                f.write(name)
+        pattern = os.path.join(d, '*.conf')
+        ThreadPool.return_value.map.side_effect = lambda f, xs: list(map(f, xs))
+
+        hashes = host.path_hash(pattern)
+        ThreadPool.assert_called_once_with(3)
+        self.assertEqual(hashes, host.path_hash(pattern, workers=1))
+        self.assertEqual(ThreadPool.call_count, 1)
+        self.assertEqual(hashes[os.path.join(d, 'a.conf')],
+                         hashlib.md5(b'a.conf').hexdigest())
+
     @patch.object(host, 'service')
     @patch('os.path.exists')
     @patch('glob.iglob')
@@ -1353,7 +1455,7 @@ class HelpersTest(TestCase):
 
         @host.restart_on_change(restart_map)
         def make_some_changes(mock_file):
-            mock_file.read.return_value = b"newstuff"
+            mock_file.read.side_effect = [b"newstuff", b'']
 
         with patch_open() as (mock_open, mock_file):
             make_some_changes(mock_file)
@@ -1384,7 +1486,8 @@ class HelpersTest(TestCase):
             pass
 
         with patch_open() as (mock_open, mock_file):
-            mock_file.read.side_effect = [b'exists', b'missing', b'exists2']
+            mock_file.read.side_effect = [b'exists', b'', b'missing', b'',
+                                          b'exists2', b'']
             make_some_changes()
 
         # Restart should only happen once per service
@@ -1417,7 +1520,8 @@ class HelpersTest(TestCase):
             pass
 
         with patch_open() as (mock_open, mock_file):
-            mock_file.read.side_effect = [b'exists', b'missing', b'exists2']
+            mock_file.read.side_effect = [b'exists', b'', b'missing', b'',
+                                          b'exists2', b'']
             make_some_changes()
 
         # Restarts should happen in the order they are described in the
@@ -1447,8 +1551,8 @@ class HelpersTest(TestCase):
             pass
 
         with patch_open() as (mock_open, mock_file):
-            mock_file.read.side_effect = [b'content', b'content2',
-                                          b'content', b'content2']
+            mock_file.read.side_effect = [b'content', b'', b'content2', b'',
+                                          b'content', b'', b'content2', b'']
             make_some_changes()
 
         self.assertEquals([], service.call_args_list)
@@ -1472,8 +1576,8 @@ class HelpersTest(TestCase):
             pass
 
         with patch_open() as (mock_open, mock_file):
-            mock_file.read.side_effect = [b'content', b'content2',
-                                          b'changed', b'content2']
+            mock_file.read.side_effect = [b'content', b'', b'content2', b'',
+                                          b'changed', b'', b'content2', b'']
             make_some_changes()
 
         self.assertEquals([call('restart', 'service')], service.call_args_list)
@@ -1497,8 +1601,8 @@ class HelpersTest(TestCase):
             pass
 
         with patch_open() as (mock_open, mock_file):
-            mock_file.read.side_effect = [b'exists',
-                                          b'exists', b'created']
+            mock_file.read.side_effect = [b'exists', b'', b'exists', b'',
+                                          b'created', b'']
             make_some_changes()
 
         self.assertEquals([call('restart', 'service')], service.call_args_list)
@@ -1522,8 +1626,8 @@ class HelpersTest(TestCase):
             pass
 
         with patch_open() as (mock_open, mock_file):
-            mock_file.read.side_effect = [b'exists', b'exists2',
-                                          b'exists2']
+            mock_file.read.side_effect = [b'exists', b'', b'exists2', b'',
+                                          b'exists2', b'']
             make_some_changes()
 
         self.assertEquals([call('restart', 'service')], service.call_args_list)
@@ -1553,12 +1657,164 @@ class HelpersTest(TestCase):
             pass
 
         with patch_open() as (mock_open, mock_file):
-            mock_file.read.side_effect = [b'exists', b'missing', b'exists2']
+            mock_file.read.side_effect = [b'exists', b'', b'missing', b'',
+                                          b'exists2', b'']
             make_some_changes()
 
         self.assertEquals([call('restart', 'haproxy')], service.call_args_list)
         self.assertEquals([call('some-api')], service_reload.call_args_list)
 
+    def _write_files(self, directory, contents):
+        for name, content in contents.items():
+            with open(os.path.join(directory, name), 'w') as f:
+                f.write(content)
+
+    @patch.object(host, 'SNAPSHOT_RACY_SECONDS', 0)
+    def test_path_snapshot_reuses_digests(self):
+        d = mkdtemp()
+        self.addCleanup(rmtree, d)
+        self._write_files(d, {'a.conf': 'a', 'b.conf': 'b'})
+        pattern = os.path.join(d, '*.conf')
+
+        first = host.path_snapshot(pattern)
+        self.assertEqual(host._snapshot_digests(first),
+                         host.path_hash(pattern))
+        with patch.object(host, 'file_hash') as file_hash:
+            file_hash.return_value = 'changed'
+            self._write_files(d, {'b.conf': 'B', 'c.conf': 'c'})
+            second = host.path_snapshot(pattern, first)
+        self.assertEqual(sorted(file_hash.call_args_list),
+                         [call(os.path.join(d, 'b.conf')),
+                          call(os.path.join(d, 'c.conf'))])
+        self.assertEqual(second[os.path.join(d, 'a.conf')],
+                         first[os.path.join(d, 'a.conf')])
+
+    def test_path_snapshot_rehashes_recent_files(self):
+        d = mkdtemp()
+        self.addCleanup(rmtree, d)
+        self._write_files(d, {'a.conf': 'a'})
+        pattern = os.path.join(d, '*.conf')
+        first = host.path_snapshot(pattern)
+        self.assertEqual(first[os.path.join(d, 'a.conf')][:-1], [None] * 4)
+        self._write_files(d, {'a.conf': 'b'})
+        second = host.path_snapshot(pattern, first)
+        self.assertNotEqual(host._snapshot_digests(first),
+                            host._snapshot_digests(second))
+
+    @patch.object(host, 'SNAPSHOT_RACY_SECONDS', 0)
+    @patch.object(host, 'service')
+    def test_restart_on_change_persist_snapshots(self, service):
+        from charmhelpers.core import unitdata
+        d = mkdtemp()
+        self.addCleanup(rmtree, d)
+        self._write_files(d, {'a.conf': 'a', 'b.conf': 'b'})
+        restart_map = {os.path.join(d, '*.conf'): ['svc']}
+        kv = unitdata.Storage(':memory:')
+
+        @host.restart_on_change(restart_map, persist_snapshots=True)
+        def write(contents):
+            self._write_files(d, contents)
+
+        with patch.object(unitdata, 'kv', lambda: kv):
+            write({'a.conf': 'a'})
+            self.assertEqual(service.call_args_list, [])
+            with patch.object(host, 'file_hash') as file_hash:
+                write({})
+            self.assertFalse(file_hash.called)
+            write({'b.conf': 'B'})
+            self.assertEqual(service.call_args_list, [call('restart', 'svc')])
+        self.assertEqual(
+            sorted(kv.get(host.SNAPSHOTS_KEY)[os.path.join(d, '*.conf')]),
+            [os.path.join(d, 'a.conf'), os.path.join(d, 'b.conf')])
+
+    @patch('subprocess.call')
+    @patch.object(host, 'init_is_systemd')
+    def test_service_many(self, systemd, call_):
+        call_.return_value = 0
+        systemd.return_value = True
+        self.assertTrue(host.service_many('restart', ['a', 'b']))
+        systemd.return_value = False
+        self.assertTrue(host.service_many('restart', ['a', 'b']))
+        self.assertTrue(host.service_many('restart', []))
+        self.assertEqual(call_.call_args_list, [
+            call(['systemctl', 'restart', 'a', 'b']),
+            call(['service', 'a', 'restart']),
+            call(['service', 'b', 'restart']),
+        ])
+
+    @patch.object(host, 'service')
+    @patch.object(host, 'init_is_systemd')
+    def test_restart_services_in_graph_order(self, systemd, service):
+        systemd.return_value = False
+        restart_graph = {'api': ['db', 'mq'], 'worker': ['mq'],
+                         'mq': ['not-restarted']}
+        host.restart_services(['api', 'worker', 'mq', 'db'],
+                              restart_graph=restart_graph)
+        self.assertEqual(service.call_args_list, [
+            call('restart', 'mq'),
+            call('restart', 'db'),
+            call('restart', 'api'),
+            call('restart', 'worker'),
+        ])
+
+    @patch.object(host, 'service_many')
+    @patch.object(host, 'init_is_systemd')
+    def test_restart_services_stopstart_batched(self, systemd, service_many):
+        systemd.return_value = True
+        restart = MagicMock()
+        host.restart_services(['api', 'db', 'custom'], stopstart=True,
+                              restart_functions={'custom': restart},
+                              restart_graph={'api': ['db']})
+        self.assertEqual(service_many.call_args_list, [
+            call('stop', ['api']),
+            call('stop', ['db']),
+            call('start', ['db']),
+            call('start', ['api']),
+        ])
+        restart.assert_called_once_with('custom')
+
+    @patch.object(host, 'ThreadPool')
+    @patch.object(host, 'service')
+    @patch.object(host, 'init_is_systemd')
+    def test_restart_services_concurrently(self, systemd, service,
+                                           ThreadPool):
+        systemd.return_value = False
+        ThreadPool.return_value.map.side_effect = (
+            lambda f, xs: [f(x) for x in xs])
+        host.restart_services(['a', 'b', 'c'], workers=8)
+        ThreadPool.assert_called_once_with(3)
+        self.assertEqual(sorted(service.call_args_list), [
+            call('restart', 'a'),
+            call('restart', 'b'),
+            call('restart', 'c'),
+        ])
+
+    def test_restart_services_circular_graph(self):
+        self.assertRaises(ValueError, host.restart_services, ['a', 'b'],
+                          restart_graph={'a': ['b'], 'b': ['a']})
+
+    @patch.object(host, 'SNAPSHOT_RACY_SECONDS', 0)
+    @patch.object(host, 'restart_services')
+    @patch.object(host, 'service')
+    def test_restart_on_change_restart_workers(self, service,
+                                               restart_services):
+        d = mkdtemp()
+        self.addCleanup(rmtree, d)
+        restart_map = OrderedDict([
+            (os.path.join(d, 'a.conf'), ['api', 'db']),
+            (os.path.join(d, 'b.conf'), ['db', 'mq']),
+        ])
+
+        @host.restart_on_change(restart_map, restart_workers=4,
+                                restart_graph={'api': ['db']})
+        def write():
+            self._write_files(d, {'a.conf': 'a', 'b.conf': 'b'})
+
+        write()
+        self.assertFalse(service.called)
+        restart_services.assert_called_once_with(
+            ['api', 'db', 'mq'], False, {}, 4, {'api': ['db']})
+
     @patch.object(osplatform, 'get_platform')
     def test_lsb_release_ubuntu(self, platform):
         platform.return_value = 'ubuntu'
@@ -21,6 +21,13 @@ class TestTemplating(unittest.TestCase):
                                                   'charm_dir')
         self._charm_dir_mock = self._charm_dir_patch.start()
         self._charm_dir_mock.side_effect = lambda: self.charm_dir
+        # keep compiled templates out of the source tree
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+        cache_dir_patch = mock.patch.object(templating, 'TEMPLATE_CACHE_DIR',
+                                            self.cache_dir)
+        cache_dir_patch.start()
+        self.addCleanup(cache_dir_patch.stop)
 
     def tearDown(self):
         self._charm_dir_patch.stop()
@@ -154,9 +161,67 @@ class TestTemplating(unittest.TestCase):
         finally:
             shutil.rmtree(tmpdir, ignore_errors=True)
 
+    def test_bytecode_cache(self):
+        cache = templating.bytecode_cache()
+        self.assertEqual(cache.directory,
+                         os.path.join(self.cache_dir, jinja2.__version__))
+        env = templating.get_environment(jinja2.FileSystemLoader(
+            TEMPLATES_DIR))
+        self.assertEqual(env.bytecode_cache.directory, cache.directory)
+        env.get_template('test.conf')
+        self.assertEqual(len(os.listdir(cache.directory)), 1)
+
+        # compiled templates are reused by other environments
+        env = templating.get_environment(jinja2.FileSystemLoader(
+            TEMPLATES_DIR))
+        with mock.patch.object(env, 'compile') as compile:
+            self.assertIn('listen 80', env.get_template('test.conf').render(
+                nginx_port=80))
+            self.assertFalse(compile.called)
+
+    def test_bytecode_cache_without_charm_dir(self):
+        self.charm_dir = None
+        self.assertEqual(templating.bytecode_cache(), None)
+        env = templating.get_environment(jinja2.FileSystemLoader(
+            TEMPLATES_DIR))
+        self.assertEqual(env.bytecode_cache, None)
+
+    def test_render_loads_cached_bytecode(self):
+        """render() compiles a template once and reuses it in later calls,
+        until its source changes."""
+        templates = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, templates)
+        source = os.path.join(templates, 'large.conf')
+        with open(source, 'w') as f:
+            for i in range(50):
+                f.write('{%% if option%d %%}option%d = {{ option%d }}\n'
+                        '{%% endif %%}' % (i, i, i))
+        context = dict(('option%d' % i, i) for i in range(0, 50, 2))
+
+        compile_ = jinja2.Environment.compile
+        with mock.patch.object(jinja2.Environment, 'compile', autospec=True,
+                               side_effect=compile_) as compile:
+            cold = templating.render('large.conf', None, context,
+                                     templates_dir=templates)
+            self.assertEqual(compile.call_count, 1)
+            warm = templating.render('large.conf', None, context,
+                                     templates_dir=templates)
+            self.assertEqual(warm, cold)
+            self.assertEqual(compile.call_count, 1)
+
+            with open(source, 'a') as f:
+                f.write('end\n')
+            # the cache is keyed on the source, so it is compiled again
+            self.assertEqual(templating.render('large.conf', None, context,
+                                               templates_dir=templates),
+                             cold + 'end')
+            self.assertEqual(compile.call_count, 2)
+        self.assertIn('option48 = 48', cold)
+
     @mock.patch.object(templating, 'hookenv')
     @mock.patch('jinja2.Environment')
     def test_load_error(self, Env, hookenv):
+        hookenv.charm_dir.return_value = None
         Env().get_template.side_effect = jinja2.exceptions.TemplateNotFound(
             'fake_cc.yml')
         self.assertRaises(
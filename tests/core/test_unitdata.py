@@ -10,12 +10,15 @@ try:
 except Exception:
     from io import StringIO
 
+import json
 import os
 import shutil
 import tempfile
+import time
 import unittest
 
-from mock import patch
+from mock import MagicMock, patch
+import nose.plugins.attrib
 
 from charmhelpers.core.unitdata import Storage, HookData, kv
 
@@ -223,6 +226,239 @@ class StorageTest(unittest.TestCase):
         kv.flush(False)
         self.assertEqual(kv.get('hello'), 'world')
 
+    def test_set_many(self):
+        kv = Storage(':memory:')
+        with kv.hook_scope('install'):
+            kv.set_many({'a': 1, 'b': [1, 2], 'c': None})
+            self.assertEqual(kv.get('b'), [1, 2])
+        with kv.hook_scope('config-changed'):
+            kv.set_many({'a': 1, 'b': [2]})
+        self.assertEqual(kv.getrange(''), {'a': 1, 'b': [2], 'c': None})
+        self.assertEqual([h[:-1] for h in kv.gethistory('a')],
+                         [(1, 'a', '1', 'install')])
+        self.assertEqual([h[:-1] for h in kv.gethistory('b')],
+                         [(1, 'b', '[1, 2]', 'install'),
+                          (2, 'b', '[2]', 'config-changed')])
+
+    def test_set_many_exceeds_variable_limit(self):
+        kv = Storage(':memory:')
+        kv.set_many(dict(('k%d' % i, i) for i in range(2500)))
+        kv.update(dict(('k%d' % i, -i) for i in range(2500)))
+        kv.flush()
+        result = kv.getrange('k')
+        self.assertEqual(len(result), 2500)
+        self.assertEqual(result['k1234'], -1234)
+
+    def test_pending_writes_visible_before_flush(self):
+        kv = Storage(':memory:')
+        kv.set('a', {'x': 1})
+        self.assertEqual(kv.get('a'), {'x': 1})
+        self.assertEqual(kv.get('a', record=True).x, 1)
+        self.assertEqual(kv.getrange('a'), {'a': {'x': 1}})
+        kv.set('b', 2)
+        kv.unset('b')
+        self.assertEqual(kv.get('b'), None)
+
+    def test_pending_writes_discarded_on_rollback(self):
+        kv = Storage(':memory:')
+        kv.set('a', 1)
+        kv.flush()
+        kv.set('a', 2)
+        kv.set('b', 3)
+        kv.flush(False)
+        self.assertEqual(kv.get('a'), 1)
+        self.assertEqual(kv.get('b'), None)
+
+    def test_revision_writes_collapsed(self):
+        kv = Storage(':memory:')
+        with kv.hook_scope('install'):
+            for i in range(10):
+                kv.set('a', i)
+        self.assertEqual([h[:-1] for h in kv.gethistory('a')],
+                         [(1, 'a', '9', 'install')])
+
+    def test_getrange_matches_prefix_exactly(self):
+        kv = Storage(':memory:')
+        kv.update({'v_a': 1, 'vxa': 2, 'V_b': 3, 'v_': 4, 'v`': 5, 'w': 6})
+        self.assertEqual(kv.getrange('v_'), {'v_a': 1, 'v_': 4})
+        kv.unsetrange(prefix='v_')
+        self.assertEqual(kv.getrange('v'), {'vxa': 2, 'v`': 5})
+        self.assertEqual(kv.get('V_b'), 3)
+        self.assertEqual(len(kv.getrange('')), 4)
+
+    def test_reads_cached(self):
+        kv = Storage(':memory:')
+        kv.update({'a': 1, 'b': 'x'}, prefix='config.')
+        kv.set('other', [1])
+        kv.flush()
+        kv.cursor = MagicMock(wraps=kv.cursor)
+        self.assertEqual(kv.getrange('config.', True), {'a': 1, 'b': 'x'})
+        self.assertEqual(kv.cursor.execute.call_count, 1)
+        self.assertEqual(kv.getrange('config.'),
+                         {'config.a': 1, 'config.b': 'x'})
+        self.assertEqual(kv.getrange('config.a'), {'config.a': 1})
+        self.assertEqual(kv.get('config.b'), 'x')
+        self.assertEqual(kv.get('config.missing'), None)
+        self.assertEqual(kv.delta({'a': 2, 'b': 'x'}, 'config.'),
+                         {'a': (1, 2)})
+        self.assertEqual(kv.cursor.execute.call_count, 1)
+        self.assertEqual(kv.get('other'), [1])
+        self.assertEqual(kv.get('other'), [1])
+        self.assertEqual(kv.get('nothing'), None)
+        self.assertEqual(kv.get('nothing'), None)
+        self.assertEqual(kv.cursor.execute.call_count, 2)
+
+    def test_cached_containers_not_shared(self):
+        kv = Storage(':memory:')
+        kv.set('a', {'x': [1]})
+        kv.flush()
+        kv.get('a')['x'].append(2)
+        self.assertEqual(kv.get('a'), {'x': [1]})
+        kv.getrange('a')['a']['y'] = 1
+        self.assertEqual(kv.getrange('a'), {'a': {'x': [1]}})
+
+    def test_cache_coherent_with_writes(self):
+        kv = Storage(':memory:')
+        kv.update({'a': 1, 'b': 2}, prefix='x.')
+        self.assertEqual(kv.getrange('x.', True), {'a': 1, 'b': 2})
+        kv.set('x.c', 3)
+        kv.set('x.a', 0)
+        self.assertEqual(kv.getrange('x.', True), {'a': 0, 'b': 2, 'c': 3})
+        kv.unset('x.b')
+        self.assertEqual(kv.getrange('x.', True), {'a': 0, 'c': 3})
+        self.assertEqual(kv.get('x.b'), None)
+        kv.unsetrange(['a'], prefix='x.')
+        self.assertEqual(kv.getrange('x.', True), {'c': 3})
+        kv.unsetrange(prefix='x.')
+        self.assertEqual(kv.getrange('x.'), {})
+        self.assertEqual(kv.get('x.c'), None)
+
+    def test_cache_reset_on_rollback(self):
+        kv = Storage(':memory:')
+        kv.update({'a': 1, 'b': 2})
+        kv.flush()
+        self.assertEqual(kv.getrange(''), {'a': 1, 'b': 2})
+        kv.set('c', 3)
+        kv.unset('a')
+        self.assertEqual(kv.getrange(''), {'b': 2, 'c': 3})
+        kv.flush(False)
+        self.assertEqual(kv.getrange(''), {'a': 1, 'b': 2})
+        self.assertEqual(kv.get('a'), 1)
+
+    def test_journal_mode(self):
+        with tempfile.NamedTemporaryFile() as fh:
+            kv = Storage(fh.name, journal_mode='wal')
+            kv.cursor.execute('pragma journal_mode')
+            self.assertEqual(kv.cursor.fetchone()[0], 'wal')
+            kv.cursor.execute('pragma synchronous')
+            self.assertEqual(kv.cursor.fetchone()[0], 1)
+            with kv.hook_scope('install'):
+                kv.set('a', 1)
+            kv.close()
+
+            with patch.dict('os.environ', {'UNIT_STATE_DB_SYNCHRONOUS': 'off'}):
+                kv = Storage(fh.name)
+            kv.cursor.execute('pragma journal_mode')
+            self.assertEqual(kv.cursor.fetchone()[0], 'wal')
+            kv.cursor.execute('pragma synchronous')
+            self.assertEqual(kv.cursor.fetchone()[0], 0)
+            self.assertEqual(kv.get('a'), 1)
+            kv.close()
+
+    def test_journal_mode_invalid(self):
+        self.assertRaises(ValueError, Storage, ':memory:',
+                          journal_mode='wal; drop table kv')
+        with patch.dict('os.environ', {'UNIT_STATE_DB_SYNCHRONOUS': 'x'}):
+            self.assertRaises(ValueError, Storage, ':memory:')
+
+    def _history(self, kv, key):
+        return [h[:-1] for h in kv.gethistory(key)]
+
+    def test_compact_keep_revisions(self):
+        kv = Storage(':memory:')
+        for i in range(5):
+            with kv.hook_scope('hook-%d' % i):
+                kv.set('a', i)
+                if i < 2:
+                    kv.set('b', i)
+        self.assertEqual(kv.compact(keep_revisions=2), 3)
+        self.assertEqual(self._history(kv, 'a'),
+                         [(4, 'a', '3', 'hook-3'), (5, 'a', '4', 'hook-4')])
+        self.assertEqual(self._history(kv, 'b'),
+                         [(1, 'b', '0', 'hook-0'), (2, 'b', '1', 'hook-1')])
+        self.assertEqual(kv.compact(keep_revisions=0), 4)
+        self.assertEqual(self._history(kv, 'a'), [])
+        self.assertEqual(kv.get('a'), 4)
+
+    def test_compact_keep_days(self):
+        kv = Storage(':memory:')
+        with kv.hook_scope('install'):
+            kv.set('a', 1)
+        kv.cursor.execute("update hooks set date = '2015-01-21T16:49:30'")
+        with kv.hook_scope('config-changed'):
+            kv.set('a', 2)
+        self.assertEqual(kv.compact(keep_days=30, vacuum=True), 1)
+        self.assertEqual(self._history(kv, 'a'),
+                         [(2, 'a', '2', 'config-changed')])
+        kv.cursor.execute('select hook from hooks')
+        self.assertEqual(kv.cursor.fetchall(), [('config-changed',)])
+
+    @nose.plugins.attrib.attr('slow')
+    def test_compact_benchmark(self):
+        """Time compacting a database with 100k revisions."""
+        keys, hooks = 1000, 100
+        with tempfile.NamedTemporaryFile() as fh:
+            kv = Storage(fh.name, journal_mode='wal')
+            kv.cursor.executemany(
+                'insert into hooks (hook, date) values (?, ?)',
+                [('update-status', '2015-01-21T16:49:30.038372')] * hooks)
+            kv.cursor.executemany(
+                'insert into kv_revisions values (?, ?, ?)',
+                [('key.%d' % k, h, json.dumps({'hook': h}))
+                 for k in range(keys) for h in range(1, hooks + 1)])
+            kv.flush()
+            size = os.path.getsize(fh.name)
+
+            before = time.time()
+            removed = kv.compact(keep_revisions=5, vacuum=True)
+            duration = time.time() - before
+            self.assertEqual(removed, keys * (hooks - 5))
+            self.assertEqual(len(kv.gethistory('key.1')), 5)
+            print('compacted %d revisions in %.3fs, %d -> %d bytes' % (
+                keys * hooks, duration, size, os.path.getsize(fh.name)))
+
+            before = time.time()
+            for i in range(100):
+                with kv.hook_scope('update-status'):
+                    kv.set('key.1', i)
+            print('100 hook scopes in wal mode: %.3fs' % (time.time() - before))
+            kv.close()
+
+    @nose.plugins.attrib.attr('slow')
+    def test_write_benchmark(self):
+        """Time writing 10k keys with and without a hook scope."""
+        count = 10000
+        data = dict(('key.%d' % i, {'value': i}) for i in range(count))
+        for scoped in (False, True):
+            with tempfile.NamedTemporaryFile() as fh:
+                kv = Storage(fh.name)
+                before = time.time()
+                if scoped:
+                    with kv.hook_scope('benchmark'):
+                        for k, v in data.items():
+                            kv.set(k, v)
+                else:
+                    for k, v in data.items():
+                        kv.set(k, v)
+                    kv.flush()
+                duration = time.time() - before
+                kv.close()
+                kv = Storage(fh.name)
+                self.assertEqual(len(kv.getrange('key.')), count)
+                kv.close()
+            print('%d keys %s hook scope: %.3fs' % (
+                count, 'with' if scoped else 'without', duration))
+
 
 if __name__ == '__main__':
     unittest.main()
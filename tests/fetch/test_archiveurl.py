@@ -1,19 +1,29 @@
+import hashlib
+import json
 import os
+import threading
+import time
+from shutil import rmtree
+from tempfile import mkdtemp
 
 from unittest import TestCase
+import nose.plugins.attrib
 from mock import (
     MagicMock,
     patch,
-    mock_open,
     Mock,
     ANY
 )
+from charmhelpers import fetch
 from charmhelpers.fetch import (
     archiveurl,
     UnhandledSource,
 )
+from charmhelpers.fetch import cache as fetch_cache
+from charmhelpers.core.host import ChecksumError
 
 import six
+from six.moves import BaseHTTPServer, socketserver
 if six.PY3:
     from urllib.parse import urlparse
     from urllib.error import URLError
@@ -22,6 +32,51 @@ else:
     from urlparse import urlparse
 
 
+class ThreadingHTTPServer(socketserver.ThreadingMixIn,
+                          BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 32
+
+
+class RangeRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves server.content to any GET request, honouring Range headers
+    when server.honour_range is set and conditional requests when
+    server.etag is set. A Range is ignored when an If-Range header does
+    not match server.etag."""
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        content = self.server.content
+        header = self.headers.get('Range')
+        self.server.ranges.append(header)
+        etag = self.server.etag
+        if etag and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        start = 0
+        if_range = self.headers.get('If-Range')
+        if header and self.server.honour_range and if_range in (None, etag):
+            start = int(header.split('=')[1].rstrip('-'))
+            if start >= len(content):
+                self.send_response(416)
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (
+                start, len(content) - 1, len(content)))
+        else:
+            self.send_response(200)
+        if etag:
+            self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(content) - start))
+        self.end_headers()
+        self.wfile.write(content[start:])
+
+    def log_message(self, *args):
+        pass
+
+
 class ArchiveUrlFetchHandlerTest(TestCase):
 
     def setUp(self):
@@ -59,25 +114,51 @@ class ArchiveUrlFetchHandlerTest(TestCase):
 
     @patch('charmhelpers.fetch.archiveurl.urlopen')
     def test_downloads(self, _urlopen):
+        d = mkdtemp()
+        self.addCleanup(rmtree, d)
+        dest = os.path.join(d, 'foo')
         for url in self.valid_urls:
             response = MagicMock()
-            response.read.return_value = "bar"
+            response.read.side_effect = [b'bar', b'']
+            response.info.return_value = {}
             _urlopen.return_value = response
 
-            _open = mock_open()
-            with patch('charmhelpers.fetch.archiveurl.open',
-                       _open, create=True):
-                self.fh.download(url, "foo")
+            digests = self.fh.download(url, dest, hash_types=['md5'])
 
-            response.read.assert_called_with()
-            _open.assert_called_once_with("foo", 'wb')
-            _open().write.assert_called_with("bar")
+            response.read.assert_called_with(archiveurl.DOWNLOAD_CHUNK_SIZE)
+            self.assertEqual(digests, {'md5': hashlib.md5(b'bar').hexdigest()})
+            with open(dest, 'rb') as f:
+                self.assertEqual(f.read(), b'bar')
+            self.assertFalse(os.path.exists(dest + archiveurl.PARTIAL_SUFFIX))
+
+    @patch('charmhelpers.fetch.archiveurl.urlopen')
+    def test_download_failure_keeps_resumable_partial(self, _urlopen):
+        d = mkdtemp()
+        self.addCleanup(rmtree, d)
+        dest = os.path.join(d, 'foo')
+        partial = dest + archiveurl.PARTIAL_SUFFIX
+        for url, resumable in (("http://example.com/foo.tgz", True),
+                               ("file://example.com/foo.tgz", False)):
+            response = MagicMock()
+            response.read.side_effect = [b'bar', IOError('reset')]
+            response.info.return_value = {'ETag': '"v1"'}
+            _urlopen.return_value = response
+            self.assertRaises(IOError, self.fh.download, url, dest)
+            self.assertFalse(os.path.exists(dest))
+            self.assertEqual(os.path.exists(partial), resumable)
+            if resumable:
+                with open(partial, 'rb') as f:
+                    self.assertEqual(f.read(), b'bar')
+                with open(partial + archiveurl.PARTIAL_INFO_SUFFIX) as f:
+                    self.assertEqual(json.load(f), {
+                        'url': url, 'etag': '"v1"', 'last_modified': None})
+                os.unlink(partial)
 
-    @patch('charmhelpers.fetch.archiveurl.check_hash')
     @patch('charmhelpers.fetch.archiveurl.mkdir')
     @patch('charmhelpers.fetch.archiveurl.extract')
-    def test_installs(self, _extract, _mkdir, _check_hash):
+    def test_installs(self, _extract, _mkdir):
         self.fh.download = MagicMock()
+        self.fh.download.return_value = {'sha1': 'deadbeef'}
 
         for url in self.valid_urls:
             filename = urlparse(url).path
@@ -85,11 +166,10 @@ class ArchiveUrlFetchHandlerTest(TestCase):
             _extract.return_value = dest
             with patch.dict('os.environ', {'CHARM_DIR': 'foo'}):
                 where = self.fh.install(url, checksum='deadbeef')
-            self.fh.download.assert_called_with(url, dest)
+            self.fh.download.assert_called_with(url, dest,
+                                                hash_types=['sha1'])
             _extract.assert_called_with(dest, None)
-            _check_hash.assert_called_with(dest, 'deadbeef', 'sha1')
             self.assertEqual(where, dest)
-            _check_hash.reset_mock()
 
         url = "http://www.example.com/archive.tar.gz"
 
@@ -101,15 +181,41 @@ class ArchiveUrlFetchHandlerTest(TestCase):
         with patch.dict('os.environ', {'CHARM_DIR': 'foo'}):
             self.assertRaises(UnhandledSource, self.fh.install, url)
 
-    @patch('charmhelpers.fetch.archiveurl.check_hash')
     @patch('charmhelpers.fetch.archiveurl.mkdir')
     @patch('charmhelpers.fetch.archiveurl.extract')
-    def test_install_with_hash_in_url(self, _extract, _mkdir, _check_hash):
+    def test_install_with_hash_in_url(self, _extract, _mkdir):
         self.fh.download = MagicMock()
+        self.fh.download.return_value = {'sha512': 'beefdead'}
         url = "file://example.com/foo.tar.bz2#sha512=beefdead"
         with patch.dict('os.environ', {'CHARM_DIR': 'foo'}):
             self.fh.install(url)
-        _check_hash.assert_called_with(ANY, 'beefdead', 'sha512')
+        self.fh.download.assert_called_with(url, ANY, hash_types=['sha512'])
+
+        self.fh.download.return_value = {'sha512': 'deadbeef'}
+        with patch.dict('os.environ', {'CHARM_DIR': 'foo'}):
+            self.assertRaises(ChecksumError, self.fh.install, url)
+
+    @patch('charmhelpers.fetch.archiveurl.mkdir')
+    @patch('charmhelpers.fetch.archiveurl.extract')
+    def test_install_with_several_hashes(self, _extract, _mkdir):
+        self.fh.download = MagicMock()
+        self.fh.download.return_value = {
+            'sha512': 'beefdead', 'md5': 'cafe', 'sha256': 'deadbeef'}
+        url = "file://example.com/foo.tar.bz2#sha512=beefdead&md5=cafe"
+        with patch.dict('os.environ', {'CHARM_DIR': 'foo'}):
+            self.fh.install(url, checksum='deadbeef', hash_type='sha256')
+        self.fh.download.assert_called_once_with(
+            url, ANY, hash_types=['md5', 'sha256', 'sha512'])
+
+    @patch('charmhelpers.fetch.archiveurl.mkdir')
+    @patch('charmhelpers.fetch.archiveurl.extract')
+    def test_install_with_conflicting_hashes(self, _extract, _mkdir):
+        self.fh.download = MagicMock()
+        url = "file://example.com/foo.tar.bz2#sha1=beefdead"
+        with patch.dict('os.environ', {'CHARM_DIR': 'foo'}):
+            self.assertRaises(ChecksumError, self.fh.install, url,
+                              checksum='deadbeef')
+        self.assertFalse(self.fh.download.called)
 
     @patch('charmhelpers.fetch.archiveurl.mkdir')
     @patch('charmhelpers.fetch.archiveurl.extract')
@@ -129,3 +235,201 @@ class ArchiveUrlFetchHandlerTest(TestCase):
         dlhash = '988881adc9fc3655077dc2d4d757d480b5ea0e11'
         self.fh.download_and_validate(dlurl, dlhash)
         vfmock.assert_called_with('/tmp/tmpebM9Hv', dlhash, 'sha1')
+
+
+class ArchiveUrlDownloadTest(TestCase):
+
+    def setUp(self):
+        super(ArchiveUrlDownloadTest, self).setUp()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0),
+                                          RangeRequestHandler)
+        self.server.content = os.urandom(archiveurl.DOWNLOAD_CHUNK_SIZE * 3 + 5)
+        self.server.honour_range = True
+        self.server.etag = None
+        self.server.latency = 0
+        self.server.ranges = []
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  kwargs={'poll_interval': 0.05})
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = 'http://127.0.0.1:%d/foo.tgz' % self.server.server_port
+        d = mkdtemp()
+        self.addCleanup(rmtree, d)
+        self.dest = os.path.join(d, 'foo.tgz')
+        self.partial = self.dest + archiveurl.PARTIAL_SUFFIX
+        self.partial_info = self.partial + archiveurl.PARTIAL_INFO_SUFFIX
+        self.fh = archiveurl.ArchiveUrlFetchHandler()
+
+    def assertDownloaded(self, digests):
+        content = self.server.content
+        self.assertEqual(digests, {
+            'md5': hashlib.md5(content).hexdigest(),
+            'sha256': hashlib.sha256(content).hexdigest(),
+        })
+        with open(self.dest, 'rb') as f:
+            self.assertEqual(f.read(), content)
+        self.assertFalse(os.path.exists(self.partial))
+        self.assertFalse(os.path.exists(self.partial_info))
+
+    def write_partial(self, data, url=None, etag='"v1"'):
+        with open(self.partial, 'wb') as f:
+            f.write(data)
+        with open(self.partial_info, 'w') as f:
+            json.dump({'url': url or self.url, 'etag': etag,
+                       'last_modified': None}, f)
+
+    def test_download(self):
+        self.assertDownloaded(
+            self.fh.download(self.url, self.dest, ['md5', 'sha256']))
+        self.assertEqual(self.server.ranges, [None])
+
+    def test_download_resumes_partial(self):
+        self.server.etag = '"v1"'
+        self.write_partial(self.server.content[:1000])
+        self.assertDownloaded(
+            self.fh.download(self.url, self.dest, ['md5', 'sha256']))
+        self.assertEqual(self.server.ranges, ['bytes=1000-'])
+
+    def test_download_restarts_changed_file(self):
+        self.server.etag = '"v2"'
+        self.server.content = b'NEWVERSION-0123456789'
+        self.write_partial(b'OLDVERSION', etag='"v1"')
+        self.assertDownloaded(
+            self.fh.download(self.url, self.dest, ['md5', 'sha256']))
+        self.assertEqual(self.server.ranges, ['bytes=10-'])
+
+    def test_download_discards_partial_of_other_url(self):
+        self.server.etag = '"v1"'
+        self.write_partial(b'OLDVERSION',
+                           url=self.url.replace('foo.tgz', 'v1/foo.tgz'))
+        self.assertDownloaded(
+            self.fh.download(self.url, self.dest, ['md5', 'sha256']))
+        self.assertEqual(self.server.ranges, [None])
+
+    def test_download_discards_partial_without_validator(self):
+        for etag in (None, 'W/"v1"'):
+            self.write_partial(b'OLDVERSION', etag=etag)
+            self.assertDownloaded(
+                self.fh.download(self.url, self.dest, ['md5', 'sha256']))
+        # A partial file without its info.
+        with open(self.partial, 'wb') as f:
+            f.write(b'OLDVERSION')
+        self.assertDownloaded(
+            self.fh.download(self.url, self.dest, ['md5', 'sha256']))
+        self.assertEqual(self.server.ranges, [None, None, None])
+
+    def test_download_range_ignored(self):
+        self.server.honour_range = False
+        self.write_partial(b'stale')
+        self.assertDownloaded(
+            self.fh.download(self.url, self.dest, ['md5', 'sha256']))
+        self.assertEqual(self.server.ranges, ['bytes=5-'])
+
+    def test_download_range_not_satisfiable(self):
+        self.server.etag = '"v1"'
+        self.write_partial(self.server.content + b'stale')
+        self.assertDownloaded(
+            self.fh.download(self.url, self.dest, ['md5', 'sha256']))
+        self.assertEqual(self.server.ranges, [
+            'bytes=%d-' % (len(self.server.content) + 5), None])
+
+    @patch('charmhelpers.fetch.archiveurl.extract')
+    def test_install_validates_while_downloading(self, _extract):
+        md5 = hashlib.md5(self.server.content).hexdigest()
+        charm_dir = os.path.dirname(self.dest)
+        os.mkdir(os.path.join(charm_dir, 'fetched'))
+        with patch.dict('os.environ', {'CHARM_DIR': charm_dir}):
+            with patch.object(archiveurl, 'check_hash') as check_hash:
+                self.fh.install(self.url + '#md5=' + md5)
+                self.assertRaises(ChecksumError, self.fh.install,
+                                  self.url + '#md5=deadbeef')
+        self.assertFalse(check_hash.called)
+        _extract.assert_called_with(
+            os.path.join(charm_dir, 'fetched', 'foo.tgz'), None)
+
+    def test_download_revalidates_cached_file(self):
+        self.server.etag = '"v1"'
+        cache = fetch_cache.enable_fetch_cache(mkdtemp())
+        self.addCleanup(rmtree, cache.path)
+        self.addCleanup(fetch_cache.disable_fetch_cache)
+
+        self.assertDownloaded(
+            self.fh.download(self.url, self.dest, ['md5', 'sha256']))
+        os.unlink(self.dest)
+        self.assertDownloaded(
+            self.fh.download(self.url, self.dest, ['md5', 'sha256']))
+        # The second download was answered with a 304 and linked from the
+        # cache rather than written from the response.
+        self.assertEqual(len(self.server.ranges), 2)
+        self.assertTrue(os.path.samefile(self.dest,
+                                         cache.lookup_url(self.url)))
+
+        # A modified file is downloaded again.
+        self.server.etag = '"v2"'
+        self.server.content = b'modified'
+        self.assertDownloaded(
+            self.fh.download(self.url, self.dest, ['md5', 'sha256']))
+
+    @patch('charmhelpers.fetch.archiveurl.extract')
+    def test_install_from_cache(self, _extract):
+        cache = fetch_cache.enable_fetch_cache(mkdtemp())
+        self.addCleanup(rmtree, cache.path)
+        self.addCleanup(fetch_cache.disable_fetch_cache)
+        sha256 = hashlib.sha256(self.server.content).hexdigest()
+        charm_dir = os.path.dirname(self.dest)
+        os.mkdir(os.path.join(charm_dir, 'fetched'))
+        with patch.dict('os.environ', {'CHARM_DIR': charm_dir}):
+            self.fh.install(self.url + '#sha256=' + sha256)
+            self.fh.install(self.url + '#sha256=' + sha256)
+        self.assertEqual(len(self.server.ranges), 1)
+        with open(os.path.join(charm_dir, 'fetched', 'foo.tgz'), 'rb') as f:
+            self.assertEqual(f.read(), self.server.content)
+
+    @patch('charmhelpers.fetch.plugins')
+    @patch('charmhelpers.fetch.archiveurl.extract')
+    def test_install_remote_many_with_fetch_cache(self, _extract, _plugins):
+        _plugins.return_value = [self.fh]
+        cache = fetch_cache.enable_fetch_cache(mkdtemp())
+        self.addCleanup(rmtree, cache.path)
+        self.addCleanup(fetch_cache.disable_fetch_cache)
+        sha256 = hashlib.sha256(self.server.content).hexdigest()
+        sources = [self.url.replace('foo.tgz', 'foo%d.tgz#sha256=%s' % (
+            i, sha256)) for i in range(8)]
+        charm_dir = os.path.dirname(self.dest)
+        with patch.dict('os.environ', {'CHARM_DIR': charm_dir}):
+            for i in range(2):
+                results, errors = fetch.install_remote_many(sources,
+                                                            max_workers=4)
+                self.assertEqual(errors, {})
+                self.assertEqual(sorted(results), sorted(sources))
+                if i == 0:
+                    downloads = len(self.server.ranges)
+        # The second round was installed from the cache.
+        self.assertEqual(len(self.server.ranges), downloads)
+        self.assertTrue(cache.lookup('sha256', sha256))
+
+    @nose.plugins.attrib.attr('slow')
+    @patch('charmhelpers.fetch.plugins')
+    @patch('charmhelpers.fetch.archiveurl.extract')
+    def test_install_remote_many_benchmark(self, _extract, _plugins):
+        """Time installing 16 sources from a server with 100ms latency."""
+        _plugins.return_value = [self.fh]
+        self.server.latency = 0.1
+        sources = [self.url.replace('foo.tgz', 'foo%d.tgz' % i)
+                   for i in range(16)]
+        charm_dir = os.path.dirname(self.dest)
+        os.mkdir(os.path.join(charm_dir, 'fetched'))
+        with patch.dict('os.environ', {'CHARM_DIR': charm_dir}):
+            before = time.time()
+            for source in sources:
+                fetch.install_remote(source)
+            serial = time.time() - before
+            before = time.time()
+            results, errors = fetch.install_remote_many(sources,
+                                                        max_workers=8)
+            parallel = time.time() - before
+        self.assertEqual((len(results), errors), (16, {}))
+        print('%d sources serially: %.3fs, 8 workers: %.3fs' % (
+            len(sources), serial, parallel))
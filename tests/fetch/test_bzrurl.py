@@ -122,6 +122,22 @@ class BzrUrlFetchHandlerTest(TestCase):
                 where = self.fh.install(url)
             self.assertEqual(where, dest_dir)
 
+    def test_installs_through_fetch_cache(self):
+        self.fh.branch = MagicMock()
+        self.fh.restore_from_cache = MagicMock()
+        self.fh.store_in_cache = MagicMock()
+        self.fh.revno = MagicMock(return_value='7')
+        url = self.valid_urls[0]
+        branch_name = urlparse(url).path.strip("/").split("/")[-1]
+        dest_dir = os.path.join('foo', 'fetched', branch_name)
+        with patch.dict('os.environ', {'CHARM_DIR': 'foo'}):
+            self.fh.install(url, revno=42)
+        key = 'bzr+{}#42'.format(url)
+        self.fh.restore_from_cache.assert_called_once_with(key, dest_dir)
+        self.fh.branch.assert_called_once_with(url, dest_dir, 42)
+        self.fh.revno.assert_called_once_with(dest_dir)
+        self.fh.store_in_cache.assert_called_once_with(key, dest_dir, '7')
+
     @patch('charmhelpers.fetch.bzrurl.mkdir')
     def test_installs_dir(self, _mkdir):
         self.fh.branch = MagicMock()
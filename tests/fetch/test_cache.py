@@ -0,0 +1,122 @@
+import hashlib
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from testtools import TestCase
+from mock import patch
+
+from charmhelpers.fetch import cache
+
+
+class FetchCacheTest(TestCase):
+
+    def setUp(self):
+        super(FetchCacheTest, self).setUp()
+        self.dir = mkdtemp()
+        self.addCleanup(rmtree, self.dir)
+        self.cache = cache.FetchCache(os.path.join(self.dir, 'cache'),
+                                      max_size=10)
+        self.now = 1000
+        patcher = patch('time.time', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def write(self, name, content):
+        path = os.path.join(self.dir, name)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def test_add_and_lookup(self):
+        path = self.write('a.tgz', b'aaaa')
+        sha256 = hashlib.sha256(b'aaaa').hexdigest()
+        digest = self.cache.add(path, checksums={'md5': 'cafe'},
+                                url='http://example.com/a.tgz', etag='"1"')
+        self.assertEqual(digest, sha256)
+        cached = self.cache.object_path(sha256)
+        self.assertEqual(self.cache.lookup('sha256', sha256), cached)
+        self.assertEqual(self.cache.lookup('md5', 'cafe'), cached)
+        self.assertEqual(self.cache.lookup('md5', 'beef'), None)
+        self.assertEqual(self.cache.lookup_url('http://example.com/a.tgz'),
+                         cached)
+        self.assertEqual(
+            self.cache.conditional_headers('http://example.com/a.tgz'),
+            {'If-None-Match': '"1"'})
+        self.assertEqual(
+            self.cache.conditional_headers('http://example.com/b.tgz'), {})
+
+        dest = self.cache.copy(cached, os.path.join(self.dir, 'copy.tgz'))
+        with open(dest, 'rb') as f:
+            self.assertEqual(f.read(), b'aaaa')
+
+    def test_lookup_missing_file(self):
+        path = self.write('a.tgz', b'aaaa')
+        digest = self.cache.add(path, url='http://example.com/a.tgz')
+        os.unlink(self.cache.object_path(digest))
+        self.assertEqual(self.cache.lookup('sha256', digest), None)
+        self.assertEqual(self.cache.lookup_url('http://example.com/a.tgz'),
+                         None)
+        self.assertEqual(self.cache.index.getrange('url.'), {})
+
+    def test_evicts_least_recently_used(self):
+        a = self.cache.add(self.write('a', b'aaaa'))
+        self.now += 1
+        b = self.cache.add(self.write('b', b'bbbb'))
+        self.now += 1
+        self.cache.lookup('sha256', a)
+        self.now += 1
+        c = self.cache.add(self.write('c', b'cccc'))
+        self.assertEqual(self.cache.lookup('sha256', b), None)
+        self.assertFalse(os.path.exists(self.cache.object_path(b)))
+        self.assertTrue(self.cache.lookup('sha256', a))
+        self.assertTrue(self.cache.lookup('sha256', c))
+
+    def test_tree(self):
+        tree = os.path.join(self.dir, 'tree')
+        os.makedirs(os.path.join(tree, 'sub'))
+        with open(os.path.join(tree, 'sub', 'file'), 'w') as f:
+            f.write('content')
+        self.cache.max_size = 1024 ** 2
+        self.cache.add_tree('git+http://example.com/repo#master', tree)
+
+        dest = os.path.join(self.dir, 'restored')
+        self.assertFalse(self.cache.extract_tree('git+other', dest))
+        self.assertTrue(
+            self.cache.extract_tree('git+http://example.com/repo#master',
+                                    dest))
+        with open(os.path.join(dest, 'sub', 'file')) as f:
+            self.assertEqual(f.read(), 'content')
+
+    def test_tree_version(self):
+        tree = os.path.join(self.dir, 'tree')
+        os.makedirs(tree)
+        self.cache.max_size = 1024 ** 2
+        self.assertEqual(self.cache.tree_version('bzr+lp:foo#None'), None)
+        self.cache.add_tree('bzr+lp:foo#None', tree, '42')
+        self.assertEqual(self.cache.tree_version('bzr+lp:foo#None'), '42')
+        self.cache.add_tree('bzr+lp:foo#None', tree)
+        self.assertEqual(self.cache.tree_version('bzr+lp:foo#None'), None)
+
+    def test_shared_index(self):
+        # Another process using the cache sees changes as they are made.
+        other = cache.FetchCache(self.cache.path, max_size=10)
+        a = self.cache.add(self.write('a', b'aaaa'), url='http://a')
+        self.assertEqual(other.lookup_url('http://a'),
+                         self.cache.object_path(a))
+        self.now += 1
+        other.add(self.write('b', b'bbbb'))
+        self.now += 1
+        self.cache.add(self.write('c', b'cccc'))
+        self.assertEqual(other.lookup('sha256', a), None)
+        self.assertEqual(sorted(other.index.getrange('object.', True)),
+                         sorted(self.cache.index.getrange('object.', True)))
+
+    def test_enable_fetch_cache(self):
+        self.addCleanup(cache.disable_fetch_cache)
+        self.assertEqual(cache.fetch_cache(), None)
+        enabled = cache.enable_fetch_cache(os.path.join(self.dir, 'other'))
+        self.assertEqual(cache.fetch_cache(), enabled)
+        self.assertEqual(enabled.max_size, cache.FETCH_CACHE_MAX_SIZE)
+        cache.disable_fetch_cache()
+        self.assertEqual(cache.fetch_cache(), None)
@@ -0,0 +1,110 @@
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from testtools import TestCase
+
+from charmhelpers.fetch import dpkg
+
+DPKG_STATUS = b"""Package: vim
+Status: install ok installed
+Priority: optional
+Architecture: amd64
+Version: 2:7.3.547-6ubuntu5
+Description: Vi IMproved - enhanced vi editor
+ Package: not-a-field
+
+Package: emacs
+Status: deinstall ok config-files
+Architecture: all
+Version: 24.5
+
+Package: libc6
+Status: install ok installed
+Architecture: i386
+Version: 2.23-0ubuntu1
+
+Package: libc6
+Status: install ok installed
+Architecture: amd64
+Version: 2.23-0ubuntu3
+
+Package: half
+Status: install reinstreq half-installed
+Architecture: amd64
+Version: 1.0
+"""
+
+
+class DpkgStatusTest(TestCase):
+
+    def setUp(self):
+        super(DpkgStatusTest, self).setUp()
+        tmpdir = mkdtemp()
+        self.addCleanup(rmtree, tmpdir)
+        self.path = os.path.join(tmpdir, 'status')
+        self.write(DPKG_STATUS)
+
+    def write(self, content):
+        with open(self.path, 'wb') as f:
+            f.write(content)
+
+    def test_installed(self):
+        status = dpkg.DpkgStatus(self.path)
+        self.assertTrue(status.installed('vim'))
+        self.assertEqual(status.installed_version('vim'),
+                         '2:7.3.547-6ubuntu5')
+        self.assertFalse(status.installed('emacs'))
+        self.assertFalse(status.installed('unknown'))
+        self.assertFalse(status.installed('not-a-field'))
+        self.assertTrue(status.installed('half'))
+
+    def test_architectures(self):
+        status = dpkg.DpkgStatus(self.path)
+        self.assertEqual(status.installed_version('libc6:i386'),
+                         '2.23-0ubuntu1')
+        self.assertEqual(status.installed_version('libc6:amd64'),
+                         '2.23-0ubuntu3')
+        self.assertFalse(status.installed('libc6:arm64'))
+        self.assertTrue(status.installed('libc6'))
+        self.assertFalse(status.installed('vim:i386'))
+
+    def test_parses_on_demand(self):
+        status = dpkg.DpkgStatus(self.path)
+        status.installed('vim')
+        self.assertEqual(list(status._packages), ['vim'])
+        status.installed('emacs')
+        self.assertEqual(sorted(status._packages), ['emacs', 'vim'])
+
+    def test_empty(self):
+        self.write(b'')
+        self.assertFalse(dpkg.DpkgStatus(self.path).installed('vim'))
+
+    def test_dpkg_status_invalidated_by_changes(self):
+        self.addCleanup(setattr, dpkg, '_status', None)
+        status = dpkg.dpkg_status(self.path)
+        self.assertIs(dpkg.dpkg_status(self.path), status)
+        self.assertFalse(status.installed('new'))
+
+        self.write(DPKG_STATUS + b'\nPackage: new\n'
+                   b'Status: install ok installed\nVersion: 1\n')
+        updated = dpkg.dpkg_status(self.path)
+        self.assertIsNot(updated, status)
+        self.assertTrue(updated.installed('new'))
+
+    def test_large_status(self):
+        """Queries against a large status file share one snapshot and only
+        parse the packages looked up."""
+        self.write(b'\n'.join(
+            b'Package: pkg%d\nStatus: install ok installed\n'
+            b'Architecture: amd64\nVersion: 1.%d\nDescription: package\n'
+            b' with a long description\n' % (i, i) for i in range(5000)))
+        self.addCleanup(setattr, dpkg, '_status', None)
+        status = dpkg.dpkg_status(self.path)
+        for i in range(0, 5000, 50):
+            self.assertIs(dpkg.dpkg_status(self.path), status)
+            self.assertEqual(status.installed_version('pkg%d' % i),
+                             '1.%d' % i)
+        self.assertTrue(status.installed('pkg4999'))
+        self.assertFalse(status.installed('pkg5000'))
+        self.assertEqual(len(status._packages), 102)
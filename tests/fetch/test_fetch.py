@@ -1,5 +1,7 @@
 import six
 import os
+import shutil
+import tempfile
 import yaml
 
 from testtools import TestCase
@@ -10,6 +12,7 @@ from mock import (
 )
 
 from charmhelpers import fetch
+from charmhelpers.fetch import cache as fetch_cache
 
 if six.PY3:
     from urllib.parse import urlparse
@@ -120,7 +123,17 @@ class FetchTest(TestCase):
         config.side_effect = ['source', 'key']
         fetch.configure_sources(update=True)
         add_source.assert_called_with('source', 'key')
-        self.assertTrue(update.called)
+        update.assert_called_once_with(fatal=True, skip_unchanged=False)
+
+    @patch.object(fetch, '_fetch_update')
+    @patch.object(fetch, 'config')
+    @patch.object(fetch, 'add_source')
+    def test_configure_sources_update_skip_unchanged(self, add_source, config,
+                                                     update):
+        config.side_effect = ['source', 'key']
+        fetch.configure_sources(update=True, skip_unchanged=True)
+        add_source.assert_called_with('source', 'key')
+        update.assert_called_once_with(fatal=True, skip_unchanged=True)
 
 
 class InstallTest(TestCase):
@@ -183,6 +196,50 @@ class InstallTest(TestCase):
         fetch.install_remote('url', extra_arg=True)
         h2.install.assert_called_with('url', extra_arg=True)
 
+    @patch('charmhelpers.fetch.log')
+    @patch('charmhelpers.fetch.install_remote')
+    def test_installs_remote_many(self, _instrem, _log):
+        def install(url, **kwargs):
+            if 'bad' in url:
+                raise fetch.UnhandledSource(url)
+            return '/dest/' + url.rsplit('/', 1)[1]
+        _instrem.side_effect = install
+
+        results, errors = fetch.install_remote_many([
+            'http://example.com/one.tgz',
+            ('http://example.com/two.tgz', {'checksum': 'deadbeef'}),
+            'http://example.com/bad.tgz',
+        ], max_workers=2)
+
+        self.assertEqual(results, {
+            'http://example.com/one.tgz': '/dest/one.tgz',
+            'http://example.com/two.tgz': '/dest/two.tgz',
+        })
+        self.assertEqual(list(errors), ['http://example.com/bad.tgz'])
+        self.assertIsInstance(errors['http://example.com/bad.tgz'],
+                              fetch.UnhandledSource)
+        _instrem.assert_any_call('http://example.com/two.tgz',
+                                 checksum='deadbeef')
+
+    @patch('charmhelpers.core.host.ThreadPool')
+    @patch('charmhelpers.fetch.install_remote')
+    def test_installs_remote_many_same_name_in_order(self, _instrem,
+                                                     _ThreadPool):
+        _ThreadPool.return_value.map.side_effect = (
+            lambda f, xs: [f(x) for x in xs])
+        fetch.install_remote_many([
+            'http://example.com/a/foo.tgz',
+            'http://example.com/bar.tgz',
+            'http://example.com/b/foo.tgz',
+        ], max_workers=8)
+        _ThreadPool.assert_called_once_with(2)
+        groups = _ThreadPool.return_value.map.call_args[0][1]
+        self.assertEqual(groups, [
+            [('http://example.com/a/foo.tgz', {}),
+             ('http://example.com/b/foo.tgz', {})],
+            [('http://example.com/bar.tgz', {})],
+        ])
+
     @patch('charmhelpers.fetch.install_remote')
     @patch('charmhelpers.fetch.config')
     def test_installs_from_config(self, _config, _instrem):
@@ -267,3 +324,37 @@ class BaseFetchHandlerTest(TestCase):
         expected_url = "http://example.com/foo"
         u = self.fh.base_url(sample_url)
         self.assertEqual(u, expected_url)
+
+    def test_tree_cache(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        tree = os.path.join(tmp, 'tree')
+        restored = os.path.join(tmp, 'restored')
+        os.mkdir(tree)
+        with open(os.path.join(tree, 'file'), 'w') as f:
+            f.write('content')
+
+        # Nothing is stored or restored without a fetch cache.
+        self.fh.store_in_cache('key', tree)
+        self.assertFalse(self.fh.restore_from_cache('key', restored))
+
+        fetch_cache.enable_fetch_cache(os.path.join(tmp, 'cache'))
+        self.addCleanup(fetch_cache.disable_fetch_cache)
+        self.assertFalse(self.fh.restore_from_cache('key', restored))
+        self.fh.store_in_cache('key', tree)
+        self.assertFalse(self.fh.restore_from_cache('key', tree))
+        self.assertTrue(self.fh.restore_from_cache('key', restored))
+        with open(os.path.join(restored, 'file')) as f:
+            self.assertEqual(f.read(), 'content')
+
+        # A version of the tree that is already cached is not stored again.
+        cache = fetch_cache.fetch_cache()
+        with patch.object(cache, 'add_tree') as add_tree:
+            self.fh.store_in_cache('key', tree, '1')
+            add_tree.assert_called_once_with('key', tree, '1')
+        self.fh.store_in_cache('key', tree, '1')
+        with patch.object(cache, 'add_tree') as add_tree:
+            self.fh.store_in_cache('key', tree, '1')
+            self.assertFalse(add_tree.called)
+            self.fh.store_in_cache('key', tree, '2')
+            add_tree.assert_called_once_with('key', tree, '2')
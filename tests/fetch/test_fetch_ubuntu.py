@@ -2,6 +2,7 @@ import six
 import subprocess
 import io
 import os
+import shutil
 import tempfile
 
 from tests.helpers import patch_open
@@ -87,6 +88,15 @@ def fake_apt_cache(in_memory=True, progress=None):
     return cache
 
 
+def fake_dpkg_status(path=None):
+    def _installed_version(package):
+        return FAKE_APT_CACHE.get(package, {}).get('current_ver')
+    status = MagicMock()
+    status.installed_version.side_effect = _installed_version
+    status.installed.side_effect = lambda p: bool(_installed_version(p))
+    return status
+
+
 def getenv(update=None):
     # return a copy of os.environ with update applied.
     # this was necessary because some modules modify os.environment directly
@@ -100,6 +110,7 @@ class FetchTest(TestCase):
 
     @patch("charmhelpers.fetch.ubuntu.log")
     @patch('apt_pkg.Cache')
+    @patch.object(fetch, 'dpkg_status', fake_dpkg_status)
     def test_filter_packages_missing_ubuntu(self, cache, log):
         cache.side_effect = fake_apt_cache
         result = fetch.filter_installed_packages(['vim', 'emacs'])
@@ -107,13 +118,16 @@ class FetchTest(TestCase):
 
     @patch("charmhelpers.fetch.ubuntu.log")
     @patch('apt_pkg.Cache')
+    @patch.object(fetch, 'dpkg_status', fake_dpkg_status)
     def test_filter_packages_none_missing_ubuntu(self, cache, log):
         cache.side_effect = fake_apt_cache
         result = fetch.filter_installed_packages(['vim'])
         self.assertEquals(result, [])
+        self.assertFalse(cache.called)
 
     @patch('charmhelpers.fetch.ubuntu.log')
     @patch('apt_pkg.Cache')
+    @patch.object(fetch, 'dpkg_status', fake_dpkg_status)
     def test_filter_packages_not_available_ubuntu(self, cache, log):
         cache.side_effect = fake_apt_cache
         result = fetch.filter_installed_packages(['vim', 'joe'])
@@ -189,8 +203,11 @@ class FetchTest(TestCase):
         fetch.add_source(source=source)
         check_call.assert_called_with(
             ['add-apt-repository', '--yes', source])
-        sleep.assert_called_with(10)
-        self.assertTrue(fetch.CMD_RETRY_COUNT, sleep.call_count)
+        self.assertEqual(sleep.call_count, fetch.CMD_RETRY_COUNT)
+        # jittered exponential backoff
+        delays = [args[0] for args, _ in sleep.call_args_list]
+        for retry, delay in enumerate(delays):
+            self.assertTrue(2 ** retry / 2.0 <= delay <= 2 ** retry)
 
     @patch('charmhelpers.fetch.ubuntu.log')
     @patch('subprocess.check_call')
@@ -456,6 +473,16 @@ class FetchTest(TestCase):
 
 class AptTests(TestCase):
 
+    def setUp(self):
+        super(AptTests, self).setUp()
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.apt_sources_state = os.path.join(tmpdir, 'apt-sources.json')
+        patcher = patch.object(fetch, 'APT_SOURCES_STATE',
+                               self.apt_sources_state)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
     @patch('subprocess.call')
     @patch('charmhelpers.fetch.ubuntu.log')
     def test_apt_upgrade_non_fatal(self, log, mock_call):
@@ -678,6 +705,215 @@ class AptTests(TestCase):
             ['apt-get', 'update'],
             env=getenv({'DEBIAN_FRONTEND': 'noninteractive'}))
 
+    def _apt_sources(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        sources = os.path.join(tmpdir, 'sources.list')
+        parts = os.path.join(tmpdir, 'sources.list.d')
+        keyrings = os.path.join(tmpdir, 'trusted.gpg.d')
+        os.mkdir(parts)
+        os.mkdir(keyrings)
+        for name, value in (('APT_SOURCE_LIST', sources),
+                            ('APT_SOURCE_PARTS', parts),
+                            ('APT_KEYRINGS', (keyrings,))):
+            patcher = patch.object(fetch, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        with open(sources, 'w') as f:
+            f.write('deb http://archive.ubuntu.com/ubuntu xenial main\n')
+        return tmpdir
+
+    @patch('subprocess.check_call')
+    @patch('time.time')
+    @patch('charmhelpers.fetch.ubuntu.log')
+    def test_apt_update_skipped_if_unchanged(self, log, _time, check_call):
+        tmpdir = self._apt_sources()
+        check_call.return_value = 0
+        _time.return_value = 1000
+        fetch.apt_update(fatal=True, skip_unchanged=True)
+        fetch.apt_update(fatal=True, skip_unchanged=True)
+        check_call.assert_called_once_with(
+            ['apt-get', 'update'],
+            env=getenv({'DEBIAN_FRONTEND': 'noninteractive'}))
+
+        # Sources changed in other ways than in sources.list.d
+        with open(os.path.join(tmpdir, 'trusted.gpg.d', 'key.gpg'),
+                  'w') as f:
+            f.write('key')
+        # backup files are ignored by apt
+        with open(os.path.join(tmpdir, 'sources.list.d', 'ppa.list.save'),
+                  'w') as f:
+            f.write('deb http://ppa.launchpad.net/foo/ubuntu xenial main')
+        fetch.apt_update(fatal=True, skip_unchanged=True)
+        self.assertEqual(check_call.call_count, 2)
+
+        # Updates are only skipped when asked for.
+        fetch.apt_update(fatal=True)
+        self.assertEqual(check_call.call_count, 3)
+        _time.return_value += fetch.APT_UPDATE_MAX_AGE
+        fetch.apt_update(fatal=True, skip_unchanged=True)
+        self.assertEqual(check_call.call_count, 4)
+        fetch.apt_update(fatal=True, skip_unchanged=True)
+        self.assertEqual(check_call.call_count, 4)
+
+    @patch('subprocess.call')
+    @patch('charmhelpers.fetch.ubuntu.log')
+    def test_apt_update_not_skipped_by_default(self, log, mock_call):
+        self._apt_sources()
+        mock_call.return_value = 0
+        fetch.apt_update()
+        fetch.apt_update()
+        self.assertEqual(mock_call.call_count, 2)
+        self.assertFalse(os.path.exists(self.apt_sources_state))
+
+    @patch('subprocess.call')
+    @patch('charmhelpers.fetch.ubuntu.log')
+    def test_apt_update_state_not_writable(self, log, mock_call):
+        self._apt_sources()
+        mock_call.return_value = 0
+        os.mkdir(self.apt_sources_state)
+        fetch.apt_update(skip_unchanged=True)
+        fetch.apt_update(skip_unchanged=True)
+        self.assertEqual(mock_call.call_count, 2)
+
+    @patch('subprocess.call')
+    @patch('charmhelpers.fetch.ubuntu.log')
+    def test_apt_update_scoped_to_new_sources(self, log, mock_call):
+        tmpdir = self._apt_sources()
+        mock_call.return_value = 0
+        fetch.apt_update(skip_unchanged=True)
+
+        ppa = os.path.join(tmpdir, 'sources.list.d', 'ppa.list')
+        with open(ppa, 'w') as f:
+            f.write('deb http://ppa.launchpad.net/foo/ubuntu xenial main')
+        fetch.apt_update(skip_unchanged=True)
+        mock_call.assert_called_with(
+            ['apt-get', 'update', '-o', 'Dir::Etc::sourcelist={}'.format(ppa),
+             '-o', 'Dir::Etc::sourceparts=-',
+             '-o', 'APT::Get::List-Cleanup=0'],
+            env=getenv({'DEBIAN_FRONTEND': 'noninteractive'}))
+        fetch.apt_update(skip_unchanged=True)
+        self.assertEqual(mock_call.call_count, 2)
+
+        # removing a source needs a full update to clean up its lists.
+        os.unlink(ppa)
+        fetch.apt_update(skip_unchanged=True)
+        mock_call.assert_called_with(
+            ['apt-get', 'update'],
+            env=getenv({'DEBIAN_FRONTEND': 'noninteractive'}))
+
+    @patch('subprocess.call')
+    @patch('charmhelpers.fetch.ubuntu.log')
+    def test_apt_update_failure_not_recorded(self, log, mock_call):
+        self._apt_sources()
+        mock_call.return_value = 1
+        fetch.apt_update(skip_unchanged=True)
+        fetch.apt_update(skip_unchanged=True)
+        self.assertEqual(mock_call.call_count, 2)
+
+    @patch('subprocess.check_call')
+    @patch('subprocess.call')
+    @patch('charmhelpers.fetch.retry.log')
+    @patch('charmhelpers.fetch.ubuntu.log')
+    def test_apt_transaction(self, log, retry_log, mock_call, check_call):
+        with fetch.apt_transaction():
+            fetch.apt_install(['foo', 'bar'])
+            fetch.apt_hold('foo', fatal=True)
+            fetch.apt_purge(['baz', 'bar'])
+            fetch.apt_install('qux', fatal=True)
+            fetch.apt_unhold('baz')
+            self.assertFalse(mock_call.called)
+            self.assertFalse(check_call.called)
+
+        env = getenv({'DEBIAN_FRONTEND': 'noninteractive'})
+        self.assertEqual(mock_call.call_args_list, [
+            call(['apt-mark', 'unhold', 'baz'], universal_newlines=True),
+            call(['apt-get', '--assume-yes',
+                  '--option=Dpkg::Options::=--force-confold', '--purge',
+                  'install', 'foo', 'baz-', 'bar-'], env=env),
+        ])
+        self.assertEqual(check_call.call_args_list, [
+            call(['apt-get', '--assume-yes',
+                  '--option=Dpkg::Options::=--force-confold',
+                  'install', 'qux'], env=env),
+            call(['apt-mark', 'hold', 'foo'], universal_newlines=True),
+        ])
+
+    @patch('subprocess.check_call')
+    @patch('subprocess.call')
+    @patch('charmhelpers.fetch.retry.log')
+    @patch('charmhelpers.fetch.ubuntu.log')
+    def test_apt_transaction_keeps_fatality(self, log, retry_log, mock_call,
+                                            check_call):
+        with fetch.apt_transaction():
+            fetch.apt_install(['foo'], fatal=True)
+            fetch.apt_purge(['bar'])
+            fetch.apt_purge(['baz'], fatal=True)
+            fetch.apt_hold(['foo'], fatal=True)
+            fetch.apt_hold(['qux'])
+        env = getenv({'DEBIAN_FRONTEND': 'noninteractive'})
+        self.assertEqual(check_call.call_args_list, [
+            call(['apt-get', '--assume-yes',
+                  '--option=Dpkg::Options::=--force-confold', '--purge',
+                  'install', 'foo', 'baz-'], env=env),
+            call(['apt-mark', 'hold', 'foo'], universal_newlines=True),
+        ])
+        self.assertEqual(mock_call.call_args_list, [
+            call(['apt-get', '--assume-yes', 'purge', 'bar'], env=env),
+            call(['apt-mark', 'hold', 'qux'], universal_newlines=True),
+        ])
+
+    @patch('subprocess.call')
+    @patch('charmhelpers.fetch.ubuntu.log')
+    def test_apt_transaction_groups_options(self, log, mock_call):
+        with fetch.apt_transaction():
+            fetch.apt_install(['foo'], options=['--foo'])
+            fetch.apt_install(['bar'])
+            with fetch.apt_transaction():
+                fetch.apt_install(['baz'], options=['--foo'])
+            fetch.apt_purge('qux')
+        env = getenv({'DEBIAN_FRONTEND': 'noninteractive'})
+        self.assertEqual(mock_call.call_args_list, [
+            call(['apt-get', '--assume-yes', '--foo', 'install',
+                  'foo', 'baz'], env=env),
+            call(['apt-get', '--assume-yes',
+                  '--option=Dpkg::Options::=--force-confold', '--purge',
+                  'install', 'bar', 'qux-'], env=env),
+        ])
+
+    @patch('subprocess.call')
+    @patch('charmhelpers.fetch.ubuntu.log')
+    def test_apt_transaction_purge_only(self, log, mock_call):
+        with fetch.apt_transaction():
+            fetch.apt_purge('foo')
+            fetch.apt_purge(['bar'])
+        mock_call.assert_called_once_with(
+            ['apt-get', '--assume-yes', 'purge', 'foo', 'bar'],
+            env=getenv({'DEBIAN_FRONTEND': 'noninteractive'}))
+
+    @patch('subprocess.call')
+    @patch('charmhelpers.fetch.ubuntu.log')
+    def test_apt_transaction_discarded_on_error(self, log, mock_call):
+        def install():
+            with fetch.apt_transaction():
+                fetch.apt_install(['foo'])
+                raise ValueError()
+        self.assertRaises(ValueError, install)
+        self.assertFalse(mock_call.called)
+        fetch.apt_install(['foo'])
+        self.assertTrue(mock_call.called)
+
+    @patch('subprocess.check_call')
+    @patch('time.sleep')
+    @patch('charmhelpers.fetch.ubuntu.log')
+    def test_apt_transaction_retries_lock(self, log, sleep, check_call):
+        check_call.side_effect = [
+            subprocess.CalledProcessError(fetch.APT_NO_LOCK, 'apt-get'), 0]
+        with fetch.apt_transaction():
+            fetch.apt_install(['foo'], fatal=True)
+        self.assertEqual(check_call.call_count, 2)
+        self.assertTrue(sleep.called)
+
     @patch('subprocess.check_call')
     @patch('time.sleep')
     def test_run_apt_command_retries_if_fatal(self, check_call, sleep):
@@ -704,9 +940,21 @@ class AptTests(TestCase):
         _run_apt_command(["some", "command"], fatal=True)
         self.assertTrue(sleep.called)
 
-    @patch('apt_pkg.Cache')
-    def test_get_upstream_version(self, cache):
-        cache.side_effect = fake_apt_cache
+    @patch('charmhelpers.fetch.retry.log')
+    @patch('subprocess.check_call')
+    @patch('time.sleep')
+    def test_run_with_retries_returns_result(self, sleep, check_call, log):
+        check_call.side_effect = [
+            subprocess.CalledProcessError(returncode=1, cmd="some command"),
+            0]
+        from charmhelpers.fetch.ubuntu import _run_with_retries
+        result = _run_with_retries(["some", "command"], return_result=True)
+        self.assertEqual(result.returncode, 0)
+        self.assertEqual(result.attempts, 2)
+        self.assertEqual(result.backoff_time, sleep.call_args[0][0])
+
+    @patch.object(fetch, 'dpkg_status', fake_dpkg_status)
+    def test_get_upstream_version(self):
         self.assertEqual(fetch.get_upstream_version('vim'), '7.3.547')
         self.assertEqual(fetch.get_upstream_version('emacs'), None)
         self.assertEqual(fetch.get_upstream_version('unknown'), None)
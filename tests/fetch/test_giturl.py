@@ -1,3 +1,4 @@
+import hashlib
 import os
 import shutil
 import subprocess
@@ -18,10 +19,12 @@ else:
 
 try:
     from charmhelpers.fetch import (
+        cache,
         giturl,
         UnhandledSource,
     )
 except ImportError:
+    cache = None
     giturl = None
     UnhandledSource = None
 
@@ -103,6 +106,79 @@ class GitUrlFetchHandlerTest(TestCase):
                 where = self.fh.install(url)
             self.assertEqual(where, dest)
 
+    def _repo(self):
+        src = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, src, ignore_errors=True)
+        with chdir(src):
+            subprocess.check_call(['git', 'init', '-q'])
+            subprocess.check_call(['git', 'config', 'user.name', 'Joe'])
+            subprocess.check_call(
+                ['git', 'config', 'user.email', 'joe@test.com'])
+            subprocess.check_call(['git', 'checkout', '-q', '-b', 'master'])
+        self._commit(src, 'foo')
+        return src
+
+    def _commit(self, repo, name):
+        with chdir(repo):
+            subprocess.check_call(['touch', name])
+            subprocess.check_call(['git', 'add', name])
+            subprocess.check_call(['git', 'commit', '-q', '-m', name])
+
+    def test_clone_through_mirror(self):
+        src = self._repo()
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.addCleanup(cache.disable_fetch_cache)
+        cache.enable_fetch_cache(os.path.join(tmpdir, 'cache'))
+        dst = os.path.join(tmpdir, 'dst')
+
+        with patch.object(giturl, 'check_call',
+                          MagicMock(wraps=subprocess.check_call)) as cc:
+            self.fh.clone(src, dst)
+            self.assertEqual(cc.call_args_list[0][0][0][:3],
+                             ['git', 'clone', '--mirror'])
+            mirror = os.path.join(
+                tmpdir, 'cache', 'git',
+                hashlib.sha256(src.encode('utf-8')).hexdigest() + '.git')
+            cc.assert_called_with(['git', 'clone', src, dst, '--branch',
+                                   'master', '--reference', mirror,
+                                   '--dissociate'])
+            self.assertTrue(os.path.exists(os.path.join(dst, 'foo')))
+            # dissociated from the mirror
+            self.assertFalse(os.path.exists(os.path.join(
+                dst, '.git', 'objects', 'info', 'alternates')))
+
+            # Nothing to do when the branch is already checked out.
+            cc.reset_mock()
+            self.fh.clone(src, dst)
+            cc.assert_called_once_with(
+                ['git', '-C', mirror, 'fetch', '--prune', 'origin'])
+
+            # Nor is the mirror fetched for a commit already checked out.
+            cc.reset_mock()
+            self.fh.clone(src, dst, branch=self.fh.checked_out(dst))
+            self.assertFalse(cc.called)
+
+            self._commit(src, 'bar')
+            self.fh.clone(src, dst)
+            cc.assert_called_with(['git', '-C', dst, 'pull', mirror,
+                                   'master'])
+            self.assertTrue(os.path.exists(os.path.join(dst, 'bar')))
+
+    def test_clone_up_to_date_without_mirror(self):
+        src = self._repo()
+        dst = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, dst, ignore_errors=True)
+        os.rmdir(dst)
+        self.fh.clone(src, dst)
+        with patch.object(giturl, 'check_call') as check_call:
+            self.fh.clone(src, dst)
+            self.assertFalse(check_call.called)
+            head = self.fh.checked_out(dst)
+            self.assertEqual(self.fh.revision(src, 'master'), head)
+            self.assertEqual(self.fh.revision(src, head), head)
+            self.assertEqual(self.fh.revision(src, 'missing'), None)
+
     def test_installs_specified_dest(self):
         self.fh.clone = MagicMock()
 
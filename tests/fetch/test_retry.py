@@ -0,0 +1,115 @@
+import fcntl
+import os
+import subprocess
+import sys
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from mock import MagicMock, patch
+from testtools import TestCase
+
+from charmhelpers.fetch import retry
+
+
+class RetryTest(TestCase):
+
+    def setUp(self):
+        super(RetryTest, self).setUp()
+        for target in ('time.sleep', 'charmhelpers.fetch.retry.log'):
+            patcher = patch(target)
+            setattr(self, target.split('.')[-1], patcher.start())
+            self.addCleanup(patcher.stop)
+
+    @patch('subprocess.check_call')
+    def test_backoff(self, check_call):
+        check_call.side_effect = [
+            subprocess.CalledProcessError(100, 'apt-get'),
+            subprocess.CalledProcessError(100, 'apt-get'),
+            subprocess.CalledProcessError(100, 'apt-get'),
+            0]
+        result = retry.run_with_retries(['apt-get'], retry_exitcodes=(100,),
+                                        base_delay=1, max_delay=3, env={})
+        check_call.assert_called_with(['apt-get'], env={})
+        self.assertEqual(result.returncode, 0)
+        self.assertEqual(result.attempts, 4)
+        delays = [args[0] for args, _ in self.sleep.call_args_list]
+        self.assertEqual(len(delays), 3)
+        self.assertTrue(0.5 <= delays[0] <= 1)
+        self.assertTrue(1 <= delays[1] <= 2)
+        self.assertTrue(1.5 <= delays[2] <= 3)
+        self.assertAlmostEqual(result.backoff_time, sum(delays))
+        self.assertEqual(result.lock_wait_time, 0)
+        self.assertIn('after 4 attempts', self.log.call_args[0][0])
+
+    @patch('subprocess.check_call')
+    def test_gives_up(self, check_call):
+        check_call.side_effect = subprocess.CalledProcessError(1, 'snap')
+        self.assertRaises(subprocess.CalledProcessError,
+                          retry.run_with_retries, ['snap'], max_retries=2)
+        self.assertEqual(check_call.call_count, 3)
+
+    @patch('subprocess.check_call')
+    def test_other_exit_code(self, check_call):
+        check_call.side_effect = subprocess.CalledProcessError(2, 'apt-get')
+        result = retry.run_with_retries(['apt-get'])
+        self.assertEqual(result.returncode, 2)
+        self.assertEqual(result.attempts, 1)
+        self.assertFalse(self.sleep.called)
+
+    @patch('subprocess.check_call')
+    def test_first_attempt_logged_at_debug(self, check_call):
+        result = retry.run_with_retries(['apt-get'])
+        self.assertEqual(result.attempts, 1)
+        self.log.assert_called_once_with(str(result), level=retry.DEBUG)
+
+    @patch.object(retry, 'lock_held')
+    @patch('subprocess.check_call')
+    def test_waits_for_lock(self, check_call, lock_held):
+        check_call.side_effect = [
+            subprocess.CalledProcessError(100, 'apt-get'), 0]
+        # held when the command fails, then twice more while polling.
+        lock_held.side_effect = [True, True, True, False]
+        result = retry.run_with_retries(['apt-get'], retry_exitcodes=(100,),
+                                        lock_paths=['/lock'])
+        self.assertEqual(result.returncode, 0)
+        self.assertEqual(self.sleep.call_count, 2)
+        for (delay,), _ in self.sleep.call_args_list:
+            self.assertTrue(delay <= retry.LOCK_POLL_MAX_INTERVAL)
+        self.assertEqual(result.backoff_time, 0)
+
+    @patch.object(retry, 'lock_held', lambda path: True)
+    @patch('time.time')
+    def test_wait_for_locks_timeout(self, _time):
+        _time.side_effect = [0, 4, 11]
+        self.assertEqual(retry.wait_for_locks(['/lock'], timeout=10), 11)
+        self.assertEqual(self.sleep.call_count, 2)
+
+    def test_lock_held(self):
+        tmpdir = mkdtemp()
+        self.addCleanup(rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'lock')
+        open(path, 'w').close()
+        self.assertFalse(retry.lock_held(path))
+        self.assertFalse(retry.lock_held(os.path.join(tmpdir, 'missing')))
+
+        holder = subprocess.Popen(
+            [sys.executable, '-c',
+             'import fcntl, sys; f = open(sys.argv[1], "r+"); '
+             'fcntl.lockf(f, fcntl.LOCK_EX); print("locked"); '
+             'sys.stdout.flush(); sys.stdin.read()', path],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.addCleanup(holder.wait)
+        self.addCleanup(holder.stdin.close)
+        holder.stdout.readline()
+        self.assertTrue(retry.lock_held(path))
+
+        # Probing never takes the lock, which would fail a concurrent apt.
+        fcntl_ = MagicMock(wraps=fcntl.fcntl)
+        with patch.object(fcntl, 'lockf') as lockf, \
+                patch.object(fcntl, 'flock') as flock, \
+                patch.object(fcntl, 'fcntl', fcntl_):
+            self.assertTrue(retry.lock_held(path))
+        self.assertFalse(lockf.called)
+        self.assertFalse(flock.called)
+        self.assertEqual([args[1] for args, _ in fcntl_.call_args_list],
+                         [fcntl.F_GETLK])
@@ -64,6 +64,119 @@ class SnapTest(TestCase):
         snap_remove(['hello-world', 'htop'])
         check_call.assert_called_with(['snap', 'remove', 'hello-world', 'htop'], env=TEST_ENV)
 
+    @patch('time.sleep')
+    @patch('subprocess.check_call')
+    @patch('os.environ', TEST_ENV)
+    def testSnapLockRetries(self, check_call, sleep):
+        """
+        Test snap commands are retried with backoff while snap is locked.
+
+        :param check_call: Mock object
+        :param sleep: Mock object
+        :return: None
+        """
+        from subprocess import CalledProcessError
+        from charmhelpers.fetch.snap import (
+            snap_install,
+            CouldNotAcquireLockException,
+            SNAP_NO_LOCK,
+            SNAP_NO_LOCK_RETRY_COUNT,
+            SNAP_NO_LOCK_RETRY_DELAY,
+        )
+        check_call.side_effect = CalledProcessError(SNAP_NO_LOCK, 'snap')
+        with self.assertRaises(CouldNotAcquireLockException):
+            snap_install('hello-world')
+        self.assertEqual(check_call.call_count, SNAP_NO_LOCK_RETRY_COUNT + 1)
+        delays = [args[0] for args, _ in sleep.call_args_list]
+        self.assertLess(delays[0], 1.1)
+        self.assertLessEqual(max(delays), SNAP_NO_LOCK_RETRY_DELAY)
+
+    @patch('subprocess.check_call')
+    @patch('os.environ', TEST_ENV)
+    def testSnapExecReturnsResult(self, check_call):
+        """
+        Test the RetryResult is returned on request.
+
+        :param check_call: Mock object
+        :return: None
+        """
+        from charmhelpers.fetch.snap import _snap_exec
+        check_call.return_value = 0
+        self.assertEqual(_snap_exec(['list']), 0)
+        result = _snap_exec(['list'], return_result=True)
+        self.assertEqual(result.cmd, ['snap', 'list'])
+        self.assertEqual(result.returncode, 0)
+        self.assertEqual(result.attempts, 1)
+
+    @patch('subprocess.check_output')
+    def testSnapList(self, check_output):
+        """
+        Test listing installed snaps.
+
+        :param check_output: Mock object
+        :return: None
+        """
+        from charmhelpers.fetch.snap import snap_list
+        check_output.return_value = (
+            u'Name   Version  Rev   Tracking  Publisher   Notes\n'
+            u'core   16-2.35  5548  stable    canonical\u2713  core\n'
+            u'hello  2.10     42    edge      canonical\u2713  -\n'
+        ).encode('utf-8')
+        snaps = snap_list()
+        check_output.assert_called_once_with(['snap', 'list'])
+        self.assertEqual(sorted(snaps), ['core', 'hello'])
+        self.assertEqual(snaps['hello']['tracking'], 'edge')
+        self.assertEqual(snaps['core']['rev'], '5548')
+
+        check_output.return_value = b''
+        self.assertEqual(snap_list(), {})
+
+    @patch('charmhelpers.fetch.snap._snap_exec')
+    @patch('charmhelpers.fetch.snap.snap_list')
+    def testSnapMany(self, snap_list, snap_exec):
+        """
+        Test batching snap installs.
+
+        :param snap_list: Mock object
+        :param snap_exec: Mock object
+        :return: None
+        """
+        from subprocess import CalledProcessError
+        from charmhelpers.fetch.snap import snap_many
+        snap_list.return_value = {'core': {}}
+
+        def _exec(commands):
+            if 'broken' in commands:
+                return 2
+            return 0
+        snap_exec.side_effect = _exec
+        results, errors = snap_many('install', {
+            'core': [],
+            'htop': ['--dangerous'],
+            'jq': ['--dangerous'],
+            'nova': ['--channel=ocata/beta', '--classic'],
+            'neutron': ['--channel=ocata/beta', '--classic'],
+            'broken': [],
+        })
+        self.assertEqual(results, {'core': False, 'htop': True, 'jq': True,
+                                   'nova': True, 'neutron': True})
+        self.assertEqual(list(errors), ['broken'])
+        self.assertIsInstance(errors['broken'], CalledProcessError)
+        commands = sorted(args[0] for args, _ in snap_exec.call_args_list)
+        self.assertEqual(len(commands), 4)
+        self.assertIn(['install', '--dangerous', 'htop', 'jq'], commands)
+        self.assertIn(['install', '--channel=ocata/beta', '--classic',
+                       'nova'], commands)
+        self.assertIn(['install', '--channel=ocata/beta', '--classic',
+                       'neutron'], commands)
+        self.assertIn(['install', 'broken'], commands)
+
+        snap_exec.reset_mock()
+        results, errors = snap_many('remove', {'core': [], 'htop': []},
+                                    workers=1)
+        self.assertEqual(results, {'core': True, 'htop': False})
+        snap_exec.assert_called_once_with(['remove', 'core'])
+
     def test_valid_snap_channel(self):
         """ Test valid snap channel
 
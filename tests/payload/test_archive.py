@@ -4,10 +4,14 @@ from mock import (
     patch,
     MagicMock,
 )
+from charmhelpers.core import host
 from charmhelpers.payload import archive
 from tempfile import mkdtemp
 from shutil import rmtree
 import subprocess
+import tarfile
+import time
+import zipfile
 
 
 class ArchiveTestCase(TestCase):
@@ -104,7 +108,7 @@ class ArchiveTestCase(TestCase):
         dest = archive.extract(archive_name, "bar")
 
         _gethandler.assert_called_with(archive_name)
-        archive_handler.assert_called_with(archive_name, "bar")
+        archive_handler.assert_called_with(archive_name, "bar", {})
         _defdest.assert_not_called()
         _mkdir.assert_called_with("bar")
         self.assertEqual(dest, "bar")
@@ -134,4 +138,150 @@ class ArchiveTestCase(TestCase):
 
         dest = archive.extract(archive_name)
         self.assertEqual(expected_dest, dest)
-        handler.assert_called_with(archive_name, expected_dest)
+        handler.assert_called_with(archive_name, expected_dest, {})
+
+    def write_archive(self, format, files, basename='payload'):
+        workdir = mkdtemp()
+        self.addCleanup(rmtree, workdir)
+        for name, content in files.items():
+            path = os.path.join(workdir, 'src', name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write(content)
+        archive_name = os.path.join(workdir, basename + '.' + format)
+        if format == 'tar.gz':
+            with tarfile.open(archive_name, 'w:gz') as tar:
+                tar.add(os.path.join(workdir, 'src'), arcname='payload')
+        else:
+            with zipfile.ZipFile(archive_name, 'w') as zf:
+                for name in sorted(files):
+                    zf.write(os.path.join(workdir, 'src', name),
+                             os.path.join('payload', name))
+        return archive_name
+
+    def check_incremental_extract(self, format):
+        destdir = mkdtemp()
+        self.addCleanup(rmtree, destdir)
+        payload = os.path.join(destdir, 'payload')
+        v1 = self.write_archive(format, {
+            'same': 'same', 'changed': 'v1', 'removed': 'gone',
+            'sub/file': 'sub'})
+        v2 = self.write_archive(format, {
+            'same': 'same', 'changed': 'v2', 'sub/file': 'sub',
+            'added': 'new'})
+
+        archive.extract(v1, destdir)
+        manifest = archive.read_manifest(destdir, v1)
+        self.assertEqual(sorted(manifest['members']), [
+            'payload/changed', 'payload/removed', 'payload/same',
+            'payload/sub/file'])
+        inodes = {name: os.stat(os.path.join(payload, name)).st_ino
+                  for name in ('same', 'changed', 'sub/file')}
+
+        # Extracting the same archive again is skipped.
+        with patch.object(archive, 'get_archive_handler') as handler:
+            handler.return_value = MagicMock()
+            archive.extract(v1, destdir)
+        self.assertFalse(handler.return_value.called)
+
+        # A new version only replaces changed files.
+        archive.extract(v2, destdir)
+        for name, content in (('same', 'same'), ('changed', 'v2'),
+                              ('sub/file', 'sub'), ('added', 'new')):
+            with open(os.path.join(payload, name)) as f:
+                self.assertEqual(f.read(), content)
+        self.assertFalse(os.path.exists(os.path.join(payload, 'removed')))
+        self.assertEqual(os.stat(os.path.join(payload, 'same')).st_ino,
+                         inodes['same'])
+        self.assertEqual(os.stat(os.path.join(payload, 'sub/file')).st_ino,
+                         inodes['sub/file'])
+        self.assertEqual(archive.read_manifest(destdir, v2)['archive'],
+                         archive.host.file_hash(v2, 'sha256'))
+
+        # Missing files are extracted again.
+        os.unlink(os.path.join(payload, 'same'))
+        archive.extract(v2, destdir)
+        self.assertTrue(os.path.exists(os.path.join(payload, 'same')))
+
+        # So are files modified without changing their size.
+        with open(os.path.join(payload, 'changed'), 'w') as f:
+            f.write('xx')
+        archive.extract(v2, destdir)
+        with open(os.path.join(payload, 'changed')) as f:
+            self.assertEqual(f.read(), 'v2')
+
+    @patch('charmhelpers.core.hookenv.log')
+    def test_extracts_archives_to_shared_destination(self, _log):
+        destdir = mkdtemp()
+        self.addCleanup(rmtree, destdir)
+        workdir = mkdtemp()
+        self.addCleanup(rmtree, workdir)
+        a = self.write_archive('tar.gz', {'a.txt': 'a', 'shared': 'a'})
+        b = self.write_archive('zip', {'b.txt': 'b', 'shared': 'b'})
+        a2 = os.path.join(workdir, os.path.basename(a))
+        with tarfile.open(a2, 'w:gz') as tar:
+            tar.add(b, arcname='payload/c.txt')
+
+        archive.extract(a, destdir)
+        archive.extract(b, destdir)
+        payload = os.path.join(destdir, 'payload')
+        self.assertEqual(sorted(os.listdir(payload)),
+                         ['a.txt', 'b.txt', 'shared'])
+        self.assertEqual(sorted(archive.read_manifests(destdir)),
+                         ['payload.tar.gz', 'payload.zip'])
+
+        # A new version of a only removes the files a recorded, and keeps
+        # those b recorded too.
+        archive.extract(a2, destdir)
+        self.assertEqual(sorted(os.listdir(payload)),
+                         ['b.txt', 'c.txt', 'shared'])
+        self.assertEqual(
+            sorted(archive.read_manifest(destdir, b)['members']),
+            ['payload/b.txt', 'payload/shared'])
+
+    @patch('charmhelpers.core.hookenv.log')
+    def test_malformed_manifest_extracts_again(self, _log):
+        destdir = mkdtemp()
+        self.addCleanup(rmtree, destdir)
+        a = self.write_archive('tar.gz', {'a.txt': 'a'})
+        archive.extract(a, destdir)
+        os.unlink(os.path.join(destdir, 'payload', 'a.txt'))
+        archive.write_manifest(destdir, a, {
+            'archive': archive.host.file_hash(a, 'sha256')})
+        self.assertEqual(archive.read_manifest(destdir, a), {})
+        archive.extract(a, destdir)
+        self.assertTrue(os.path.exists(
+            os.path.join(destdir, 'payload', 'a.txt')))
+        self.assertEqual(
+            sorted(archive.read_manifest(destdir, a)['members']),
+            ['payload/a.txt'])
+
+    @patch('charmhelpers.core.hookenv.log')
+    def test_concurrent_extracts_keep_manifests(self, _log):
+        destdir = mkdtemp()
+        self.addCleanup(rmtree, destdir)
+        names = ['archive%d' % i for i in range(8)]
+        archives = [self.write_archive('tar.gz', {name: name}, basename=name)
+                    for name in names]
+        read_manifests = archive.read_manifests
+
+        def slow_read_manifests(destpath):
+            # Widen the window between reading and writing the manifest.
+            manifests = read_manifests(destpath)
+            time.sleep(0.01)
+            return manifests
+
+        with patch.object(archive, 'read_manifests', slow_read_manifests):
+            host.parallel_map(lambda a: archive.extract(a, destdir),
+                              archives, workers=8)
+        self.assertEqual(sorted(archive.read_manifests(destdir)),
+                         sorted(name + '.tar.gz' for name in names))
+
+    @patch('charmhelpers.core.hookenv.log')
+    def test_extracts_tarfile_incrementally(self, _log):
+        self.check_incremental_extract('tar.gz')
+
+    @patch('charmhelpers.core.hookenv.log')
+    def test_extracts_zipfile_incrementally(self, _log):
+        self.check_incremental_extract('zip')